@@ -0,0 +1,371 @@
+'''Archives of many pickles, read and written with picklelite3.
+
+ArchiveWriter(file, protocol=None)
+   Write many independent pickles, each under a str key, to one file,
+   followed by an index of them.
+
+Archive(path)
+   Read such an archive as a mapping of its keys to the unpickled
+   entries, in place through a memory map.
+'''
+
+import collections.abc
+import hashlib
+import io
+import mmap
+import os
+import struct
+import threading
+from functools import partial
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import gzip
+except ImportError:
+    gzip = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from picklelite3 import (
+    PROTO, MappedFile, Pickler, Unpickler, UnpicklingError, dumps,
+    get_metrics, loads,
+)
+
+__all__ = ['ArchiveWriter', 'Archive']
+
+# Magic number -> opener of the decompressed stream, for add_file()
+_COMPRESSED_FORMATS = []
+if lzma is not None:
+    _COMPRESSED_FORMATS.append((b'\xfd7zXZ\x00', lzma.open))
+if gzip is not None:
+    _COMPRESSED_FORMATS.append((b'\x1f\x8b', gzip.open))
+if bz2 is not None:
+    _COMPRESSED_FORMATS.append((b'BZh', bz2.open))
+
+# An archive is _ARCHIVE_MAGIC, the pickles one after another, a footer
+# and a trailer.  The footer is a pickle of plain data, (keys, table,
+# digests): table packs an _ARCHIVE_ENTRY for each key in turn, and
+# digests holds the BLAKE2b digest of each pickle.  The trailer gives
+# the offset of the footer.
+
+_ARCHIVE_MAGIC = b'PLA1'
+_ARCHIVE_ENTRY = struct.Struct('<QQB')      # offset, length, protocol
+_ARCHIVE_TRAILER = struct.Struct('<Q4s')    # footer offset, magic
+_ARCHIVE_DIGEST_SIZE = 16
+
+def _archive_digest(data):
+    return hashlib.blake2b(data, digest_size=_ARCHIVE_DIGEST_SIZE).digest()
+
+class ArchiveWriter:
+    """Write many independent pickles, each under a str key, to one file.
+
+    Pickles are appended as they are added; close() then writes the
+    footer index, without which the archive can't be read.  file is a
+    path or a binary file open for writing at its start.
+    """
+
+    def __init__(self, file, protocol=None):
+        if isinstance(file, (str, bytes, os.PathLike)):
+            self._file = open(file, 'wb')
+            self._owns_file = True
+        else:
+            self._file = file
+            self._owns_file = False
+        self._pickler = Pickler(io.BytesIO(), protocol)
+        self._buffer = bytearray()
+        self._keys = []
+        self._seen = set()
+        self._table = bytearray()
+        self._digests = bytearray()
+        self._file.write(_ARCHIVE_MAGIC)
+        self._offset = len(_ARCHIVE_MAGIC)
+
+    def add(self, key, data):
+        """Append data, a whole pickle, under key."""
+        if self._file is None:
+            raise ValueError("add to a closed archive")
+        if not isinstance(key, str):
+            raise TypeError("archive keys must be str, not %s" %
+                            type(key).__name__)
+        if key in self._seen:
+            raise ValueError("duplicate archive key %r" % key)
+        if len(data) > 1 and data[0] == PROTO[0]:
+            protocol = data[1]
+        else:
+            protocol = 0
+        self._file.write(data)
+        self._keys.append(key)
+        self._seen.add(key)
+        self._table += _ARCHIVE_ENTRY.pack(self._offset, len(data), protocol)
+        self._digests += _archive_digest(data)
+        self._offset += len(data)
+
+    def dump(self, key, obj):
+        """Pickle obj and append it under key."""
+        self.add(key, self._pickler.dump_into(obj, self._buffer))
+
+    def add_file(self, key, path):
+        """Append the pickle in the file at path under key.
+
+        xz, gzip and bz2 compressed files are decompressed first.
+        """
+        with open(path, 'rb') as f:
+            magic = f.peek(6)[:6]
+            for prefix, opener in _COMPRESSED_FORMATS:
+                if magic.startswith(prefix):
+                    with opener(f) as decompressed:
+                        data = decompressed.read()
+                    break
+            else:
+                data = f.read()
+        self.add(key, data)
+
+    def close(self):
+        """Write the footer index, and close the file if it was opened
+        from a path."""
+        if self._file is None:
+            return
+        self._file.write(dumps((self._keys, bytes(self._table),
+                                 bytes(self._digests)), 4))
+        self._file.write(_ARCHIVE_TRAILER.pack(self._offset, _ARCHIVE_MAGIC))
+        if self._owns_file:
+            self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Archive(collections.abc.Mapping):
+    """Read an archive written by ArchiveWriter.
+
+    archive[key] unpickles the entry under key.  The file is memory
+    mapped, and view() returns the bytes of an entry without copying
+    them.  load() decodes a copy, which is faster than reading the
+    mapping through a file position; with bytes_views it reads in place
+    through a mapping of the calling thread's own.  Threads may share
+    one Archive; processes should each open the archive.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self._file = open(path, 'rb')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < len(_ARCHIVE_MAGIC) + _ARCHIVE_TRAILER.size:
+                raise UnpicklingError("%r is not an archive" % self.path)
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            footer, magic = _ARCHIVE_TRAILER.unpack_from(
+                self._map, size - _ARCHIVE_TRAILER.size)
+            if (self._map[:len(_ARCHIVE_MAGIC)] != _ARCHIVE_MAGIC or
+                    magic != _ARCHIVE_MAGIC or
+                    not len(_ARCHIVE_MAGIC) <= footer <= size -
+                    _ARCHIVE_TRAILER.size):
+                raise UnpicklingError("%r is not an archive, or was not "
+                                      "closed" % self.path)
+            self._keys, self._table, self._digests = loads(
+                self._map[footer:size - _ARCHIVE_TRAILER.size],
+                policy='data')
+        except BaseException:
+            self._file.close()
+            raise
+        self._index = {key: i for i, key in enumerate(self._keys)}
+        self._local = threading.local()
+        self._mapped_files = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        return self.load(key)
+
+    def _span(self, key):
+        # (offset, length) of the entry under key
+        offset, length, _ = _ARCHIVE_ENTRY.unpack_from(
+            self._table, self._index[key] * _ARCHIVE_ENTRY.size)
+        return offset, length
+
+    def entry(self, key):
+        """Return (offset, length, protocol, digest) of the entry under
+        key."""
+        i = self._index[key]
+        digest = self._digests[i * _ARCHIVE_DIGEST_SIZE:
+                               (i + 1) * _ARCHIVE_DIGEST_SIZE]
+        return _ARCHIVE_ENTRY.unpack_from(
+            self._table, i * _ARCHIVE_ENTRY.size) + (digest,)
+
+    def view(self, key):
+        """Return a read-only memoryview of the pickle under key."""
+        offset, length = self._span(key)
+        return memoryview(self._map)[offset:offset + length]
+
+    def verify(self, key):
+        """Return whether the pickle under key matches its digest."""
+        with self.view(key) as data:
+            return _archive_digest(data) == self.entry(key)[3]
+
+    def _mapped_file(self):
+        # This thread's mapping of the archive, for bytes_views loads
+        file = getattr(self._local, 'file', None)
+        if file is None:
+            file = MappedFile(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+            self._local.file = file
+            with self._lock:
+                self._mapped_files.append(file)
+        return file
+
+    def load(self, key, **kwargs):
+        """Unpickle the entry under key; kwargs are as for load_path()."""
+        offset, length = self._span(key)
+        if kwargs.get('bytes_views'):
+            file = self._mapped_file()
+            file.seek(offset)
+        else:
+            file = io.BytesIO(self._map[offset:offset + length])
+            offset = 0
+        unpickler = Unpickler(file, **kwargs)
+        metrics = get_metrics()
+        if metrics is None:
+            obj = unpickler.load()
+        else:
+            obj = metrics.observe("archive_load", unpickler.load,
+                                  unpickler, lambda: file.tell() - offset)
+        if file.tell() > offset + length:
+            raise UnpicklingError("the pickle under %r runs past its end" %
+                                  key)
+        return obj
+
+    def get_many(self, keys, *, max_workers=None, chunksize=256,
+                 return_exceptions=False, **kwargs):
+        """Return a list of the objects under keys, in the same order.
+
+        Entries are loaded in the order they are stored, so the archive
+        is read front to back.  If max_workers is given, chunks of
+        chunksize keys are loaded in a pool of that many processes, which
+        each open the archive; the objects are sent back pickled, so
+        they must be picklable.  If return_exceptions is true an
+        exception raised for a key is returned in its place.
+        """
+        keys = list(keys)
+        if max_workers is None:
+            return self._get_many(keys, return_exceptions, kwargs)
+        from concurrent.futures import ProcessPoolExecutor
+        worker = partial(_archive_get_many, self.path,
+                         return_exceptions=return_exceptions, kwargs=kwargs)
+        chunks = [keys[i:i + chunksize]
+                  for i in range(0, len(keys), chunksize)]
+        with ProcessPoolExecutor(max_workers) as executor:
+            return [obj for objs in executor.map(worker, chunks)
+                    for obj in objs]
+
+    def _get_many(self, keys, return_exceptions, kwargs):
+        index = self._index
+        table = self._table
+        size = _ARCHIVE_ENTRY.size
+        def offset(n):
+            i = index.get(keys[n])
+            return -1 if i is None else _ARCHIVE_ENTRY.unpack_from(
+                table, i * size)[0]
+        objs = [None] * len(keys)
+        for n in sorted(range(len(keys)), key=offset):
+            try:
+                objs[n] = self.load(keys[n], **kwargs)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                objs[n] = e
+        return objs
+
+    def close(self):
+        """Unmap and close the archive.  Memoryviews from view() or
+        bytes_views loads must have been released."""
+        with self._lock:
+            for file in self._mapped_files:
+                file.close()
+            self._mapped_files.clear()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Archives opened by _archive_get_many() in a worker process
+_worker_archives = {}
+
+def _archive_get_many(path, keys, return_exceptions, kwargs):
+    # Runs in a worker process of Archive.get_many()
+    archive = _worker_archives.get(path)
+    if archive is None:
+        archive = _worker_archives[path] = Archive(path)
+    return archive._get_many(keys, return_exceptions, kwargs)
+
+
+# Doctest
+__test__ = {"archive_round_trip": """
+Entries dumped, added as pickles or added from compressed files are
+read back as pickle reads them:
+
+>>> import gzip, pickle, tempfile
+>>> folder = tempfile.mkdtemp()
+>>> path = os.path.join(folder, 'archive')
+>>> compressed = os.path.join(folder, 'entry.pkl.gz')
+>>> with gzip.open(compressed, 'wb') as f:
+...     _ = f.write(pickle.dumps({'z': 1}, 2))
+>>> with ArchiveWriter(path) as writer:
+...     writer.dump('a', [1, 2, 'x'])
+...     writer.add('b', pickle.dumps(b'raw', 4))
+...     writer.add_file('c', compressed)
+>>> with Archive(path) as archive:
+...     print(sorted(archive), archive['a'])
+...     print(all(pickle.loads(archive.view(key)) == archive[key]
+...               for key in archive), archive.verify('b'))
+...     print(archive.get_many(['c', 'a', 'q'], return_exceptions=True))
+['a', 'b', 'c'] [1, 2, 'x']
+True True
+[{'z': 1}, [1, 2, 'x'], KeyError('q')]
+
+Keys are unique, and an archive is only readable once closed:
+
+>>> writer = ArchiveWriter(path)
+>>> writer.dump('a', bytes(100))
+>>> writer.dump('a', 1)
+Traceback (most recent call last):
+  ...
+ValueError: duplicate archive key 'a'
+>>> writer._file.flush()
+>>> Archive(path)
+... # doctest: +ELLIPSIS
+Traceback (most recent call last):
+  ...
+picklelite3.UnpicklingError: '...' is not an archive, or was not closed
+>>> writer.close()
+>>> with Archive(path) as archive:
+...     print(archive['a'] == bytes(100))
+True
+"""}
+
+def _test():
+    import doctest
+    return doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,588 @@
+'''Predicting the time and memory picklelite3.loads() takes for a pickle.
+
+CostModel.calibrate()
+   Fit a model by timing loads() on this host; save() and load() keep it.
+
+CostModel.predict(pickle)
+   The seconds and peak bytes loading pickle should take, from one scan
+   of it that unpickles nothing.  The scan is pure Python too, and takes
+   from a fifth as long as loads() to a little longer.
+
+CostModel.admission(pickle, *, queue_above=None, reject_above=None,
+                    max_memory=None)
+   Whether to admit, queue or reject a pickle by its predicted cost.
+'''
+
+import json
+import re
+import struct
+import tracemalloc
+from struct import pack
+from time import perf_counter_ns
+
+from picklelite3 import (
+    ADDITEMS, APPEND, APPENDS, BINBYTES, BINBYTES8, BINFLOAT, BINGET, BININT,
+    BININT1, BININT2, BINPERSID, BINPUT, BINSTRING, BINUNICODE, BINUNICODE8,
+    BUILD, DICT, DUP, EMPTY_DICT, EMPTY_LIST, EMPTY_SET, EMPTY_TUPLE, EXT1,
+    EXT2, EXT4, FLOAT, FRAME, FROZENSET, GET, GLOBAL, HIGHEST_PROTOCOL, INST,
+    INT, LIST, LONG, LONG1, LONG4, LONG_BINGET, LONG_BINPUT, LOWEST_PROTOCOL,
+    MARK, MEMOIZE, NEWFALSE, NEWOBJ, NEWOBJ_EX, NEWTRUE, NONE, OBJ, PERSID,
+    POP, POP_MARK, PROTO, PUT, REDUCE, SETITEM, SETITEMS, SHORT_BINBYTES,
+    SHORT_BINSTRING, SHORT_BINUNICODE, STACK_GLOBAL, STOP, STRING, TUPLE,
+    TUPLE1, TUPLE2, TUPLE3, UNICODE, UnpicklingError, dumps, loads,
+    opcode_table,
+)
+
+__all__ = ['CostModel']
+
+# What _cost_features() does for each effect opcode_table() names
+_STEP_PUSH, _STEP_MODIFY, _STEP_MARK, _STEP_GET, _STEP_POP, _STEP_POP_MARK, \
+    _STEP_STOP, _STEP_OTHER = range(8)
+_STEPS = {'push': _STEP_PUSH, 'modify': _STEP_MODIFY, 'mark': _STEP_MARK,
+          'get': _STEP_GET, 'pop': _STEP_POP, 'pop_mark': _STEP_POP_MARK,
+          'stop': _STEP_STOP}
+
+def _cost_table():
+    # code -> (argument kind, size/Struct/lines, step, items popped), the
+    # argument kinds being 0 fixed, 1 counted and 2 lines
+    table = [None] * 256
+    for code, entry in enumerate(opcode_table()):
+        if entry is not None:
+            _, (kind, arg), effect, pops, _ = entry
+            table[code] = (('fixed', 'counted', 'lines').index(kind), arg,
+                           _STEPS.get(effect, _STEP_OTHER), pops)
+    return table
+
+_COST_SCAN = _cost_table()
+_COST_OPCODE_NAMES = {code: entry[0]
+                      for code, entry in enumerate(opcode_table()) if entry}
+
+# Right after MARK, load_mark() decodes a run of one scalar opcode in one
+# go, then other scalars in a loop of its own rather than by dispatch.
+# CostModel charges them as two pseudo-opcodes: the run, sized by its
+# items, and each item of the loop, sized by its bytes.  Binary text is
+# charged as ASCII, and text that is not ASCII as well as one more
+# pseudo-opcode, sized by its bytes: decoding takes about as long
+# whatever the widths, but builds the str as wide as its widest
+# character, so text outside the BMP has one of its own.
+_COST_RUN, _COST_MARKED, _COST_WIDE, _COST_ASTRAL = 256, 257, 258, 259
+_COST_NAMES = {_COST_RUN: 'SCALAR_RUN', _COST_MARKED: 'MARKED_SCALARS',
+               _COST_WIDE: 'WIDE_TEXT', _COST_ASTRAL: 'ASTRAL_TEXT'}
+_COST_TEXT = frozenset(
+    (SHORT_BINUNICODE[0], BINUNICODE[0], BINUNICODE8[0]))
+_COST_ASTRAL_LEAD = re.compile(b'[\xf0-\xff]')
+# Opcode -> size of its records in a run, with the opcode
+_COST_RUNS = {code: 1 + entry[1][1]
+              for code, entry in enumerate(opcode_table())
+              if entry and entry[4] == 'run'}
+_COST_MARKED_ITEM = re.compile(b'|'.join(
+    re.escape(bytes((code,))) + b'.{%d}' % entry[1][1]
+    for code, entry in enumerate(opcode_table())
+    if entry and entry[4] is not None), re.S)
+_COST_MARKED_ITEMS = re.compile(b'(?:%s)*' % _COST_MARKED_ITEM.pattern, re.S)
+
+def _cost_run(data, pos):
+    # The end of the run load_scalar_run() decodes at pos, and its items
+    size = _COST_RUNS.get(data[pos])
+    if size is None:
+        return pos, 0
+    code = bytes((data[pos],))
+    limit = len(data) - (len(data) - pos) % size
+    items = 0
+    while True:
+        ops = bytes(data[pos:min(pos + size * 1024, limit):size])
+        run = len(ops) - len(ops.lstrip(code))
+        items += run
+        pos += run * size
+        if run < len(ops) or not ops:
+            return pos, items
+
+def _cost_features(data):
+    # Count, summed size and summed squared size of each opcode of the
+    # pickle at the start of data, and of the pseudo-opcodes.  The size
+    # of an opcode is the length of its argument, or for one that pops
+    # through a mark the number of items popped.
+    if not hasattr(data, 'find'):
+        data = bytes(data)
+    counts = [0] * 260
+    sizes = [0] * 260
+    squares = [0] * 260
+    table = _COST_SCAN
+    find = data.find
+    pos = depth = 0
+    marks = []
+    try:
+        while True:
+            code = data[pos]
+            entry = table[code]
+            if entry is None:
+                raise UnpicklingError("invalid load key, %r at offset %d" %
+                                      (bytes([code]), pos))
+            argkind, arg, action, npop = entry
+            if argkind == 0:
+                size = 0
+                end = pos + 1 + arg
+            elif argkind == 1:
+                size, = arg.unpack_from(data, pos + 1)
+                if size < 0:
+                    raise UnpicklingError("negative byte count at offset %d"
+                                          % pos)
+                end = pos + 1 + arg.size + size
+                if code in _COST_TEXT and not data[end - size:end].isascii():
+                    wide = _COST_WIDE
+                    if _COST_ASTRAL_LEAD.search(data, end - size, end):
+                        wide = _COST_ASTRAL
+                    counts[wide] += 1
+                    sizes[wide] += size
+                    squares[wide] += size * size
+            else:
+                end = find(b'\n', pos + 1)
+                if arg == 2 and end >= 0:
+                    end = find(b'\n', end + 1)
+                if end < 0:
+                    raise UnpicklingError("unterminated line at offset %d" %
+                                          pos)
+                size = end - pos - 1
+                end += 1
+            if action <= _STEP_MODIFY:
+                if npop < 0:
+                    mark = marks.pop() if marks else 0
+                    size = depth - mark
+                    depth = mark + (action == _STEP_PUSH)
+                else:
+                    depth += (action == _STEP_PUSH) - npop
+            elif action == _STEP_MARK:
+                marks.append(depth)
+                start, run = _cost_run(data, end)
+                if run:
+                    counts[_COST_RUN] += 1
+                    sizes[_COST_RUN] += run
+                    squares[_COST_RUN] += run * run
+                end = _COST_MARKED_ITEMS.match(data, start).end()
+                if end > start:
+                    items = len(_COST_MARKED_ITEM.findall(data, start, end))
+                    counts[_COST_MARKED] += items
+                    sizes[_COST_MARKED] += end - start
+                    run += items
+                depth += run
+            elif action == _STEP_GET:
+                depth += 1
+            elif action == _STEP_POP:
+                if marks and marks[-1] == depth:
+                    marks.pop()
+                else:
+                    depth -= 1
+            elif action == _STEP_POP_MARK:
+                depth = marks.pop() if marks else 0
+            counts[code] += 1
+            sizes[code] += size
+            squares[code] += size * size
+            if action == _STEP_STOP:
+                return counts, sizes, squares
+            pos = end
+    except (IndexError, struct.error):
+        raise EOFError("pickle ends before STOP") from None
+
+def _cost_units():
+    # (code, sizes, unit(size), text opcodes, lead): calibrate() times
+    # pickles repeating each unit after lead, calling it with each size.
+    # A unit nets one item on the stack; the other opcodes in it come
+    # earlier.  A unit may also be a function of its index, for items
+    # that must differ.  (code, other) instead charges code what other
+    # costs.
+    def unit(op, make, sizes=None, text=False, lead=EMPTY_TUPLE):
+        if sizes is None:
+            return (op[0], None, lambda n: make, text, lead)
+        return (op[0], sizes, make, text, lead)
+    def counted(op, fmt):
+        return lambda n: op + pack(fmt, n) + b'a' * n
+    def short(op):
+        return lambda n: op + bytes((n,)) + b'a' * n
+    def mixed(text):
+        # UTF-8 of mixed widths is the slowest to decode
+        text = text.encode()
+        return lambda n: BINUNICODE + pack('<I', n) + text * (n // len(text))
+    def binint(i):
+        return BININT + pack('<i', 100000 + i)
+    def marked(op, item, before=b''):
+        return lambda n: before + MARK + item * n + op
+    pair = BININT1 + b'\x01' + NONE
+    # Strings and bytes of one character are cached
+    small, large, items = (2, 255), (2, 1 << 20), (1, 64)
+    memo = NONE + MEMOIZE
+    return [
+        unit(NONE, NONE),
+        unit(NEWTRUE, NEWTRUE),
+        unit(NEWFALSE, NEWFALSE),
+        unit(BININT1, BININT1 + b'\x05'),
+        unit(BININT2, lambda i: BININT2 + pack('<H', 1000 + i % 60000)),
+        unit(BININT, binint),
+        unit(BINFLOAT, lambda i: BINFLOAT + pack('>d', i + 0.5)),
+        (_COST_MARKED, (1, 9), lambda n: (
+            NONE if n == 1 else lambda i: BINFLOAT + pack('>d', i + 0.5)),
+         False, NONE),
+        unit(INT, lambda n: INT + b'7' * n + b'\n', (1, 18)),
+        unit(LONG1, lambda n: LONG1 + bytes((n,)) + b'\x07' * n, small),
+        unit(LONG4, lambda n: LONG4 + pack('<i', n) + b'\x07' * n,
+             (1, 1 << 14)),
+        unit(SHORT_BINUNICODE, short(SHORT_BINUNICODE), small),
+        unit(BINUNICODE, counted(BINUNICODE, '<I'), large),
+        unit(BINUNICODE8, counted(BINUNICODE8, '<Q'), large),
+        (_COST_WIDE, (12, 12 << 16), mixed('a\u00e9\u20ac'), False,
+         EMPTY_TUPLE),
+        (_COST_ASTRAL, (10, 10 << 16), mixed('a\u00e9\u20ac\U0001f600'),
+         False, EMPTY_TUPLE),
+        unit(SHORT_BINBYTES, short(SHORT_BINBYTES), small),
+        unit(BINBYTES, counted(BINBYTES, '<I'), large),
+        unit(BINBYTES8, counted(BINBYTES8, '<Q'), large),
+        unit(SHORT_BINSTRING, short(SHORT_BINSTRING), small),
+        unit(BINSTRING, counted(BINSTRING, '<i'), large),
+        unit(LONG, lambda n: LONG + b'7' * n + b'\n', (1, 2000, 4000), True),
+        unit(FLOAT, lambda n: FLOAT + b'1.' + b'5' * (n - 2) + b'\n',
+             (3, 24), True),
+        unit(STRING, lambda n: STRING + b"'" + b'a' * (n - 2) + b"'\n",
+             (2, 1 << 18), True),
+        unit(UNICODE, lambda n: UNICODE + b'a' * n + b'\n', (1, 1 << 18),
+             True),
+        unit(EMPTY_TUPLE, EMPTY_TUPLE),
+        unit(EMPTY_LIST, EMPTY_LIST),
+        unit(EMPTY_DICT, EMPTY_DICT),
+        unit(EMPTY_SET, EMPTY_SET),
+        unit(TUPLE1, NONE + TUPLE1),
+        unit(TUPLE2, NONE * 2 + TUPLE2),
+        unit(TUPLE3, NONE * 3 + TUPLE3),
+        unit(APPEND, EMPTY_LIST + NONE + APPEND),
+        unit(SETITEM, EMPTY_DICT + pair + SETITEM),
+        unit(POP, NONE * 2 + POP),
+        (POP_MARK[0], POP[0]),
+        unit(MARK, EMPTY_TUPLE + MARK + POP_MARK),
+        unit(DUP, NONE + DUP + POP),
+        unit(TUPLE, marked(TUPLE, NONE), items),
+        unit(LIST, marked(LIST, NONE), items),
+        unit(APPENDS, marked(APPENDS, NONE, EMPTY_LIST), items),
+        (_COST_RUN, (1, 1 << 10), lambda n: lambda i: (
+            EMPTY_LIST + MARK + b''.join(binint(i * n + j)
+                                         for j in range(n)) + APPENDS),
+         False, EMPTY_TUPLE),
+        unit(FROZENSET, marked(FROZENSET, EMPTY_TUPLE), items),
+        unit(ADDITEMS, marked(ADDITEMS, EMPTY_TUPLE, EMPTY_SET), items),
+        unit(DICT, lambda n: MARK + pair * (n // 2) + DICT, (2, 64)),
+        unit(SETITEMS, lambda n: EMPTY_DICT + MARK + pair * (n // 2) +
+             SETITEMS, (2, 64)),
+        unit(MEMOIZE, memo),
+        unit(BINPUT, lambda i: NONE + BINPUT + bytes((i & 0xff,))),
+        unit(LONG_BINPUT, lambda i: NONE + LONG_BINPUT + pack('<I', i)),
+        unit(PUT, lambda i: NONE + PUT + b'%d\n' % i, text=True),
+        unit(BINGET, BINGET + b'\x00', lead=memo),
+        unit(LONG_BINGET, LONG_BINGET + b'\0\0\0\0', lead=memo),
+        unit(GET, lambda n: GET + b'0' * n + b'\n', (1, 6), True, memo),
+        unit(GLOBAL, GLOBAL + b'builtins\nlen\n'),
+        unit(STACK_GLOBAL, SHORT_BINUNICODE + b'\x08builtins' +
+             SHORT_BINUNICODE + b'\x03len' + STACK_GLOBAL),
+        unit(REDUCE, GLOBAL + b'builtins\ntuple\n' + EMPTY_TUPLE + TUPLE1 +
+             REDUCE),
+        unit(NEWOBJ, GLOBAL + b'builtins\nobject\n' + EMPTY_TUPLE + NEWOBJ),
+        unit(NEWOBJ_EX, GLOBAL + b'builtins\nobject\n' + EMPTY_TUPLE +
+             EMPTY_DICT + NEWOBJ_EX),
+        unit(OBJ, MARK + GLOBAL + b'builtins\nobject\n' + OBJ),
+        unit(BUILD, GLOBAL + b'types\nSimpleNamespace\n' + EMPTY_TUPLE +
+             NEWOBJ + EMPTY_DICT + SHORT_BINUNICODE + b'\x01a' + NONE +
+             SETITEM + BUILD),
+        unit(FRAME, FRAME + pack('<Q', 1) + NONE),
+        (INST[0], OBJ[0]),
+        (EXT1[0], GLOBAL[0]),
+        (EXT2[0], GLOBAL[0]),
+        (EXT4[0], GLOBAL[0]),
+        (PERSID[0], REDUCE[0]),
+        (BINPERSID[0], REDUCE[0]),
+    ]
+
+def _cost_payloads():
+    # Pickles of the shapes data commonly takes, which calibrate() fits
+    # the margins of CostModel to.  Bytes below protocol 3 are left out:
+    # they are rebuilt by a call, which REDUCE is not charged by size.
+    n = 10000
+    shapes = [
+        [i % 3 == 0 for i in range(n)],
+        [i / 7 for i in range(n)],
+        [i * 7919 for i in range(n)],
+        [str(i) for i in range(n)],
+        ['caf\u00e9 %d \u20ac' % i for i in range(n)],
+        ['%d \U0001f600' % i for i in range(n)],
+        [(i, str(i)) for i in range(n)],
+        [[i, [i, [i / 2, None]]] for i in range(n // 4)],
+        [{'id': i, 'name': 'n%d' % i, 'score': i / 3} for i in range(n // 4)],
+    ]
+    blobs = [bytes(range(256)) * 4 for _ in range(n // 100)]
+    return [dumps(shape, protocol)
+            for protocol in range(LOWEST_PROTOCOL, HIGHEST_PROTOCOL + 1)
+            for shape in (shapes + [blobs] if protocol >= 3 else shapes)]
+
+def _cost_pickle(unit, count, lead):
+    # A protocol 4 pickle of a list of lead's items and count units
+    if callable(unit):
+        units = b''.join(map(unit, range(count)))
+    else:
+        units = unit * count
+    return PROTO + b'\x04' + EMPTY_LIST + MARK + lead + units + APPENDS + STOP
+
+def _cost_fit(sizes, costs):
+    # (a, b, c) with a + b*size + c*size**2 through the points, as many
+    # terms as points, none negative
+    if len(sizes) == 1:
+        return (max(costs[0], 0.0), 0.0, 0.0)
+    if len(sizes) == 2:
+        (x0, x1), (y0, y1) = sizes, costs
+        b = max((y1 - y0) / (x1 - x0), 0.0)
+        return (max(y0 - b * x0, 0.0), b, 0.0)
+    (x0, x1, x2), (y0, y1, y2) = sizes, costs
+    d01 = (y1 - y0) / (x1 - x0)
+    c = max(((y2 - y1) / (x2 - x1) - d01) / (x2 - x0), 0.0)
+    b = max(d01 - c * (x0 + x1), 0.0)
+    return (max(y0 - b * x0 - c * x0 * x0, 0.0), b, c)
+
+
+class CostModel:
+    """Predicts the time and peak memory of loads() from one scan.
+
+    For each opcode the model charges seconds and bytes of a + b*size +
+    c*size**2, where size is the length of the argument, or for opcodes
+    that pop through a mark the number of items popped, on top of a
+    cost per call.  Text that is not ASCII is charged as UTF-8 of mixed
+    widths, the slowest to decode.  Opcodes that call code, like REDUCE,
+    are charged what the calls calibrate() makes cost, which says
+    nothing of others.  The sums are multiplied by scale, the seconds
+    and memory margins calibrate() fits so that no pickle of common
+    shapes is predicted to cost less than it does.
+
+    Predictions hold on the host that calibrated the model; save() and
+    load() keep one for ingress to share.
+    """
+
+    def __init__(self, seconds=None, memory=None, base=(0.0, 0.0),
+                 scale=(1.0, 1.0)):
+        # code -> (a, b, c)
+        self.seconds = dict(seconds or {})
+        self.memory = dict(memory or {})
+        self.base = tuple(base)
+        self.scale = tuple(scale)
+
+    @classmethod
+    def calibrate(cls, *, repeat=5, duration=0.002):
+        """Return a model fitted by timing loads() on this host.
+
+        Each measurement is the fastest of repeat loads of a pickle
+        repeating one unit for about duration seconds; the peak memory
+        is taken once with tracemalloc.  scale is then fitted to the
+        worst prediction for pickles of common shapes, lists of bools,
+        numbers, text, tuples, nested lists, dicts and bytes.  It takes
+        a few seconds.
+        """
+        model = cls()
+        def measure(data, text):
+            # Seconds and peak bytes of loads(data)
+            best = None
+            for _ in range(repeat):
+                start = perf_counter_ns()
+                loads(data, text_opcodes=text)
+                elapsed = perf_counter_ns() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            return best / 1e9, traced(data, text)
+        def traced(data, text):
+            # Peak bytes of loads(data)
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            try:
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                else:
+                    # Before Python 3.9 only a restart resets the peak
+                    tracemalloc.stop()
+                    tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                loads(data, text_opcodes=text)
+                peak = tracemalloc.get_traced_memory()[1] - before
+            finally:
+                if not tracing:
+                    tracemalloc.stop()
+            return peak
+        model.base = measure(_cost_pickle(b'', 0, b''), False)
+        for entry in _cost_units():
+            if len(entry) == 2:
+                code, other = entry
+                model.seconds[code] = model.seconds[other]
+                model.memory[code] = model.memory[other]
+                continue
+            code, sizes, make, text, lead = entry
+            seconds, memory = [], []
+            for size in sizes or (0,):
+                unit = make(size)
+                count = 1
+                while True:
+                    data = _cost_pickle(unit, count, lead)
+                    start = perf_counter_ns()
+                    loads(data, text_opcodes=text)
+                    if (perf_counter_ns() - start >= duration * 1e9 or
+                            len(data) >= 1 << 22):
+                        break
+                    count *= 2
+                elapsed, peak = measure(data, text)
+                # What is left once the opcodes calibrated so far are paid
+                known, known_peak = model.predict(data)
+                seconds.append((elapsed - known) / count)
+                # Freelists hand out the first few thousand small objects
+                # untraced, so memory is at least what doubling the units
+                # adds; a large one is also charged the buffers it needs
+                # while it is built.
+                data = _cost_pickle(unit, 2 * count, lead)
+                doubled = (traced(data, text) - peak -
+                           model.predict(data)[1] + known_peak)
+                memory.append(max(peak - known_peak, doubled) / count)
+            model.seconds[code] = _cost_fit(sizes or (0,), seconds)
+            model.memory[code] = _cost_fit(sizes or (0,), memory)
+        scale = []
+        for data in _cost_payloads():
+            elapsed, peak = measure(data, False)
+            seconds, memory = model.predict(data)
+            scale.append((elapsed / seconds, peak / memory))
+        model.scale = tuple(map(max, zip(*scale)))
+        return model
+
+    def predict(self, data):
+        """Return the seconds and peak bytes loads(data) should take.
+
+        The scan of data tracks the stack as loads() would, to size the
+        opcodes that pop through a mark, and costs a good part of the
+        loads() it predicts: on the pickles calibrate() fits scale to,
+        it takes 0.2 of the time of loads() for lists of numbers, 0.5
+        for lists of dicts and up to 1.2 for lists of text that is not
+        ASCII.
+        """
+        counts, sizes, squares = _cost_features(data)
+        seconds, memory = self.base
+        for code, count in enumerate(counts):
+            if count:
+                a, b, c = self.seconds.get(code, (0.0, 0.0, 0.0))
+                seconds += a * count + b * sizes[code] + c * squares[code]
+                a, b, c = self.memory.get(code, (0.0, 0.0, 0.0))
+                memory += a * count + b * sizes[code] + c * squares[code]
+        return seconds * self.scale[0], memory * self.scale[1]
+
+    def admission(self, data, *, queue_above=None, reject_above=None,
+                  max_memory=None):
+        """Return 'admit', 'queue' or 'reject' for loads(data).
+
+        data is rejected if predicted to take over reject_above seconds
+        or max_memory bytes, or if it is no pickle, and queued if over
+        queue_above seconds.  Limits that are None don't apply.  It
+        costs one predict(), so it pays where loads() is guarded from
+        pickles far costlier than the usual, not to shave the usual.
+        """
+        try:
+            seconds, memory = self.predict(data)
+        except (UnpicklingError, EOFError):
+            return 'reject'
+        if (reject_above is not None and seconds > reject_above or
+                max_memory is not None and memory > max_memory):
+            return 'reject'
+        if queue_above is not None and seconds > queue_above:
+            return 'queue'
+        return 'admit'
+
+    def as_dict(self):
+        """Return the model as a dict of plain values."""
+        def named(costs):
+            return {_COST_NAMES.get(code) or
+                    _COST_OPCODE_NAMES.get(code, "0x%02x" % code): list(cost)
+                    for code, cost in sorted(costs.items())}
+        return {"base": list(self.base), "scale": list(self.scale),
+                "seconds": named(self.seconds), "memory": named(self.memory)}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Return the model as_dict() returned d for."""
+        codes = {name: code for code, name in
+                 [*_COST_OPCODE_NAMES.items(), *_COST_NAMES.items()]}
+        def coded(costs):
+            return {codes[name] if name in codes else int(name, 16):
+                    tuple(cost) for name, cost in costs.items()}
+        return cls(coded(d["seconds"]), coded(d["memory"]), d["base"],
+                   d.get("scale", (1.0, 1.0)))
+
+    def save(self, path):
+        """Write the model to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """Return the model save() wrote to path."""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+# Doctest
+__test__ = {"predict_and_admit": """
+A model charges each opcode, or run of scalars, what it is given, and
+survives a save() and load():
+
+>>> import os, pickle, tempfile
+>>> model = CostModel.from_dict({
+...     'base': [1e-6, 100.0],
+...     'seconds': {'SCALAR_RUN': [0, 1e-8, 0], 'APPENDS': [1e-7, 0, 0]},
+...     'memory': {'SCALAR_RUN': [0, 32.0, 0]}})
+>>> data = pickle.dumps(list(range(200)), 4)
+>>> seconds, memory = model.predict(data)
+>>> round(seconds * 1e9), memory
+(3100, 6500.0)
+>>> path = os.path.join(tempfile.mkdtemp(), 'model.json')
+>>> model.save(path)
+>>> CostModel.load(path).predict(data) == (seconds, memory)
+True
+
+A pickle admitted loads as pickle loads it; one predicted to cost too
+much, or that is no whole pickle, is turned away:
+
+>>> model.admission(data, queue_above=1e-3, max_memory=1 << 20)
+'admit'
+>>> loads(data) == pickle.loads(data)
+True
+>>> model.admission(data, queue_above=1e-6)
+'queue'
+>>> model.admission(data, max_memory=1000)
+'reject'
+>>> model.admission(data[:-5]), model.admission(b'no pickle')
+('reject', 'reject')
+>>> model.predict(data[:-5])
+Traceback (most recent call last):
+  ...
+EOFError: pickle ends before STOP
+"""}
+
+def _test():
+    import doctest
+    return doctest.testmod()
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(
+        description='predict the cost of loading pickle files')
+    parser.add_argument(
+        'model', help='the cost model, calibrated on this host and saved '
+                      'there first if missing')
+    parser.add_argument(
+        'pickle_file', type=argparse.FileType('br'),
+        nargs='+', help='the pickle file')
+    args = parser.parse_args()
+    if os.path.exists(args.model):
+        model = CostModel.load(args.model)
+    else:
+        model = CostModel.calibrate()
+        model.save(args.model)
+    for f in args.pickle_file:
+        seconds, memory = model.predict(f.read())
+        print(json.dumps({"file": f.name, "seconds": seconds,
+                          "bytes": round(memory)}))
@@ -0,0 +1,389 @@
+"""Generate the unpickler handlers picklelite2 and picklelite3 share.
+
+picklelite2 and picklelite3 used to carry a hand written copy each of
+most opcode handlers, keyed by a 1-character str on Python 2 and by an
+int on Python 3, and differing only in how a byte is read, which type
+text is and how the memo is keyed.  OPCODES holds those handlers once,
+with placeholders for the differences, and install() compiles them for
+one interpreter into an Unpickler class: each becomes a method and the
+class's dispatch entry for its opcode, so a change made here reaches
+both engines.
+
+Handlers an engine specialises stay hand written in it: picklelite3's
+superinstructions (BININT1, SHORT_BINUNICODE, BINGET and MARK), and the
+opcodes the two engines implement differently, like PROTO, INT, POP,
+OBJ, GLOBAL and BUILD.
+
+Functions:
+
+    generate(py3) -> source
+    install(cls, namespace, py3)
+
+Run as a script to print the generated source, e.g. to review it:
+
+    python pickleengine.py [--py2] [-o handlers.py]
+"""
+
+from __future__ import print_function
+
+import linecache
+import string
+import sys
+
+__all__ = ["OPCODES", "generate", "install"]
+
+
+# Each entry is (opcode, method, protocol, body).  opcode names the
+# opcode constant of the engine module, method the Unpickler method the
+# handler becomes, and protocol the first protocol using the opcode;
+# engines that read older protocols only don't get it.  body is the
+# method body.  It runs with the globals of the engine module, so it may
+# use its names, like unpack, maxsize, decode_long and UnpicklingError,
+# and these placeholders, which are filled in per interpreter:
+#
+#   $byte           read one byte as an int
+#   $text           the text type
+#   $utf8           arguments to decode UTF-8 text
+#   $slot           wrap a memo index into a memo key
+#   $decode_string  decode the Python 2 8-bit string held in data
+
+OPCODES = [
+    ('BINPERSID', 'load_binpersid', 1, """
+pid = self.stack.pop()
+self.append(self.persistent_load(pid))
+"""),
+    ('NONE', 'load_none', 0, """
+self.append(None)
+"""),
+    ('NEWFALSE', 'load_false', 2, """
+self.append(False)
+"""),
+    ('NEWTRUE', 'load_true', 2, """
+self.append(True)
+"""),
+    ('BININT', 'load_binint', 1, """
+self.append(unpack('<i', self.read(4))[0])
+"""),
+    ('BININT2', 'load_binint2', 1, """
+self.append(unpack('<H', self.read(2))[0])
+"""),
+    ('LONG1', 'load_long1', 2, """
+n = $byte
+data = self.read(n)
+self.append(decode_long(data))
+"""),
+    ('LONG4', 'load_long4', 2, """
+n, = unpack('<i', self.read(4))
+if n < 0:
+    # Corrupt or hostile pickle -- we never write one like this
+    raise UnpicklingError("LONG pickle has negative byte count")
+data = self.read(n)
+self.append(decode_long(data))
+"""),
+    ('BINFLOAT', 'load_binfloat', 1, """
+self.append(unpack('>d', self.read(8))[0])
+"""),
+    ('BINSTRING', 'load_binstring', 1, """
+# Deprecated BINSTRING uses signed 32-bit length
+len, = unpack('<i', self.read(4))
+if len < 0:
+    raise UnpicklingError("BINSTRING pickle has negative byte count")
+data = self.read(len)
+self.append($decode_string)
+"""),
+    ('BINBYTES', 'load_binbytes', 3, """
+len, = unpack('<I', self.read(4))
+if len > maxsize:
+    raise UnpicklingError("BINBYTES exceeds system's maximum size "
+                          "of %d bytes" % maxsize)
+self.append(self.read(len))
+"""),
+    ('BINUNICODE', 'load_binunicode', 1, """
+len, = unpack('<I', self.read(4))
+if len > maxsize:
+    raise UnpicklingError("BINUNICODE exceeds system's maximum size "
+                          "of %d bytes" % maxsize)
+self.append($text(self.read(len), $utf8))
+"""),
+    ('BINUNICODE8', 'load_binunicode8', 4, """
+len, = unpack('<Q', self.read(8))
+if len > maxsize:
+    raise UnpicklingError("BINUNICODE8 exceeds system's maximum size "
+                          "of %d bytes" % maxsize)
+self.append($text(self.read(len), $utf8))
+"""),
+    ('BINBYTES8', 'load_binbytes8', 4, """
+len, = unpack('<Q', self.read(8))
+if len > maxsize:
+    raise UnpicklingError("BINBYTES8 exceeds system's maximum size "
+                          "of %d bytes" % maxsize)
+self.append(self.read(len))
+"""),
+    ('SHORT_BINSTRING', 'load_short_binstring', 1, """
+len = $byte
+data = self.read(len)
+self.append($decode_string)
+"""),
+    ('SHORT_BINBYTES', 'load_short_binbytes', 3, """
+len = $byte
+self.append(self.read(len))
+"""),
+    ('TUPLE', 'load_tuple', 0, """
+items = self.pop_mark()
+self.append(tuple(items))
+"""),
+    ('EMPTY_TUPLE', 'load_empty_tuple', 1, """
+self.append(())
+"""),
+    ('TUPLE1', 'load_tuple1', 2, """
+self.stack[-1] = (self.stack[-1],)
+"""),
+    ('TUPLE2', 'load_tuple2', 2, """
+self.stack[-2:] = [(self.stack[-2], self.stack[-1])]
+"""),
+    ('TUPLE3', 'load_tuple3', 2, """
+self.stack[-3:] = [(self.stack[-3], self.stack[-2], self.stack[-1])]
+"""),
+    ('EMPTY_LIST', 'load_empty_list', 1, """
+self.append([])
+"""),
+    ('EMPTY_DICT', 'load_empty_dictionary', 1, """
+self.append({})
+"""),
+    ('EMPTY_SET', 'load_empty_set', 4, """
+self.append(set())
+"""),
+    ('FROZENSET', 'load_frozenset', 4, """
+items = self.pop_mark()
+self.append(frozenset(items))
+"""),
+    ('LIST', 'load_list', 0, """
+items = self.pop_mark()
+self.append(items)
+"""),
+    ('DICT', 'load_dict', 0, """
+items = self.pop_mark()
+d = {items[i]: items[i+1]
+     for i in range(0, len(items), 2)}
+self.append(d)
+"""),
+    ('NEWOBJ', 'load_newobj', 2, """
+args = self.stack.pop()
+cls = self.stack.pop()
+obj = cls.__new__(cls, *args)
+self.append(obj)
+"""),
+    ('NEWOBJ_EX', 'load_newobj_ex', 4, """
+kwargs = self.stack.pop()
+args = self.stack.pop()
+cls = self.stack.pop()
+obj = cls.__new__(cls, *args, **kwargs)
+self.append(obj)
+"""),
+    ('STACK_GLOBAL', 'load_stack_global', 4, """
+name = self.stack.pop()
+module = self.stack.pop()
+if type(name) is not $text or type(module) is not $text:
+    raise UnpicklingError("STACK_GLOBAL requires str")
+self.append(self.lookup_global(module, name))
+"""),
+    ('EXT1', 'load_ext1', 2, """
+code = $byte
+self.get_extension(code)
+"""),
+    ('EXT2', 'load_ext2', 2, """
+code, = unpack('<H', self.read(2))
+self.get_extension(code)
+"""),
+    ('EXT4', 'load_ext4', 2, """
+code, = unpack('<i', self.read(4))
+self.get_extension(code)
+"""),
+    ('REDUCE', 'load_reduce', 0, """
+stack = self.stack
+args = stack.pop()
+func = stack[-1]
+stack[-1] = func(*args)
+"""),
+    ('POP_MARK', 'load_pop_mark', 1, """
+self.pop_mark()
+"""),
+    ('DUP', 'load_dup', 0, """
+self.append(self.stack[-1])
+"""),
+    ('LONG_BINGET', 'load_long_binget', 1, """
+i, = unpack('<I', self.read(4))
+self.append(self.memo[$slot(i)])
+"""),
+    ('BINPUT', 'load_binput', 1, """
+i = $byte
+if i < 0:
+    raise ValueError("negative BINPUT argument")
+self.memo[$slot(i)] = self.stack[-1]
+"""),
+    ('LONG_BINPUT', 'load_long_binput', 1, """
+i, = unpack('<I', self.read(4))
+if i > maxsize:
+    raise ValueError("negative LONG_BINPUT argument")
+self.memo[$slot(i)] = self.stack[-1]
+"""),
+    ('MEMOIZE', 'load_memoize', 4, """
+memo = self.memo
+memo[len(memo)] = self.stack[-1]
+"""),
+    ('APPEND', 'load_append', 0, """
+stack = self.stack
+value = stack.pop()
+list = stack[-1]
+list.append(value)
+"""),
+    ('APPENDS', 'load_appends', 1, """
+items = self.pop_mark()
+list_obj = self.stack[-1]
+if isinstance(list_obj, list):
+    list_obj.extend(items)
+else:
+    append = list_obj.append
+    for item in items:
+        append(item)
+"""),
+    ('SETITEM', 'load_setitem', 0, """
+stack = self.stack
+value = stack.pop()
+key = stack.pop()
+dict = stack[-1]
+dict[key] = value
+"""),
+    ('SETITEMS', 'load_setitems', 1, """
+items = self.pop_mark()
+dict = self.stack[-1]
+for i in range(0, len(items), 2):
+    dict[items[i]] = items[i + 1]
+"""),
+    ('ADDITEMS', 'load_additems', 4, """
+items = self.pop_mark()
+set_obj = self.stack[-1]
+if isinstance(set_obj, set):
+    set_obj.update(items)
+else:
+    add = set_obj.add
+    for item in items:
+        add(item)
+"""),
+]
+
+
+def _substitutions(py3):
+    if py3:
+        return {
+            'byte': 'self.read(1)[0]',
+            'text': 'str',
+            'utf8': "'utf-8', 'surrogatepass'",
+            'slot': '',
+            'decode_string': 'self._decode_string(data)',
+        }
+    # picklelite2 keys its memo by the repr of the index, as pickle did
+    return {
+        'byte': 'ord(self.read(1))',
+        'text': 'unicode',
+        'utf8': "'utf-8'",
+        'slot': 'repr',
+        'decode_string': 'data',
+    }
+
+
+def _protocol(py3):
+    # The highest protocol the engine for py3 reads
+    return 4 if py3 else 2
+
+
+def generate(py3=sys.version_info[0] >= 3):
+    """Return the source of the handlers for Python 3 or Python 2."""
+    subs = _substitutions(py3)
+    parts = ["# Generated by pickleengine.py for Python %d; do not edit.\n"
+             % (3 if py3 else 2)]
+    for opcode, method, protocol, body in OPCODES:
+        if protocol > _protocol(py3):
+            continue
+        body = string.Template(body).substitute(subs)
+        parts.append('\ndef %s(self):\n' % method)
+        parts.extend('    ' + line + '\n' if line else '\n'
+                     for line in body.strip('\n').split('\n'))
+    return ''.join(parts)
+
+
+def install(cls, namespace, py3=sys.version_info[0] >= 3):
+    """Compile the handlers into cls, an Unpickler class.
+
+    namespace is the globals of the module defining cls, which the
+    handlers run with and which holds the opcode constants.  Each
+    handler is set as a method of cls and as the entry of cls.dispatch
+    for its opcode.
+    """
+    source = generate(py3)
+    filename = '<pickleengine %s>' % namespace['__name__']
+    # Let tracebacks show the generated lines
+    linecache.cache[filename] = (len(source), None,
+                                 source.splitlines(True), filename)
+    handlers = {}
+    exec(compile(source, filename, 'exec'), namespace, handlers)
+    for opcode, method, protocol, body in OPCODES:
+        if protocol > _protocol(py3):
+            continue
+        handler = handlers[method]
+        handler.__qualname__ = '%s.%s' % (cls.__name__, method)
+        setattr(cls, method, handler)
+        key = namespace[opcode]
+        cls.dispatch[key[0] if py3 else key] = handler
+
+
+
+# Doctest
+__test__ = {"installed_handlers": """
+The handlers installed into picklelite3 read what pickle writes:
+
+>>> import pickle, picklelite3, traceback
+>>> Unpickler = picklelite3.Unpickler
+>>> Unpickler.dispatch[pickle.BINUNICODE[0]] is Unpickler.load_binunicode
+True
+>>> obj = [None, True, (1, 2), {'a': b'b'}, {1.5}, 2 ** 70]
+>>> data = pickle.dumps(obj, 4)
+>>> picklelite3.loads(data) == pickle.loads(data) == obj
+True
+
+Their errors are raised, and shown in tracebacks, from the lines
+generated for them:
+
+>>> try:
+...     picklelite3.loads(b'\\x80\\x02\\x8b\\xff\\xff\\xff\\xff.')
+... except picklelite3.UnpicklingError as e:
+...     frame = traceback.extract_tb(e.__traceback__)[-1]
+...     print(e)
+...     print(frame.filename, frame.name)
+...     print(frame.line)
+LONG pickle has negative byte count
+<pickleengine picklelite3> load_long4
+raise UnpicklingError("LONG pickle has negative byte count")
+
+The Python 2 handlers compile too:
+
+>>> code = compile(generate(py3=False), '<py2>', 'exec')
+"""}
+
+def _test():
+    import doctest
+    return doctest.testmod()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='print the generated unpickler handlers')
+    parser.add_argument(
+        '--py2', action='store_true',
+        help='generate for Python 2 instead of the running interpreter')
+    parser.add_argument(
+        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help='where to write the source (default: stdout)')
+    args = parser.parse_args()
+    args.output.write(generate(py3=not args.py2))
@@ -0,0 +1,338 @@
+'''Crash-safe journals of records pickled with picklelite3.
+
+Journal(path, *, protocol=None, group_size=1, fsync_every=1, **kwargs)
+   An append-only file of pickled records, recovered up to the last
+   whole record when opened after a crash, and replayed by records().
+'''
+
+import io
+import mmap
+import os
+import struct
+import threading
+import zlib
+from struct import pack
+
+from picklelite3 import STOP, Pickler, UnpicklingError, loads
+
+__all__ = ['Journal']
+
+# A journal is _JOURNAL_MAGIC, a checkpoint, then records: the length of
+# a pickle as _JOURNAL_HEADER, the pickle, then a CRC-32 of both as
+# _JOURNAL_TRAILER.  The checkpoint is the offset of a record boundary
+# the file had been fsynced up to, with a CRC-32 of its own, rewritten
+# after each fsync.  Recovery walks the records forwards from it, so it
+# only checks those written since, and it can't mistake bytes inside a
+# pickle for a record since it follows the lengths from a boundary.
+
+_JOURNAL_MAGIC = b'PLJ2'
+_JOURNAL_CHECKPOINT = struct.Struct('<QI')  # offset fsynced up to, CRC-32
+_JOURNAL_START = len(_JOURNAL_MAGIC) + _JOURNAL_CHECKPOINT.size
+_JOURNAL_HEADER = struct.Struct('<I')       # pickle length
+_JOURNAL_TRAILER = struct.Struct('<I')      # CRC-32 of header and pickle
+
+def _journal_checkpoint(offset):
+    return _JOURNAL_CHECKPOINT.pack(offset, zlib.crc32(pack('<Q', offset)))
+
+def _journal_checkpointed(data, size):
+    # The offset the checkpoint in data names, or the first record's if
+    # the checkpoint is torn or past the end
+    offset, crc = _JOURNAL_CHECKPOINT.unpack_from(data, len(_JOURNAL_MAGIC))
+    if (crc != zlib.crc32(pack('<Q', offset)) or
+            not _JOURNAL_START <= offset <= size):
+        return _JOURNAL_START
+    return offset
+
+def _journal_record_at(data, pos, end):
+    # The end of the whole record at pos, or 0 if there is none before end
+    if pos + _JOURNAL_HEADER.size + _JOURNAL_TRAILER.size >= end:
+        return 0
+    n, = _JOURNAL_HEADER.unpack_from(data, pos)
+    stop = pos + _JOURNAL_HEADER.size + n
+    record_end = stop + _JOURNAL_TRAILER.size
+    if not n or record_end > end:
+        return 0
+    crc, = _JOURNAL_TRAILER.unpack_from(data, stop)
+    if data[stop - 1] != STOP[0] or zlib.crc32(data[pos:stop]) != crc:
+        return 0
+    return record_end
+
+def _fsync_dir(path):
+    # Make the creation or renaming of the file at path durable, where
+    # directories can be opened
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Journal:
+    """An append-only file of pickled records that survives crashes.
+
+    append() pickles a record into the current group.  Every group_size
+    records the group is written with one write, and every fsync_every
+    writes the file is fsynced; 0 leaves that to commit(), which writes
+    and fsyncs whatever is pending.  Opening an existing journal recovers
+    it: a tail torn by a crash is cut off after the last whole record,
+    and the number of bytes dropped kept in recovered.  Only records
+    written since the last fsync are checked, so recovery takes time in
+    proportion to them, not to the journal.
+
+    records() replays the journal; kwargs are passed to the Unpickler.
+    compact() replaces it with a snapshot.  Journal methods may be
+    called from several threads.
+    """
+
+    def __init__(self, path, *, protocol=None, group_size=1, fsync_every=1,
+                 **kwargs):
+        self.path = os.fspath(path)
+        self.protocol = protocol
+        self.group_size = group_size
+        self.fsync_every = fsync_every
+        self.kwargs = kwargs
+        self._pickler = Pickler(io.BytesIO(), protocol)
+        self._buffer = bytearray()
+        self._group = bytearray()
+        self._grouped = 0
+        self._writes = 0
+        self._lock = threading.RLock()
+        try:
+            self._file = open(self.path, 'x+b')
+        except FileExistsError:
+            self._file = open(self.path, 'r+b')
+            try:
+                self.recovered = self._recover()
+            except BaseException:
+                self._file.close()
+                raise
+        else:
+            self._file.write(_JOURNAL_MAGIC +
+                             _journal_checkpoint(_JOURNAL_START))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            _fsync_dir(self.path)
+            self._end = self._synced = _JOURNAL_START
+            self.recovered = 0
+
+    def _recover(self):
+        # Cut off a torn tail and return how many bytes were dropped
+        fileno = self._file.fileno()
+        size = os.fstat(fileno).st_size
+        if size < _JOURNAL_START:
+            # Torn while being created
+            magic = self._file.read(len(_JOURNAL_MAGIC))
+            if not _JOURNAL_MAGIC.startswith(magic):
+                raise UnpicklingError("%r is not a journal" % self.path)
+            self._file.seek(0)
+            self._file.write(_JOURNAL_MAGIC +
+                             _journal_checkpoint(_JOURNAL_START))
+            self._file.flush()
+            os.fsync(fileno)
+            self._end = self._synced = _JOURNAL_START
+            return 0
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(_JOURNAL_MAGIC)] != _JOURNAL_MAGIC:
+                raise UnpicklingError("%r is not a journal" % self.path)
+            end = _journal_checkpointed(data, size)
+            while end < size:
+                record_end = _journal_record_at(data, end, size)
+                if not record_end:
+                    break
+                end = record_end
+        if end < size:
+            self._file.truncate(end)
+        # The records walked may not have been fsynced before the crash
+        os.fsync(fileno)
+        self._end = self._synced = end
+        self._checkpoint()
+        return size - end
+
+    def append(self, obj):
+        """Pickle obj as the next record."""
+        with self._lock:
+            if self._file is None:
+                raise ValueError("append to a closed journal")
+            data = self._pickler.dump_into(obj, self._buffer)
+            header = _JOURNAL_HEADER.pack(len(data))
+            crc = zlib.crc32(data, zlib.crc32(header))
+            group = self._group
+            group += header
+            group += data
+            group += _JOURNAL_TRAILER.pack(crc)
+            self._grouped += 1
+            if self._grouped >= self.group_size:
+                self._write(False)
+
+    def _write(self, sync):
+        if self._group:
+            self._file.write(self._group)
+            self._file.flush()
+            self._end += len(self._group)
+            self._group.clear()
+            self._grouped = 0
+            self._writes += 1
+        if sync or self.fsync_every and self._writes >= self.fsync_every:
+            if self._synced != self._end:
+                os.fsync(self._file.fileno())
+                self._synced = self._end
+                self._checkpoint()
+            self._writes = 0
+
+    def _checkpoint(self):
+        # Point recovery at self._synced.  The write is made durable by
+        # the next fsync; until then the checkpoint before stands.
+        self._file.seek(len(_JOURNAL_MAGIC))
+        self._file.write(_journal_checkpoint(self._synced))
+        self._file.flush()
+        self._file.seek(self._end)
+
+    def commit(self):
+        """Write and fsync every record appended so far."""
+        with self._lock:
+            self._write(True)
+
+    def records(self, **kwargs):
+        """Yield the records, oldest first, as of the call.
+
+        Records still in the group are written out first.  kwargs update
+        those given to __init__.
+        """
+        with self._lock:
+            self._write(False)
+            end = self._end
+        kwargs = {**self.kwargs, **kwargs}
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as data:
+            pos = _JOURNAL_START
+            while pos < end:
+                record_end = _journal_record_at(data, pos, end)
+                if not record_end:
+                    raise UnpicklingError("bad journal record at offset %d"
+                                          % pos)
+                yield loads(data[pos + _JOURNAL_HEADER.size:
+                                 record_end - _JOURNAL_TRAILER.size],
+                            **kwargs)
+                pos = record_end
+
+    def compact(self, snapshot):
+        """Replace every record with the one record snapshot.
+
+        snapshot is usually the state replaying the records builds,
+        records still in the group included.  The new journal is written
+        and fsynced beside this one, then renamed over it, so a crash
+        leaves one or the other whole.
+        """
+        with self._lock:
+            self._group.clear()
+            self._grouped = 0
+            temp = self.path + '.compact'
+            if os.path.exists(temp):
+                os.remove(temp)
+            with Journal(temp, protocol=self.protocol) as journal:
+                journal.append(snapshot)
+            os.replace(temp, self.path)
+            _fsync_dir(self.path)
+            self._file.close()
+            self._file = open(self.path, 'r+b')
+            self._file.seek(0, io.SEEK_END)
+            self._end = self._synced = self._file.tell()
+            self._writes = 0
+
+    def close(self):
+        """Commit and close the journal."""
+        with self._lock:
+            if self._file is not None:
+                self._write(True)
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Doctest
+__test__ = {"journal_record_in_a_pickle": """
+A record inside a pickle of a torn record is not taken for the tail:
+
+>>> import tempfile
+>>> from picklelite3 import dumps
+>>> path = os.path.join(tempfile.mkdtemp(), 'journal')
+>>> with Journal(path) as journal:
+...     journal.append('first')
+>>> data = dumps('forged', 4)
+>>> header = _JOURNAL_HEADER.pack(len(data))
+>>> record = header + data + _JOURNAL_TRAILER.pack(zlib.crc32(header + data))
+>>> with Journal(path) as journal:
+...     journal.append(bytes(16) + record + bytes(100))
+>>> with open(path, 'r+b') as f:
+...     end = f.read().index(record) + len(record) + 10
+...     _ = f.truncate(end)
+>>> journal = Journal(path)
+>>> list(journal.records())
+['first']
+>>> journal.append('second')
+>>> list(journal.records())
+['first', 'second']
+>>> journal.close()
+""",
+
+"journal_round_trip": """
+Records read back as pickle reads them, grouped or not, and after a
+compaction:
+
+>>> import pickle, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'journal')
+>>> records = [{'n': i, 'tags': ['t'] * i} for i in range(5)]
+>>> with Journal(path, group_size=2, fsync_every=0) as journal:
+...     for record in records:
+...         journal.append(record)
+...     print(list(journal.records()) == records)
+True
+>>> with open(path, 'rb') as f:
+...     data = f.read()
+>>> pos, copies = _JOURNAL_START, []
+>>> while pos < len(data):
+...     end = _journal_record_at(data, pos, len(data))
+...     copies.append(pickle.loads(data[pos + _JOURNAL_HEADER.size:
+...                                     end - _JOURNAL_TRAILER.size]))
+...     pos = end
+>>> copies == records
+True
+>>> journal = Journal(path)
+>>> journal.recovered
+0
+>>> journal.compact(records)
+>>> list(journal.records()) == [records]
+True
+
+A closed journal takes no records, and a file that isn't a journal is
+not recovered:
+
+>>> journal.close()
+>>> journal.append('late')
+Traceback (most recent call last):
+  ...
+ValueError: append to a closed journal
+>>> with open(path, 'wb') as f:
+...     _ = f.write(pickle.dumps(records))
+>>> Journal(path)
+... # doctest: +ELLIPSIS
+Traceback (most recent call last):
+  ...
+picklelite3.UnpicklingError: '...' is not a journal
+"""}
+
+def _test():
+    import doctest
+    return doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -26,11 +26,14 @@ __version__ = "$Revision: 72223 $"       # Code version
 from types import *
 from copy_reg import dispatch_table
 from copy_reg import _extension_registry, _inverted_registry, _extension_cache
-import marshal
 import sys
+from sys import maxsize
 import struct
+from struct import unpack
 import re
 
+import pickleengine
+
 __all__ = ["PickleError", "PicklingError", "UnpicklingError", "Pickler",
            "Unpickler", "dump", "dumps", "load", "loads"]
 
@@ -38,11 +41,6 @@ __all__ = ["PickleError", "PicklingError", "UnpicklingError", "Pickler",
 # know how to read.
 HIGHEST_PROTOCOL = 2
 
-# Why use struct.pack() for pickling but marshal.loads() for
-# unpickling?  struct.pack() is 40% faster than marshal.dumps(), but
-# marshal.loads() is twice as fast as struct.unpack()!
-mloads = marshal.loads
-
 class PickleError(Exception):
     """A common base class for the other pickling exceptions."""
     pass
@@ -783,6 +781,13 @@ class Unpickler:
         while stack[k] is not mark: k = k-1
         return k
 
+    # Pop the items above the topmost mark, and the mark itself.
+    def pop_mark(self):
+        k = self.marker()
+        items = self.stack[k+1:]
+        del self.stack[k:]
+        return items
+
     dispatch = {}
 
     def load_eof(self):
@@ -795,23 +800,6 @@ class Unpickler:
             raise ValueError, "unsupported pickle protocol: %d" % proto
     dispatch[PROTO] = load_proto
 
-    def load_binpersid(self):
-        pid = self.stack.pop()
-        self.append(self.persistent_load(pid))
-    dispatch[BINPERSID] = load_binpersid
-
-    def load_none(self):
-        self.append(None)
-    dispatch[NONE] = load_none
-
-    def load_false(self):
-        self.append(False)
-    dispatch[NEWFALSE] = load_false
-
-    def load_true(self):
-        self.append(True)
-    dispatch[NEWTRUE] = load_true
-
     def load_int(self):
         data = self.readline()
         # INT is the most expensive opcode to unpickle, an attractive target
@@ -835,94 +823,10 @@ class Unpickler:
         self.append(val)
     dispatch[INT] = load_int
 
-    def load_binint(self):
-        self.append(mloads('i' + self.read(4)))
-    dispatch[BININT] = load_binint
-
     def load_binint1(self):
         self.append(ord(self.read(1)))
     dispatch[BININT1] = load_binint1
 
-    def load_binint2(self):
-        self.append(mloads('i' + self.read(2) + '\000\000'))
-    dispatch[BININT2] = load_binint2
-
-    def load_long1(self):
-        n = ord(self.read(1))
-        bytes = self.read(n)
-        self.append(decode_long(bytes))
-    dispatch[LONG1] = load_long1
-
-    def load_long4(self):
-        n = mloads('i' + self.read(4))
-        bytes = self.read(n)
-        self.append(decode_long(bytes))
-    dispatch[LONG4] = load_long4
-
-    def load_binfloat(self, unpack=struct.unpack):
-        self.append(unpack('>d', self.read(8))[0])
-    dispatch[BINFLOAT] = load_binfloat
-
-    def load_binstring(self):
-        len = mloads('i' + self.read(4))
-        self.append(self.read(len))
-    dispatch[BINSTRING] = load_binstring
-
-    def load_binunicode(self):
-        len = mloads('i' + self.read(4))
-        self.append(unicode(self.read(len),'utf-8'))
-    dispatch[BINUNICODE] = load_binunicode
-
-    def load_short_binstring(self):
-        len = ord(self.read(1))
-        self.append(self.read(len))
-    dispatch[SHORT_BINSTRING] = load_short_binstring
-
-    def load_tuple(self):
-        k = self.marker()
-        self.stack[k:] = [tuple(self.stack[k+1:])]
-    dispatch[TUPLE] = load_tuple
-
-    def load_empty_tuple(self):
-        self.stack.append(())
-    dispatch[EMPTY_TUPLE] = load_empty_tuple
-
-    def load_tuple1(self):
-        self.stack[-1] = (self.stack[-1],)
-    dispatch[TUPLE1] = load_tuple1
-
-    def load_tuple2(self):
-        self.stack[-2:] = [(self.stack[-2], self.stack[-1])]
-    dispatch[TUPLE2] = load_tuple2
-
-    def load_tuple3(self):
-        self.stack[-3:] = [(self.stack[-3], self.stack[-2], self.stack[-1])]
-    dispatch[TUPLE3] = load_tuple3
-
-    def load_empty_list(self):
-        self.stack.append([])
-    dispatch[EMPTY_LIST] = load_empty_list
-
-    def load_empty_dictionary(self):
-        self.stack.append({})
-    dispatch[EMPTY_DICT] = load_empty_dictionary
-
-    def load_list(self):
-        k = self.marker()
-        self.stack[k:] = [self.stack[k+1:]]
-    dispatch[LIST] = load_list
-
-    def load_dict(self):
-        k = self.marker()
-        d = {}
-        items = self.stack[k+1:]
-        for i in range(0, len(items), 2):
-            key = items[i]
-            value = items[i+1]
-            d[key] = value
-        self.stack[k:] = [d]
-    dispatch[DICT] = load_dict
-
     # INST and OBJ differ only in how they get a class object.  It's not
     # only sensible to do the rest in a common routine, the two routines
     # previously diverged and grew different bugs.
@@ -958,28 +862,6 @@ class Unpickler:
         self._instantiate(klass, k)
     dispatch[OBJ] = load_obj
 
-    def load_newobj(self):
-        args = self.stack.pop()
-        cls = self.stack[-1]
-        obj = cls.__new__(cls, *args)
-        self.stack[-1] = obj
-    dispatch[NEWOBJ] = load_newobj
-
-    def load_ext1(self):
-        code = ord(self.read(1))
-        self.get_extension(code)
-    dispatch[EXT1] = load_ext1
-
-    def load_ext2(self):
-        code = mloads('i' + self.read(2) + '\000\000')
-        self.get_extension(code)
-    dispatch[EXT2] = load_ext2
-
-    def load_ext4(self):
-        code = mloads('i' + self.read(4))
-        self.get_extension(code)
-    dispatch[EXT4] = load_ext4
-
     def get_extension(self, code):
         nil = []
         obj = _extension_cache.get(code, nil)
@@ -1000,80 +882,15 @@ class Unpickler:
         klass = getattr(mod, name)
         return klass
 
-    def load_reduce(self):
-        stack = self.stack
-        args = stack.pop()
-        func = stack[-1]
-        value = func(*args)
-        stack[-1] = value
-    dispatch[REDUCE] = load_reduce
-
     def load_pop(self):
         del self.stack[-1]
     dispatch[POP] = load_pop
 
-    def load_pop_mark(self):
-        k = self.marker()
-        del self.stack[k:]
-    dispatch[POP_MARK] = load_pop_mark
-
-    def load_dup(self):
-        self.append(self.stack[-1])
-    dispatch[DUP] = load_dup
-
     def load_binget(self):
         i = ord(self.read(1))
         self.append(self.memo[repr(i)])
     dispatch[BINGET] = load_binget
 
-    def load_long_binget(self):
-        i = mloads('i' + self.read(4))
-        self.append(self.memo[repr(i)])
-    dispatch[LONG_BINGET] = load_long_binget
-
-    def load_binput(self):
-        i = ord(self.read(1))
-        self.memo[repr(i)] = self.stack[-1]
-    dispatch[BINPUT] = load_binput
-
-    def load_long_binput(self):
-        i = mloads('i' + self.read(4))
-        self.memo[repr(i)] = self.stack[-1]
-    dispatch[LONG_BINPUT] = load_long_binput
-
-    def load_append(self):
-        stack = self.stack
-        value = stack.pop()
-        list = stack[-1]
-        list.append(value)
-    dispatch[APPEND] = load_append
-
-    def load_appends(self):
-        stack = self.stack
-        mark = self.marker()
-        list = stack[mark - 1]
-        list.extend(stack[mark + 1:])
-        del stack[mark:]
-    dispatch[APPENDS] = load_appends
-
-    def load_setitem(self):
-        stack = self.stack
-        value = stack.pop()
-        key = stack.pop()
-        dict = stack[-1]
-        dict[key] = value
-    dispatch[SETITEM] = load_setitem
-
-    def load_setitems(self):
-        stack = self.stack
-        mark = self.marker()
-        dict = stack[mark - 1]
-        for i in range(mark + 1, len(stack), 2):
-            dict[stack[i]] = stack[i + 1]
-
-        del stack[mark:]
-    dispatch[SETITEMS] = load_setitems
-
     def load_build(self):
         stack = self.stack
         state = stack.pop()
@@ -1122,6 +939,9 @@ class Unpickler:
         raise _Stop(value)
     dispatch[STOP] = load_stop
 
+# The handlers shared with picklelite3 are generated from one spec
+pickleengine.install(Unpickler, globals(), py3=False)
+
 # Helper class for load_inst/load_obj
 
 class _EmptyClass:
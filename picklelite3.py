@@ -12,6 +12,7 @@ Functions:
 
     dump(object, file)
     dumps(object) -> string
+    dumps_canonical(object) -> (string, hexdigest)
     load(file) -> object
     loads(string) -> object
 
@@ -26,18 +27,42 @@ Misc variables:
 from types import FunctionType
 from copyreg import dispatch_table
 from copyreg import _extension_registry, _inverted_registry, _extension_cache
-from itertools import islice
+from itertools import islice, repeat
 from functools import partial
 import sys
 from sys import maxsize
-from struct import pack, unpack
+from time import monotonic, perf_counter, perf_counter_ns
+from struct import pack, unpack, iter_unpack
+import struct
 import re
 import io
+import mmap
+import os
 import codecs
+import bisect
+import hashlib
+import heapq
+import json
 import _compat_pickle
-
-__all__ = ["PickleError", "PicklingError", "UnpicklingError", "Pickler",
-           "Unpickler", "dump", "dumps", "load", "loads"]
+import array
+import collections
+import collections.abc
+import datetime
+import decimal
+import threading
+import tracemalloc
+import weakref
+
+import pickleengine
+
+__all__ = ["PickleError", "PicklingError", "UnpicklingError",
+           "UnpicklingTimeout", "UnpicklingForbidden", "Pickler",
+           "Unpickler", "OpcodeProfile", "AllocationProfile", "Metrics",
+           "enable_metrics", "disable_metrics", "get_metrics", "dump",
+           "dumps", "load", "loads", "load_path", "load_compressed",
+           "load_compressed_many", "MappedFile", "PickleIndex",
+           "build_index", "loads_lazy", "loads_path", "dumps_canonical",
+           "opcode_table"]
 
 # Shortcut for use in isinstance testing
 bytes_types = (bytes, bytearray)
@@ -83,6 +108,29 @@ class UnpicklingError(PickleError):
     """
     pass
 
+class UnpicklingTimeout(UnpicklingError):
+    """This exception is raised when unpickling runs past its deadline.
+
+    The deadline is checked cooperatively, so it may be overrun by the
+    cost of the opcodes between two checks.  A long run of scalars after
+    one MARK is no exception:
+
+    >>> data = b'\\x80\\x04(' + b'K\\x01' * 10**6 + b'l.'
+    >>> loads(data, deadline=monotonic() + 0.01)
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnpicklingTimeout: unpickling deadline exceeded
+    """
+    pass
+
+class UnpicklingForbidden(UnpicklingError):
+    """This exception is raised when a pickle uses an opcode or global
+    that the unpickler's policy forbids.
+
+    """
+    pass
+
 # An instance of _Stop is raised by Unpickler.load_stop() in response to
 # the STOP opcode, passing the object that is the result of unpickling.
 class _Stop(Exception):
@@ -95,6 +143,37 @@ try:
 except ImportError:
     PyStringMap = None
 
+# NumPy, if available, decodes long runs of fixed width scalar opcodes.
+# It is imported by the first such run, not with this module.
+_numpy = None
+
+def _import_numpy():
+    # numpy, or False if it isn't available
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy
+
+# Decompressors for load_compressed(); each is an optional extension
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import gzip
+except ImportError:
+    gzip = None
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
 # Pickle opcodes.  See pickletools.py for extensive docs.  The listing
 # here is in kind-of alphabetical order of 1-character pickle code.
 # pickletools groups them by purpose.
@@ -104,32 +183,41 @@ STOP           = b'.'   # every pickle ends with STOP
 POP            = b'0'   # discard topmost stack item
 POP_MARK       = b'1'   # discard stack top through topmost markobject
 DUP            = b'2'   # duplicate top stack item
+GLOBAL         = b'c'   # push self.find_class(modname, name); 2 string args
 INT            = b'I'   # push integer or bool; decimal string argument
 BININT         = b'J'   # push four-byte signed int
 BININT1        = b'K'   # push 1-byte unsigned int
 BININT2        = b'M'   # push 2-byte unsigned int
+LONG           = b'L'   # push long; decimal string argument
 NONE           = b'N'   # push None
+PERSID         = b'P'   # push persistent object; id is taken from string arg
 BINPERSID      = b'Q'   #  "       "         "  ;  "  "   "     "  stack
 REDUCE         = b'R'   # apply callable to argtuple, both on stack
+STRING         = b'S'   # push string; NL-terminated string argument
 BINSTRING      = b'T'   # push string; counted binary string argument
 SHORT_BINSTRING= b'U'   #  "     "   ;    "      "       "      " < 256 bytes
+UNICODE        = b'V'   # push Unicode string; raw-unicode-escaped'd argument
 BINUNICODE     = b'X'   #   "     "       "  ; counted UTF-8 string argument
 APPEND         = b'a'   # append stack top to list below it
 BUILD          = b'b'   # call __setstate__ or __dict__.update()
 DICT           = b'd'   # build a dict from stack items
 EMPTY_DICT     = b'}'   # push empty dict
 APPENDS        = b'e'   # extend list on stack by topmost stack slice
+GET            = b'g'   # push item from memo on stack; index is string arg
 BINGET         = b'h'   #   "    "    "    "   "   "  ;   "    " 1-byte arg
+INST           = b'i'   # build & push class instance
 LONG_BINGET    = b'j'   # push item from memo on stack; index is 4-byte arg
 LIST           = b'l'   # build list from topmost stack items
 EMPTY_LIST     = b']'   # push empty list
 OBJ            = b'o'   # build & push class instance
+PUT            = b'p'   # store stack top in memo; index is string arg
 BINPUT         = b'q'   #   "     "    "   "   " ;   "    " 1-byte arg
 LONG_BINPUT    = b'r'   #   "     "    "   "   " ;   "    " 4-byte arg
 SETITEM        = b's'   # add key+value pair to dict
 TUPLE          = b't'   # build tuple from topmost stack items
 EMPTY_TUPLE    = b')'   # push empty tuple
 SETITEMS       = b'u'   # modify dict by adding topmost key+value pairs
+FLOAT          = b'F'   # push float object; decimal string argument
 BINFLOAT       = b'G'   # push float; arg is 8-byte float encoding
 
 # Protocol 2
@@ -176,13 +264,19 @@ class _Framer:
     def __init__(self, file_write):
         self.file_write = file_write
         self.current_frame = None
+        # The emptied buffer of the last frame, reused by the next dump
+        self.spare_frame = None
 
     def start_framing(self):
-        self.current_frame = io.BytesIO()
+        if self.spare_frame is not None:
+            self.current_frame, self.spare_frame = self.spare_frame, None
+        else:
+            self.current_frame = io.BytesIO()
 
     def end_framing(self):
         if self.current_frame and self.current_frame.tell() > 0:
             self.commit_frame(force=True)
+            self.spare_frame = self.current_frame
             self.current_frame = None
 
     def commit_frame(self, force=False):
@@ -207,11 +301,19 @@ class _Framer:
 
 class _Unframer:
 
-    def __init__(self, file_read, file_readline, file_tell=None):
+    def __init__(self, file_read, file_readline, file_tell=None,
+                 file_buffer=None):
         self.file_read = file_read
         self.file_readline = file_readline
+        self.file_buffer = file_buffer
         self.current_frame = None
 
+    def source(self):
+        """Return the BytesIO the next read() comes from, or None."""
+        if self.current_frame:
+            return self.current_frame
+        return self.file_buffer
+
     def read(self, n):
         if self.current_frame:
             data = self.current_frame.read(n)
@@ -225,26 +327,65 @@ class _Unframer:
         else:
             return self.file_read(n)
 
-    def readline(self):
+    def readline(self, size=-1):
         if self.current_frame:
-            data = self.current_frame.readline()
+            data = self.current_frame.readline(size)
             if not data:
                 self.current_frame = None
-                return self.file_readline()
-            if data[-1] != b'\n'[0]:
+                return self.file_readline(size)
+            if data[-1] != b'\n'[0] and len(data) != size:
                 raise UnpicklingError(
                     "pickle exhausted before end of frame")
             return data
         else:
-            return self.file_readline()
+            return self.file_readline(size)
 
     def load_frame(self, frame_size):
         if self.current_frame and self.current_frame.read() != b'':
             raise UnpicklingError(
                 "beginning of a new frame before end of current frame")
+        if isinstance(self.file_buffer, MappedFile):
+            # The whole file is in memory already, so the frame is read
+            # in place rather than copied out
+            if frame_size > self.file_buffer.remaining():
+                raise UnpicklingError("pickle exhausted before end of frame")
+            return
         self.current_frame = io.BytesIO(self.file_read(frame_size))
 
 
+class MappedFile(mmap.mmap):
+    """A read-only memory map of a file, as used by load_path().
+
+    Open one as mmap.mmap(fileno, 0, access=mmap.ACCESS_READ); an
+    Unpickler needs one to read bytes as views.
+
+    The read(), tell() and seek() of mmap copy out only the bytes asked
+    for.  read_view() returns a memoryview into the mapping instead, and
+    getbuffer() works as for BytesIO, so runs of scalars are decoded in
+    place too.
+    """
+
+    def remaining(self):
+        return len(self) - self.tell()
+
+    def read_view(self, n):
+        start = self.tell()
+        end = min(start + n, len(self))
+        self.seek(end)
+        return memoryview(self)[start:end]
+
+    def readline(self, size=-1):
+        # mmap.readline() takes no size
+        if size < 0:
+            return super().readline()
+        start = self.tell()
+        end = self.find(b'\n', start, start + size) + 1 or start + size
+        return self.read(end - start)
+
+    def getbuffer(self):
+        return memoryview(self)
+
+
 # Tools used for pickling.
 
 def _getattribute(obj, name):
@@ -260,6 +401,12 @@ def _getattribute(obj, name):
                                  .format(name, obj))
     return obj, parent
 
+# Types that are never memoized, and hold no references to other objects.
+_scalar_types = frozenset([type(None), bool, int, float])
+
+# Marks the end of a container's members in _Pickler.count_references().
+_EXIT = object()
+
 def whichmodule(obj, name):
     """Find the module an object belong to."""
     module_name = getattr(obj, '__module__', None)
@@ -328,10 +475,178 @@ def decode_long(data):
     return int.from_bytes(data, byteorder='little', signed=True)
 
 
+# Native reconstructors for the standard library types in the corpus.
+#
+# With natives=True the unpickler resolves these exact globals itself,
+# without calling find_class().  Each reconstructor checks the types of
+# the arguments it is given, rather than passing arbitrary arguments on
+# to a general purpose callable.
+
+def _native_text(value, what):
+    # Python 2 8-bit strings arrive as bytes when encoding='bytes'
+    if type(value) is bytes:
+        return value.decode('ascii')
+    if type(value) is not str:
+        raise UnpicklingError("%s must be str, not %s" %
+                              (what, type(value).__name__))
+    return value
+
+def _native_state(value, size, what):
+    # Python 2 8-bit strings arrive as str when encoding='latin1'
+    if type(value) is str:
+        value = value.encode('latin1')
+    if type(value) is not bytes or len(value) != size:
+        raise UnpicklingError("%s state must be %d bytes" % (what, size))
+    return value
+
+def _native_tzinfo(tzinfo):
+    if tzinfo is not None and type(tzinfo) is not datetime.timezone:
+        raise UnpicklingError("tzinfo must be None or a datetime.timezone")
+    return tzinfo
+
+def _native_encode(obj, encoding):
+    # Python 3 writes non-empty bytes as _codecs.encode(str, 'latin1')
+    # for protocols < 3.  Other codecs, e.g. zlib_codec, are refused.
+    if type(obj) is not str or encoding not in ('latin1', 'latin-1'):
+        raise UnpicklingError("_codecs.encode only supports latin1 str")
+    return obj.encode('latin1')
+
+def _native_bytes(*args):
+    if args:
+        raise UnpicklingError("bytes() takes no arguments when unpickling")
+    return b''
+
+def _native_bytearray(*args):
+    if not args:
+        return bytearray()
+    if len(args) == 1 and type(args[0]) is bytes:
+        return bytearray(args[0])
+    if len(args) == 2 and type(args[0]) is str:
+        return bytearray(_native_encode(*args))
+    raise UnpicklingError("bytearray() arguments must be bytes, "
+                          "or a str and 'latin-1'")
+
+def _native_complex(real, imag=0.0):
+    if type(real) not in (int, float) or type(imag) not in (int, float):
+        raise UnpicklingError("complex() arguments must be int or float")
+    return complex(real, imag)
+
+def _native_ordereddict(items=()):
+    # Python 2 passes the items as a list of [key, value] lists
+    if type(items) not in (list, tuple):
+        raise UnpicklingError("OrderedDict() argument must be a list")
+    return collections.OrderedDict(items)
+
+def _native_counter(*args):
+    if not args:
+        return collections.Counter()
+    if len(args) != 1 or type(args[0]) is not dict:
+        raise UnpicklingError("Counter() argument must be a dict")
+    return collections.Counter(args[0])
+
+def _native_defaultdict(default_factory=None):
+    if default_factory is not None and not isinstance(default_factory, type):
+        raise UnpicklingError("defaultdict() factory must be None or a type")
+    return collections.defaultdict(default_factory)
+
+def _native_date(state):
+    return datetime.date(_native_state(state, 4, 'date'))
+
+def _native_datetime(state, tzinfo=None):
+    return datetime.datetime(_native_state(state, 10, 'datetime'),
+                             _native_tzinfo(tzinfo))
+
+def _native_time(state, tzinfo=None):
+    return datetime.time(_native_state(state, 6, 'time'),
+                         _native_tzinfo(tzinfo))
+
+def _native_timedelta(days=0, seconds=0, microseconds=0):
+    if (type(days) is not int or type(seconds) is not int or
+        type(microseconds) is not int):
+        raise UnpicklingError("timedelta() arguments must be int")
+    return datetime.timedelta(days, seconds, microseconds)
+
+def _native_timezone(offset, name=None):
+    if type(offset) is not datetime.timedelta:
+        raise UnpicklingError("timezone() offset must be a timedelta")
+    if name is None:
+        return datetime.timezone(offset)
+    return datetime.timezone(offset, _native_text(name, 'timezone name'))
+
+def _native_decimal(value):
+    return decimal.Decimal(_native_text(value, 'Decimal value'))
+
+# array machine format codes, see arraymodule.c
+def _array_machine_formats():
+    little = sys.byteorder == 'little'
+    formats = {}
+    for typecode in array.typecodes:
+        size = array.array(typecode).itemsize
+        if typecode in 'fd':
+            code = {4: 14, 8: 16}[size]
+        elif typecode in 'uw':
+            code = {2: 18, 4: 20}[size]
+        elif size == 1:
+            formats[typecode] = 1 if typecode.islower() else 0
+            continue
+        else:
+            code = {2: 2, 4: 6, 8: 10}[size]
+            if typecode.islower():
+                code += 2
+        formats[typecode] = code if little else code + 1
+    return formats
+
+_ARRAY_MACHINE_FORMATS = _array_machine_formats()
+
+def _native_array_reconstructor(cls, typecode, mformat_code, items):
+    # Protocol 3+ writes array._array_reconstructor(array.array, typecode,
+    # machine format, bytes); in native format that is just frombytes()
+    typecode = _native_text(typecode, 'array typecode')
+    if (cls is not array.array or typecode not in array.typecodes or
+        type(mformat_code) is not int or type(items) is not bytes):
+        raise UnpicklingError("bad arguments to array._array_reconstructor")
+    if _ARRAY_MACHINE_FORMATS[typecode] == mformat_code:
+        result = array.array(typecode)
+        result.frombytes(items)
+        return result
+    return array._array_reconstructor(cls, typecode, mformat_code, items)
+
+# Keys use Python 3 names; Python 2 names are mapped first, as for
+# find_class().  Classes whose constructors check their own arguments,
+# e.g. array.array and BytesIO, are used directly.
+_NATIVE_GLOBALS = {
+    ('builtins', 'bytearray'): _native_bytearray,
+    ('builtins', 'bytes'): _native_bytes,
+    ('builtins', 'complex'): _native_complex,
+    ('builtins', 'dict'): dict,
+    ('builtins', 'float'): float,
+    ('builtins', 'frozenset'): frozenset,
+    ('builtins', 'int'): int,
+    ('builtins', 'list'): list,
+    ('builtins', 'set'): set,
+    ('builtins', 'str'): str,
+    ('_codecs', 'encode'): _native_encode,
+    ('array', 'array'): array.array,
+    ('array', '_array_reconstructor'): _native_array_reconstructor,
+    ('collections', 'Counter'): _native_counter,
+    ('collections', 'OrderedDict'): _native_ordereddict,
+    ('collections', 'defaultdict'): _native_defaultdict,
+    ('datetime', 'date'): _native_date,
+    ('datetime', 'datetime'): _native_datetime,
+    ('datetime', 'time'): _native_time,
+    ('datetime', 'timedelta'): _native_timedelta,
+    ('datetime', 'timezone'): _native_timezone,
+    ('decimal', 'Decimal'): _native_decimal,
+    ('_io', 'BytesIO'): io.BytesIO,
+    ('io', 'BytesIO'): io.BytesIO,
+}
+
+
 # Pickling machinery
 
 class _Pickler:
-    def __init__(self, file, protocol=None, *, fix_imports=True):
+    def __init__(self, file, protocol=None, *, fix_imports=True,
+                 canonical=False, elide_memo=False, dedup=False):
         """This takes a binary file for writing a pickle data stream.
 
         The optional *protocol* argument tells the pickler to use the
@@ -353,6 +668,24 @@ class _Pickler:
         will try to map the new Python 3 names to the old module names
         used in Python 2, so that the pickle data stream is readable
         with Python 2.
+
+        If *canonical* is True the pickler writes the same bytes for equal
+        values, independent of hash seeds, set iteration order, dict
+        insertion order and string interning: set, frozenset and dict
+        items are written in sorted order, and equal str and bytes objects
+        share a single memo slot.  A SHA-256 hash of each pickle is
+        computed as it is written, see hexdigest().
+
+        If *elide_memo* is True each dump() first counts how often every
+        object is reached, and only objects reached more than once are
+        written to the memo.  Pickles of data that contain no shared
+        objects then carry no BINPUT or MEMOIZE opcodes at all.
+
+        If *dedup* is True equal str and bytes objects of up to
+        _DEDUP_MAX_LEN items are pickled once, and later copies are
+        written as BINGET or LONG_BINGET references to the first, even
+        when they are distinct objects.  The lookup table holds at most
+        _DEDUP_MAX_ENTRIES values; the oldest are forgotten first.
         """
         if protocol is None:
             protocol = DEFAULT_PROTOCOL
@@ -365,13 +698,43 @@ class _Pickler:
             self._file_write = file.write
         except AttributeError:
             raise TypeError("file must have a 'write' attribute")
-        self.framer = _Framer(self._file_write)
+        self.canonical = canonical
+        self.content_hash = None
+        if canonical:
+            self.framer = _Framer(self._hashing_write)
+        else:
+            self.framer = _Framer(self._file_write)
+        if canonical:
+            # Every equal value must share a slot, or the output would
+            # depend on which strings happen to be the same object.
+            self._value_memo = {}
+            self._dedup_max_len = maxsize
+            self._dedup_max_entries = maxsize
+        elif dedup:
+            self._value_memo = {}
+            self._dedup_max_len = self._DEDUP_MAX_LEN
+            self._dedup_max_entries = self._DEDUP_MAX_ENTRIES
+        else:
+            self._value_memo = None
         self.write = self.framer.write
         self.memo = {}
         self.proto = int(protocol)
         self.bin = protocol >= 1
         self.fast = 0
         self.fix_imports = fix_imports and protocol < 3
+        self.elide_memo = elide_memo
+        self._refcounts = None
+        self._canonical_keys = None
+
+    def _hashing_write(self, data):
+        self.content_hash.update(data)
+        return self._file_write(data)
+
+    def hexdigest(self):
+        """Return the SHA-256 hex digest of the last canonical pickle."""
+        if self.content_hash is None:
+            raise PicklingError("no canonical pickle has been written")
+        return self.content_hash.hexdigest()
 
     def clear_memo(self):
         """Clears the pickler's "memo".
@@ -382,6 +745,44 @@ class _Pickler:
         useful when re-using picklers.
         """
         self.memo.clear()
+        if self._value_memo is not None:
+            self._value_memo.clear()
+
+    def reset(self):
+        """Forget everything the pickler remembers from earlier dumps.
+
+        The memo is cleared and any unfinished frame dropped, so that one
+        long-lived pickler can write many independent pickles.
+        """
+        self.clear_memo()
+        self.framer.current_frame = None
+        self.content_hash = None
+        self._refcounts = None
+        self._canonical_keys = None
+
+    def dump_into(self, obj, buffer):
+        """Write a pickled representation of obj into buffer.
+
+        buffer is a bytearray whose contents are replaced by the pickle;
+        the pickler is reset() first, so the pickle stands alone.  The
+        file given to __init__ is left untouched.  Return buffer.
+        """
+        del buffer[:]
+        file_write = self._file_write
+        self.reset()
+        self._set_file_write(buffer.extend)
+        try:
+            self.dump(obj)
+        finally:
+            self._set_file_write(file_write)
+        return buffer
+
+    def _set_file_write(self, file_write):
+        self._file_write = file_write
+        if self.canonical:
+            self.framer.file_write = self._hashing_write
+        else:
+            self.framer.file_write = file_write
 
     def dump(self, obj):
         """Write a pickled representation of obj to the open file."""
@@ -390,14 +791,94 @@ class _Pickler:
         if not hasattr(self, "_file_write"):
             raise PicklingError("Pickler.__init__() was not called by "
                                 "%s.__init__()" % (self.__class__.__name__,))
+        if self.canonical:
+            self.content_hash = hashlib.sha256()
         if self.proto >= 2:
             self.write(PROTO + pack("<B", self.proto))
         if self.proto >= 4:
             self.framer.start_framing()
-        self.save(obj)
+        if self.elide_memo and not self.fast:
+            self._refcounts = self.count_references(obj)
+        # The sort keys canonical_key() makes are kept for this dump, and
+        # shared with the picklers it makes for keys inside keys
+        own_keys = self.canonical and self._canonical_keys is None
+        if own_keys:
+            self._canonical_keys = {}
+        try:
+            self.save(obj)
+        finally:
+            self._refcounts = None
+            if own_keys:
+                self._canonical_keys = None
         self.write(STOP)
         self.framer.end_framing()
 
+    def count_references(self, obj):
+        """Count how many times each memoizable object in obj is reached.
+
+        Return a dict mapping id() to a count, or None if obj holds an
+        object that can only be followed by calling its __reduce__, in
+        which case every object must be given a memo slot as usual.
+        """
+        if (type(self).persistent_id is not _Pickler.persistent_id or
+            self.dispatch is not _Pickler.dispatch):
+            return None
+        proto = self.proto
+        values = {} if self._value_memo is not None else None
+        max_len = self._dedup_max_len if values is not None else -1
+        counts = {}
+        opened = set()
+        nimmutable = 0
+        todo = [obj]
+        while todo:
+            x = todo.pop()
+            if x is _EXIT:
+                x = todo.pop()
+                opened.discard(id(x))
+                if type(x) is tuple or type(x) is frozenset:
+                    nimmutable -= 1
+                continue
+            t = type(x)
+            if t in _scalar_types:
+                continue
+            if t is str or (t is bytes and proto >= 3):
+                if len(x) <= max_len:
+                    values.setdefault(x, []).append(x)
+                else:
+                    counts[id(x)] = counts.get(id(x), 0) + 1
+                continue
+            if t is tuple and not x:
+                continue
+            if not (t is tuple or t is list or t is dict or
+                    ((t is set or t is frozenset) and proto >= 4)):
+                return None
+            i = id(x)
+            n = counts.get(i, 0)
+            counts[i] = n + 1
+            if n:
+                # A cycle through a tuple or frozenset makes the pickler
+                # save some of its members twice, see save_tuple().
+                if nimmutable and i in opened:
+                    return None
+                continue
+            opened.add(i)
+            if t is tuple or t is frozenset:
+                nimmutable += 1
+            todo.append(x)
+            todo.append(_EXIT)
+            if t is dict:
+                for k, v in x.items():
+                    todo.append(k)
+                    todo.append(v)
+            else:
+                todo.extend(x)
+        if values is not None:
+            for equal in values.values():
+                n = len(equal)
+                for x in equal:
+                    counts[id(x)] = n
+        return counts
+
     def memoize(self, obj):
         """Store an object in the memo."""
 
@@ -416,6 +897,9 @@ class _Pickler:
         if self.fast:
             return
         assert id(obj) not in self.memo
+        refcounts = self._refcounts
+        if refcounts is not None and refcounts.get(id(obj), 2) < 2:
+            return
         idx = len(self.memo)
         self.write(self.put(idx))
         self.memo[id(obj)] = idx, obj
@@ -442,6 +926,64 @@ class _Pickler:
 
         raise PicklingError("picklelite only supports binary mode")
 
+    # Canonical and dedup modes key str and bytes by value as well as by
+    # id(), so that equal copies of a string share one memo slot.
+
+    _DEDUP_MAX_LEN = 1024
+    _DEDUP_MAX_ENTRIES = 1 << 16
+
+    def save_value_ref(self, obj):
+        if len(obj) > self._dedup_max_len:
+            return False
+        idx = self._value_memo.get(obj)
+        if idx is None:
+            return False
+        self.write(self.get(idx))
+        return True
+
+    def remember_value(self, obj):
+        if len(obj) > self._dedup_max_len:
+            return
+        x = self.memo.get(id(obj))
+        if x is not None:
+            table = self._value_memo
+            if len(table) >= self._dedup_max_entries:
+                # Forgetting a value only costs a later copy being written
+                # in full; its memo slot in the pickle stays valid.
+                del table[next(iter(table))]
+            table[obj] = x[0]
+
+    def canonical_key(self, obj):
+        """Return a sort key for obj that depends only on its value.
+
+        Neither id() nor hash() is used, so equal values sort the same way
+        in every process.  During a dump the key of each object is made
+        once, however often it is sorted and however deeply it is nested.
+        """
+        t = type(obj)
+        if t is str or t is bytes or t is int:
+            return (t.__name__, obj)
+        keys = self._canonical_keys
+        if keys is not None:
+            x = keys.get(id(obj))
+            if x is not None:
+                return x[1]
+        f = io.BytesIO()
+        p = _Pickler(f, self.proto, fix_imports=self.fix_imports,
+                     canonical=True)
+        p._canonical_keys = keys
+        p.dump(obj)
+        key = (t.__name__, f.getvalue())
+        if keys is not None:
+            # obj is kept too, so that its id() can't be reused
+            keys[id(obj)] = obj, key
+        return key
+
+    def canonical_order(self, items, key=None):
+        if key is None:
+            key = self.canonical_key
+        return sorted(items, key=key)
+
     def save(self, obj, save_persistent_id=True):
         self.framer.commit_frame()
 
@@ -676,6 +1218,8 @@ class _Pickler:
                 self.save_reduce(codecs.encode,
                                  (str(obj, 'latin1'), 'latin1'), obj=obj)
             return
+        if self._value_memo is not None and self.save_value_ref(obj):
+            return
         n = len(obj)
         if n <= 0xff:
             self.write(SHORT_BINBYTES + pack("<B", n) + obj)
@@ -684,9 +1228,13 @@ class _Pickler:
         else:
             self.write(BINBYTES + pack("<I", n) + obj)
         self.memoize(obj)
+        if self._value_memo is not None:
+            self.remember_value(obj)
     dispatch[bytes] = save_bytes
 
     def save_str(self, obj):
+        if self._value_memo is not None and self.save_value_ref(obj):
+            return
         if self.bin:
             encoded = obj.encode('utf-8', 'surrogatepass')
             n = len(encoded)
@@ -699,6 +1247,8 @@ class _Pickler:
         else:
             raise PicklingError("picklelite only supports binary mode")
         self.memoize(obj)
+        if self._value_memo is not None:
+            self.remember_value(obj)
     dispatch[str] = save_str
 
     def save_tuple(self, obj):
@@ -796,7 +1346,12 @@ class _Pickler:
             raise PicklingError("picklelite only supports binary mode")
 
         self.memoize(obj)
-        self._batch_setitems(obj.items())
+        if self.canonical:
+            key = self.canonical_key
+            self._batch_setitems(self.canonical_order(
+                obj.items(), key=lambda item: key(item[0])))
+        else:
+            self._batch_setitems(obj.items())
 
     dispatch[dict] = save_dict
     if PyStringMap is not None:
@@ -833,14 +1388,15 @@ class _Pickler:
         save = self.save
         write = self.write
 
+        items = self.canonical_order(obj) if self.canonical else obj
         if self.proto < 4:
-            self.save_reduce(set, (list(obj),), obj=obj)
+            self.save_reduce(set, (list(items),), obj=obj)
             return
 
         write(EMPTY_SET)
         self.memoize(obj)
 
-        it = iter(obj)
+        it = iter(items)
         while True:
             batch = list(islice(it, self._BATCHSIZE))
             n = len(batch)
@@ -857,12 +1413,13 @@ class _Pickler:
         save = self.save
         write = self.write
 
+        items = self.canonical_order(obj) if self.canonical else obj
         if self.proto < 4:
-            self.save_reduce(frozenset, (list(obj),), obj=obj)
+            self.save_reduce(frozenset, (list(items),), obj=obj)
             return
 
         write(MARK)
-        for item in obj:
+        for item in items:
             save(item)
 
         if id(obj) in self.memo:
@@ -951,10 +1508,24 @@ class _Pickler:
 
 # Unpickling machinery
 
+# The most digits int() converts by default since Python 3.11
+_DEFAULT_LONG_DIGITS = 4300
+
+def _default_long_digits():
+    # The digits int() converts as the interpreter is set up; 0 is no
+    # limit.  int() has none before Python 3.11, but a LONG is capped
+    # all the same.
+    try:
+        return sys.get_int_max_str_digits()
+    except AttributeError:
+        return _DEFAULT_LONG_DIGITS
+
 class _Unpickler:
 
     def __init__(self, file, *, fix_imports=True,
-                 encoding="ASCII", errors="strict"):
+                 encoding="ASCII", errors="strict", natives=False,
+                 policy=None, text_opcodes=False, deadline=None,
+                 profile=None, bytes_views=False, max_long_digits=None):
         """This takes a binary file for reading a pickle data stream.
 
         The protocol version of the pickle is detected automatically, so
@@ -981,14 +1552,80 @@ class _Unpickler:
         to decode 8-bit string instances pickled by Python 2; these
         default to 'ASCII' and 'strict', respectively. *encoding* can be
         'bytes' to read theses 8-bit string instances as bytes objects.
+
+        If *natives* is True the standard library globals listed in
+        _NATIVE_GLOBALS (OrderedDict, Counter, defaultdict, date,
+        datetime, time, timedelta, Decimal, array, BytesIO and a few
+        builtins) are resolved to checked reconstructors without calling
+        find_class(), so they load even when find_class() refuses all
+        globals.
+
+        *policy* selects a dispatch table compiled for one of the named
+        policies in POLICIES; opcodes the policy forbids are rejected as
+        soon as they are read:
+
+        - "data" allows only opcodes that build plain data: no globals,
+          REDUCE, BUILD, NEWOBJ, OBJ, EXT or persistent ids.
+        - "allowlist" also allows the globals in _NATIVE_GLOBALS, and
+          REDUCE, NEWOBJ and BUILD to apply them.  find_class() is never
+          called.
+        - "full" allows every opcode the unpickler knows.
+
+        The default, None, uses the class dispatch table unchanged.
+
+        If *text_opcodes* is true the protocol 0 and 1 text opcodes LONG,
+        FLOAT, STRING, UNICODE, GET and PUT are accepted too.  Their
+        arguments are capped by text_limits, so the cost of a text pickle
+        stays within a small multiple of its binary equivalent, save
+        LONG's: it is capped at *max_long_digits* digits, a sign and the
+        "L" suffix.  That defaults to sys.get_int_max_str_digits() where
+        it exists and to 4300 before Python 3.11; 0 lifts the cap.  int()
+        still enforces the interpreter's own limit.
+
+        If *deadline*, a time.monotonic() value, is given, load() raises
+        UnpicklingTimeout once the clock passes it.  The clock is read
+        every deadline_interval opcodes and before each opcode in
+        deadline_opcodes, whose cost grows with its argument.
+
+        If *profile*, an OpcodeProfile or AllocationProfile, is given,
+        every opcode handled is recorded in it.  Opcodes are then handled
+        one at a time, without the superinstructions, so that each is
+        counted on its own.
+
+        If *bytes_views* is true BINBYTES, SHORT_BINBYTES and BINBYTES8
+        push memoryviews into the file's buffer rather than bytes; the
+        file must be a MappedFile, like the one load_path() maps.
         """
         self._file_readline = file.readline
         self._file_read = file.read
+        # Runs of scalars are decoded straight from an in-memory buffer
+        if isinstance(file, (io.BytesIO, MappedFile)):
+            self._file_buffer = file
+        else:
+            self._file_buffer = None
         self.memo = {}
         self.encoding = encoding
         self.errors = errors
         self.proto = 0
         self.fix_imports = fix_imports
+        self.natives = natives
+        self.deadline = deadline
+        self.profile = profile
+        self._unframer = None
+        if bytes_views and not isinstance(file, MappedFile):
+            raise ValueError("bytes_views needs a MappedFile")
+        if text_opcodes:
+            if max_long_digits is None:
+                max_long_digits = _default_long_digits()
+            # Room for a sign and the "L" suffix
+            self.text_limits = {**self.text_limits, LONG[0]:
+                                max_long_digits + 2 if max_long_digits
+                                else None}
+        if (policy is not None or text_opcodes or deadline is not None or
+                profile is not None or bytes_views):
+            self.dispatch = _compile_policy(
+                type(self), policy, text_opcodes, deadline is not None,
+                None if profile is None else type(profile), bytes_views)
 
     def load(self):
         """Read a pickled object representation from the open file.
@@ -1000,9 +1637,16 @@ class _Unpickler:
         if not hasattr(self, "_file_read"):
             raise UnpicklingError("Unpickler.__init__() was not called by "
                                   "%s.__init__()" % (self.__class__.__name__,))
-        self._unframer = _Unframer(self._file_read, self._file_readline)
-        self.read = self._unframer.read
-        self.readline = self._unframer.readline
+        if self._unframer is None:
+            self._unframer = _Unframer(self._file_read, self._file_readline,
+                                       file_buffer=self._file_buffer)
+            self.read = self._unframer.read
+            self.readline = self._unframer.readline
+        else:
+            self._unframer.current_frame = None
+        if self.profile is not None:
+            self.read, self.readline = self.profile.counted(
+                self._unframer.read, self._unframer.readline)
         self.metastack = []
         self.stack = []
         self.append = self.stack.append
@@ -1010,15 +1654,64 @@ class _Unpickler:
         read = self.read
         dispatch = self.dispatch
         try:
+            key = read(1)
+            if self.deadline is not None:
+                self.load_until_deadline(key)
             while True:
-                key = read(1)
                 if not key:
                     raise EOFError
                 assert isinstance(key, bytes_types)
-                dispatch[key[0]](self)
+                # A handler that has already read the next opcode, to see
+                # whether it could handle it too, returns it.
+                key = dispatch[key[0]](self) or read(1)
         except _Stop as stopinst:
             return stopinst.value
 
+    # Opcodes run between two readings of the clock when a deadline is set
+    deadline_interval = 1000
+
+    # Opcodes whose cost grows with their argument read the clock first
+    deadline_opcodes = frozenset(code[0] for code in [
+        LONG, LONG4, STRING, BINSTRING, UNICODE, BINUNICODE, BINUNICODE8,
+        BINBYTES, BINBYTES8, APPENDS, SETITEMS, ADDITEMS, FROZENSET])
+
+    def load_until_deadline(self, key):
+        # The load() loop, reading the clock between runs of opcodes.  Like
+        # load() it only ends by raising _Stop or an error.
+        read = self.read
+        dispatch = self.dispatch
+        interval = self.deadline_interval
+        while True:
+            self.check_deadline()
+            for _ in repeat(None, interval):
+                if not key:
+                    raise EOFError
+                assert isinstance(key, bytes_types)
+                key = dispatch[key[0]](self) or read(1)
+
+    def check_deadline(self):
+        if monotonic() > self.deadline:
+            raise UnpicklingTimeout("unpickling deadline exceeded")
+
+    def reset(self, data):
+        """Prepare to load the pickle in data, a bytes-like object.
+
+        The memo is cleared and the file given to __init__ replaced, so
+        that one long-lived unpickler can load many pickles without being
+        set up again for each.  Return self, for u.reset(data).load().
+        """
+        file = io.BytesIO(data)
+        self._file_read = file.read
+        self._file_readline = file.readline
+        self._file_buffer = file
+        unframer = self._unframer
+        if unframer is not None:
+            unframer.file_read = file.read
+            unframer.file_readline = file.readline
+            unframer.file_buffer = self._file_buffer
+        self.memo.clear()
+        return self
+
     # Return a list of items pushed in the stack after last MARK instruction.
     def pop_mark(self):
         items = self.stack
@@ -1031,6 +1724,13 @@ class _Unpickler:
 
     dispatch = {}
 
+    # Superinstructions.  A few opcode pairs dominate typical pickles, such
+    # as a string followed by MEMOIZE, or BININT1 followed by APPEND.  The
+    # handler for the first opcode reads the next opcode; if it is the
+    # expected partner both are handled at once, otherwise the opcode is
+    # returned to load() to be dispatched as usual.  Only opcodes that are
+    # never the last before STOP look ahead, so no byte after STOP is read.
+
     def load_proto(self):
         proto = self.read(1)[0]
         if not LOWEST_PROTOCOL <= proto <= HIGHEST_PROTOCOL:
@@ -1045,23 +1745,6 @@ class _Unpickler:
         self._unframer.load_frame(frame_size)
     dispatch[FRAME[0]] = load_frame
 
-    def load_binpersid(self):
-        pid = self.stack.pop()
-        self.append(self.persistent_load(pid))
-    dispatch[BINPERSID[0]] = load_binpersid
-
-    def load_none(self):
-        self.append(None)
-    dispatch[NONE[0]] = load_none
-
-    def load_false(self):
-        self.append(False)
-    dispatch[NEWFALSE[0]] = load_false
-
-    def load_true(self):
-        self.append(True)
-    dispatch[NEWTRUE[0]] = load_true
-
     def load_int(self):
         data = self.readline()
         # INT is the most expensive opcode to unpickle, an attractive target
@@ -1077,42 +1760,25 @@ class _Unpickler:
 
         if len(data) > 21:
             raise UnpicklingError("INT data is too long to be a valid int()")
+        elif data == b'00\n':
+            val = False
+        elif data == b'01\n':
+            val = True
         else:
             val = int(data, 0)
         self.append(val)
     dispatch[INT[0]] = load_int
 
-    def load_binint(self):
-        self.append(unpack('<i', self.read(4))[0])
-    dispatch[BININT[0]] = load_binint
-
     def load_binint1(self):
-        self.append(self.read(1)[0])
+        value = self.read(1)[0]
+        key = self.read(1)
+        if key == APPEND:
+            self.stack[-1].append(value)
+            return None
+        self.append(value)
+        return key
     dispatch[BININT1[0]] = load_binint1
 
-    def load_binint2(self):
-        self.append(unpack('<H', self.read(2))[0])
-    dispatch[BININT2[0]] = load_binint2
-
-    def load_long1(self):
-        n = self.read(1)[0]
-        data = self.read(n)
-        self.append(decode_long(data))
-    dispatch[LONG1[0]] = load_long1
-
-    def load_long4(self):
-        n, = unpack('<i', self.read(4))
-        if n < 0:
-            # Corrupt or hostile pickle -- we never write one like this
-            raise UnpicklingError("LONG pickle has negative byte count")
-        data = self.read(n)
-        self.append(decode_long(data))
-    dispatch[LONG4[0]] = load_long4
-
-    def load_binfloat(self):
-        self.append(unpack('>d', self.read(8))[0])
-    dispatch[BINFLOAT[0]] = load_binfloat
-
     def _decode_string(self, value):
         # Used to allow strings from Python 2 to be decoded either as
         # bytes or Unicode strings.  This should be used only with the
@@ -1122,113 +1788,21 @@ class _Unpickler:
         else:
             return value.decode(self.encoding, self.errors)
 
-    def load_binstring(self):
-        # Deprecated BINSTRING uses signed 32-bit length
-        len, = unpack('<i', self.read(4))
-        if len < 0:
-            raise UnpicklingError("BINSTRING pickle has negative byte count")
-        data = self.read(len)
-        self.append(self._decode_string(data))
-    dispatch[BINSTRING[0]] = load_binstring
-
-    def load_binbytes(self):
-        len, = unpack('<I', self.read(4))
-        if len > maxsize:
-            raise UnpicklingError("BINBYTES exceeds system's maximum size "
-                                  "of %d bytes" % maxsize)
-        self.append(self.read(len))
-    dispatch[BINBYTES[0]] = load_binbytes
-
-    def load_binunicode(self):
-        len, = unpack('<I', self.read(4))
-        if len > maxsize:
-            raise UnpicklingError("BINUNICODE exceeds system's maximum size "
-                                  "of %d bytes" % maxsize)
-        self.append(str(self.read(len), 'utf-8', 'surrogatepass'))
-    dispatch[BINUNICODE[0]] = load_binunicode
-
-    def load_binunicode8(self):
-        len, = unpack('<Q', self.read(8))
-        if len > maxsize:
-            raise UnpicklingError("BINUNICODE8 exceeds system's maximum size "
-                                  "of %d bytes" % maxsize)
-        self.append(str(self.read(len), 'utf-8', 'surrogatepass'))
-    dispatch[BINUNICODE8[0]] = load_binunicode8
-
-    def load_binbytes8(self):
-        len, = unpack('<Q', self.read(8))
-        if len > maxsize:
-            raise UnpicklingError("BINBYTES8 exceeds system's maximum size "
-                                  "of %d bytes" % maxsize)
-        self.append(self.read(len))
-    dispatch[BINBYTES8[0]] = load_binbytes8
-
-    def load_short_binstring(self):
-        len = self.read(1)[0]
-        data = self.read(len)
-        self.append(self._decode_string(data))
-    dispatch[SHORT_BINSTRING[0]] = load_short_binstring
-
-    def load_short_binbytes(self):
-        len = self.read(1)[0]
-        self.append(self.read(len))
-    dispatch[SHORT_BINBYTES[0]] = load_short_binbytes
-
     def load_short_binunicode(self):
-        len = self.read(1)[0]
-        self.append(str(self.read(len), 'utf-8', 'surrogatepass'))
+        n = self.read(1)[0]
+        value = str(self.read(n), 'utf-8', 'surrogatepass')
+        self.append(value)
+        key = self.read(1)
+        if key == MEMOIZE:
+            memo = self.memo
+            memo[len(memo)] = value
+            return None
+        if key == BINPUT:
+            self.memo[self.read(1)[0]] = value
+            return None
+        return key
     dispatch[SHORT_BINUNICODE[0]] = load_short_binunicode
 
-    def load_tuple(self):
-        items = self.pop_mark()
-        self.append(tuple(items))
-    dispatch[TUPLE[0]] = load_tuple
-
-    def load_empty_tuple(self):
-        self.append(())
-    dispatch[EMPTY_TUPLE[0]] = load_empty_tuple
-
-    def load_tuple1(self):
-        self.stack[-1] = (self.stack[-1],)
-    dispatch[TUPLE1[0]] = load_tuple1
-
-    def load_tuple2(self):
-        self.stack[-2:] = [(self.stack[-2], self.stack[-1])]
-    dispatch[TUPLE2[0]] = load_tuple2
-
-    def load_tuple3(self):
-        self.stack[-3:] = [(self.stack[-3], self.stack[-2], self.stack[-1])]
-    dispatch[TUPLE3[0]] = load_tuple3
-
-    def load_empty_list(self):
-        self.append([])
-    dispatch[EMPTY_LIST[0]] = load_empty_list
-
-    def load_empty_dictionary(self):
-        self.append({})
-    dispatch[EMPTY_DICT[0]] = load_empty_dictionary
-
-    def load_empty_set(self):
-        self.append(set())
-    dispatch[EMPTY_SET[0]] = load_empty_set
-
-    def load_frozenset(self):
-        items = self.pop_mark()
-        self.append(frozenset(items))
-    dispatch[FROZENSET[0]] = load_frozenset
-
-    def load_list(self):
-        items = self.pop_mark()
-        self.append(items)
-    dispatch[LIST[0]] = load_list
-
-    def load_dict(self):
-        items = self.pop_mark()
-        d = {items[i]: items[i+1]
-             for i in range(0, len(items), 2)}
-        self.append(d)
-    dispatch[DICT[0]] = load_dict
-
     # INST and OBJ differ only in how they get a class object.  It's not
     # only sensible to do the rest in a common routine, the two routines
     # previously diverged and grew different bugs.
@@ -1253,43 +1827,11 @@ class _Unpickler:
         self._instantiate(cls, args)
     dispatch[OBJ[0]] = load_obj
 
-    def load_newobj(self):
-        args = self.stack.pop()
-        cls = self.stack.pop()
-        obj = cls.__new__(cls, *args)
-        self.append(obj)
-    dispatch[NEWOBJ[0]] = load_newobj
-
-    def load_newobj_ex(self):
-        kwargs = self.stack.pop()
-        args = self.stack.pop()
-        cls = self.stack.pop()
-        obj = cls.__new__(cls, *args, **kwargs)
-        self.append(obj)
-    dispatch[NEWOBJ_EX[0]] = load_newobj_ex
-
-    def load_stack_global(self):
-        name = self.stack.pop()
-        module = self.stack.pop()
-        if type(name) is not str or type(module) is not str:
-            raise UnpicklingError("STACK_GLOBAL requires str")
-        self.append(self.find_class(module, name))
-    dispatch[STACK_GLOBAL[0]] = load_stack_global
-
-    def load_ext1(self):
-        code = self.read(1)[0]
-        self.get_extension(code)
-    dispatch[EXT1[0]] = load_ext1
-
-    def load_ext2(self):
-        code, = unpack('<H', self.read(2))
-        self.get_extension(code)
-    dispatch[EXT2[0]] = load_ext2
-
-    def load_ext4(self):
-        code, = unpack('<i', self.read(4))
-        self.get_extension(code)
-    dispatch[EXT4[0]] = load_ext4
+    def load_global(self):
+        module = self.readline()[:-1].decode("utf-8")
+        name = self.readline()[:-1].decode("utf-8")
+        self.append(self.lookup_global(module, name))
+    dispatch[GLOBAL[0]] = load_global
 
     def get_extension(self, code):
         nil = []
@@ -1303,10 +1845,26 @@ class _Unpickler:
                 # Corrupt or hostile pickle.
                 raise UnpicklingError("EXT specifies code <= 0")
             raise ValueError("unregistered extension code %d" % code)
-        obj = self.find_class(*key)
+        obj = self.lookup_global(*key)
         _extension_cache[code] = obj
         self.append(obj)
 
+    def lookup_global(self, module, name):
+        if self.natives:
+            native = self.lookup_native(module, name)
+            if native is not None:
+                return native
+        return self.find_class(module, name)
+
+    def lookup_native(self, module, name):
+        key = (module, name)
+        if self.proto < 3 and self.fix_imports:
+            if key in _compat_pickle.NAME_MAPPING:
+                key = _compat_pickle.NAME_MAPPING[key]
+            elif module in _compat_pickle.IMPORT_MAPPING:
+                key = (_compat_pickle.IMPORT_MAPPING[module], name)
+        return _NATIVE_GLOBALS.get(key)
+
     def find_class(self, module, name):
         # Subclasses may override this.
         if self.proto < 3 and self.fix_imports:
@@ -1320,13 +1878,6 @@ class _Unpickler:
         else:
             return getattr(sys.modules[module], name)
 
-    def load_reduce(self):
-        stack = self.stack
-        args = stack.pop()
-        func = stack[-1]
-        stack[-1] = func(*args)
-    dispatch[REDUCE[0]] = load_reduce
-
     def load_pop(self):
         if self.stack:
             del self.stack[-1]
@@ -1334,87 +1885,19 @@ class _Unpickler:
             self.pop_mark()
     dispatch[POP[0]] = load_pop
 
-    def load_pop_mark(self):
-        self.pop_mark()
-    dispatch[POP_MARK[0]] = load_pop_mark
-
-    def load_dup(self):
-        self.append(self.stack[-1])
-    dispatch[DUP[0]] = load_dup
-
     def load_binget(self):
         i = self.read(1)[0]
-        self.append(self.memo[i])
+        value = self.memo[i]
+        key = self.read(1)
+        if key == SETITEM:
+            stack = self.stack
+            k = stack.pop()
+            stack[-1][k] = value
+            return None
+        self.append(value)
+        return key
     dispatch[BINGET[0]] = load_binget
 
-    def load_long_binget(self):
-        i, = unpack('<I', self.read(4))
-        self.append(self.memo[i])
-    dispatch[LONG_BINGET[0]] = load_long_binget
-
-    def load_binput(self):
-        i = self.read(1)[0]
-        if i < 0:
-            raise ValueError("negative BINPUT argument")
-        self.memo[i] = self.stack[-1]
-    dispatch[BINPUT[0]] = load_binput
-
-    def load_long_binput(self):
-        i, = unpack('<I', self.read(4))
-        if i > maxsize:
-            raise ValueError("negative LONG_BINPUT argument")
-        self.memo[i] = self.stack[-1]
-    dispatch[LONG_BINPUT[0]] = load_long_binput
-
-    def load_memoize(self):
-        memo = self.memo
-        memo[len(memo)] = self.stack[-1]
-    dispatch[MEMOIZE[0]] = load_memoize
-
-    def load_append(self):
-        stack = self.stack
-        value = stack.pop()
-        list = stack[-1]
-        list.append(value)
-    dispatch[APPEND[0]] = load_append
-
-    def load_appends(self):
-        items = self.pop_mark()
-        list_obj = self.stack[-1]
-        if isinstance(list_obj, list):
-            list_obj.extend(items)
-        else:
-            append = list_obj.append
-            for item in items:
-                append(item)
-    dispatch[APPENDS[0]] = load_appends
-
-    def load_setitem(self):
-        stack = self.stack
-        value = stack.pop()
-        key = stack.pop()
-        dict = stack[-1]
-        dict[key] = value
-    dispatch[SETITEM[0]] = load_setitem
-
-    def load_setitems(self):
-        items = self.pop_mark()
-        dict = self.stack[-1]
-        for i in range(0, len(items), 2):
-            dict[items[i]] = items[i + 1]
-    dispatch[SETITEMS[0]] = load_setitems
-
-    def load_additems(self):
-        items = self.pop_mark()
-        set_obj = self.stack[-1]
-        if isinstance(set_obj, set):
-            set_obj.update(items)
-        else:
-            add = set_obj.add
-            for item in items:
-                add(item)
-    dispatch[ADDITEMS[0]] = load_additems
-
     def load_build(self):
         stack = self.stack
         state = stack.pop()
@@ -1442,42 +1925,2482 @@ class _Unpickler:
     def load_mark(self):
         self.metastack.append(self.stack)
         self.stack = []
-        self.append = self.stack.append
+        self.append = append = self.stack.append
+        # MARK, a run of scalars, APPENDS is handled here in one go.  The
+        # first other opcode ends the run, and is dispatched by load().
+        src = self._unframer.source()
+        if src is not None:
+            self.load_scalar_run(src)
+        read = self.read
+        scalar = self._MARK_SCALARS.get
+        while True:
+            key = read(1)
+            decode = scalar(key)
+            if decode is None:
+                break
+            size, decode = decode
+            append(decode(read(size)))
+        if key == APPENDS:
+            return self.load_appends()
+        return key
     dispatch[MARK[0]] = load_mark
 
+    # The scalars load_mark() decodes itself after a mark, rather than by
+    # dispatch.  Maps opcode to (argument size, decoder of the argument).
+    _MARK_SCALARS = {
+        BININT1: (1, ord),
+        BININT: (4, lambda arg: unpack('<i', arg)[0]),
+        BININT2: (2, lambda arg: unpack('<H', arg)[0]),
+        BINFLOAT: (8, lambda arg: unpack('>d', arg)[0]),
+        NONE: (0, lambda arg: None),
+        NEWTRUE: (0, lambda arg: True),
+        NEWFALSE: (0, lambda arg: False),
+    }
+
+    # Handlers that replace the class handlers under a policy.
+
+    def load_global_allowlist(self):
+        module = self.readline()[:-1].decode("utf-8")
+        name = self.readline()[:-1].decode("utf-8")
+        self.append(self.allowlisted_global(module, name))
+
+    def load_stack_global_allowlist(self):
+        name = self.stack.pop()
+        module = self.stack.pop()
+        if type(name) is not str or type(module) is not str:
+            raise UnpicklingError("STACK_GLOBAL requires str")
+        self.append(self.allowlisted_global(module, name))
+
+    def allowlisted_global(self, module, name):
+        native = self.lookup_native(module, name)
+        if native is None:
+            raise UnpicklingForbidden("global '%s.%s' is forbidden" %
+                                  (module, name))
+        return native
+
+    # Only plain data exists under the "data" policy, so APPENDS and
+    # ADDITEMS can call the list and set methods directly.
+
+    def load_appends_data(self):
+        items = self.pop_mark()
+        self.stack[-1].extend(items)
+
+    def load_additems_data(self):
+        items = self.pop_mark()
+        self.stack[-1].update(items)
+
+    # Single opcode versions of the superinstructions, for profiling and
+    # deadlines: load_mark() decodes a whole run of scalars and APPENDS
+    # in one call, which neither the clock nor deadline_interval see.
+
+    def load_binint1_single(self):
+        self.append(self.read(1)[0])
+
+    def load_short_binunicode_single(self):
+        n = self.read(1)[0]
+        self.append(str(self.read(n), 'utf-8', 'surrogatepass'))
+
+    def load_binget_single(self):
+        i = self.read(1)[0]
+        self.append(self.memo[i])
+
+    def load_mark_single(self):
+        self.metastack.append(self.stack)
+        self.stack = []
+        self.append = self.stack.append
+
+    single_dispatch = {
+        BININT1[0]: load_binint1_single,
+        SHORT_BINUNICODE[0]: load_short_binunicode_single,
+        BINGET[0]: load_binget_single,
+        MARK[0]: load_mark_single,
+    }
+
+    # Bytes as views into a mapped file, installed by bytes_views=True.
+    # Frames are read in place from a mapped file, so self.read() always
+    # reads straight from it.
+
+    def load_binbytes_view(self):
+        n, = unpack('<I', self.read(4))
+        self.append(self._file_buffer.read_view(n))
+
+    def load_short_binbytes_view(self):
+        n = self.read(1)[0]
+        self.append(self._file_buffer.read_view(n))
+
+    def load_binbytes8_view(self):
+        n, = unpack('<Q', self.read(8))
+        if n > maxsize:
+            raise UnpicklingError("BINBYTES8 exceeds system's maximum size "
+                                  "of %d bytes" % maxsize)
+        self.append(self._file_buffer.read_view(n))
+
+    view_dispatch = {
+        BINBYTES[0]: load_binbytes_view,
+        SHORT_BINBYTES[0]: load_short_binbytes_view,
+        BINBYTES8[0]: load_binbytes8_view,
+    }
+
+    # Legacy text opcodes of protocols 0 and 1, installed by
+    # text_opcodes=True.  Each reads a decimal or quoted argument up to a
+    # newline.  The longest argument accepted, newline excluded, is capped
+    # per opcode: LONG because int() is quadratic in the number of digits,
+    # FLOAT because the longest repr() of a float is 24 bytes, the others
+    # only so that one line can't swallow the whole input.  None lifts the
+    # cap.  __init__() sets LONG's from max_long_digits.
+
+    text_dispatch = {}
+
+    text_limits = {
+        LONG[0]: _DEFAULT_LONG_DIGITS + 2,
+        FLOAT[0]: 32,
+        STRING[0]: 1 << 26,
+        UNICODE[0]: 1 << 26,
+        GET[0]: 20,
+        PUT[0]: 20,
+    }
+
+    def read_text_arg(self, opcode):
+        limit = self.text_limits[opcode[0]]
+        data = self.readline(-1 if limit is None else limit + 1)
+        if data[-1:] != b'\n':
+            if limit is not None and len(data) > limit:
+                raise UnpicklingError("%s argument is longer than %d bytes" %
+                                      (_opcode_names[opcode[0]], limit))
+            raise EOFError
+        return data[:-1]
+
+    def load_long(self):
+        val = self.read_text_arg(LONG)
+        if val and val[-1] == b'L'[0]:
+            val = val[:-1]
+        self.append(int(val, 0))
+    text_dispatch[LONG[0]] = load_long
+
+    def load_float(self):
+        self.append(float(self.read_text_arg(FLOAT)))
+    text_dispatch[FLOAT[0]] = load_float
+
+    def load_string(self):
+        data = self.read_text_arg(STRING)
+        # Strip outermost quotes
+        if len(data) >= 2 and data[0] == data[-1] and data[0] in b'"\'':
+            data = data[1:-1]
+        else:
+            raise UnpicklingError("the STRING opcode argument must be quoted")
+        self.append(self._decode_string(codecs.escape_decode(data)[0]))
+    text_dispatch[STRING[0]] = load_string
+
+    def load_unicode(self):
+        self.append(str(self.read_text_arg(UNICODE), 'raw-unicode-escape'))
+    text_dispatch[UNICODE[0]] = load_unicode
+
+    def load_get(self):
+        i = int(self.read_text_arg(GET))
+        self.append(self.memo[i])
+    text_dispatch[GET[0]] = load_get
+
+    def load_put(self):
+        i = int(self.read_text_arg(PUT))
+        if i < 0:
+            raise ValueError("negative PUT argument")
+        self.memo[i] = self.stack[-1]
+    text_dispatch[PUT[0]] = load_put
+
+    # A list of numbers pickles as MARK, then one fixed width opcode per
+    # item, e.g. BININT ('J' + 4 bytes), then APPENDS.  The items form
+    # fixed stride records that can be decoded with one strided view of
+    # the input, rather than one dispatch per item.  Maps opcode to
+    # (record size, struct format, NumPy dtype).
+    _SCALAR_RUNS = {
+        BININT1[0]: (2, '<xB', 'u1'),
+        BININT2[0]: (3, '<xH', '<u2'),
+        BININT[0]: (5, '<xi', '<i4'),
+        BINFLOAT[0]: (9, '>xd', '>f8'),
+    }
+    _SCALAR_RUN_CHUNK = 1024
+    # Shorter runs, most of them, are decoded without NumPy
+    _SCALAR_RUN_SHORT = 64
+
+    def load_scalar_run(self, src):
+        """Push a run of identical scalar opcodes read from BytesIO src."""
+        extend = self.stack.extend
+        chunk = self._SCALAR_RUN_CHUNK
+        with src.getbuffer() as buf:
+            start = pos = src.tell()
+            if pos >= len(buf):
+                return
+            code = buf[pos]
+            spec = self._SCALAR_RUNS.get(code)
+            if spec is None:
+                return
+            size, fmt, dtype = spec
+            end = pos + (len(buf) - pos) // size * size
+            # NumPy is only worth importing and calling for a long run.
+            # One whose opcode is still there _SCALAR_RUN_SHORT records on
+            # is taken for one; NumPy checks every record all the same.
+            probe = pos + self._SCALAR_RUN_SHORT * size
+            if probe >= end or buf[probe] != code or not _import_numpy():
+                while pos < end and buf[pos] == code:
+                    pos += size
+                extend([v for v, in iter_unpack(fmt, buf[start:pos])])
+            else:
+                numpy = _numpy
+                dtype = numpy.dtype([('op', 'u1'), ('v', dtype)])
+                count = (end - pos) // size
+                while count:
+                    n = min(count, chunk)
+                    records = numpy.frombuffer(buf, dtype, n, pos)
+                    other = numpy.flatnonzero(records['op'] != code)
+                    if other.size:
+                        n = int(other[0])
+                    extend(records['v'][:n].tolist())
+                    del records
+                    pos += n * size
+                    if other.size:
+                        break
+                    count -= n
+        src.seek(pos)
+
     def load_stop(self):
         value = self.stack.pop()
         raise _Stop(value)
     dispatch[STOP[0]] = load_stop
 
+# The handlers shared with picklelite2 are generated from one spec
+pickleengine.install(_Unpickler, globals(), py3=True)
+
+
+# Profiling
+
+class OpcodeProfile:
+    """Opcode statistics gathered by unpicklers given profile=self.
+
+    For each opcode it counts the calls, the time spent in the handler
+    in nanoseconds and the bytes read, opcode included, and keeps the
+    largest stack and memo left behind.  One profile may be shared by
+    many loads.
+    """
+
+    def __init__(self):
+        self.loads = 0
+        self.bytes_read = 0
+        self.counts = [0] * 256
+        self.times = [0] * 256
+        self.sizes = [0] * 256
+        self.max_stack = [0] * 256
+        self.max_memo = [0] * 256
+        self.max_marks = 0
+
+    @staticmethod
+    def instrument(code, handler):
+        """Return handler wrapped to record each call in self.profile."""
+        def load_and_record(self):
+            profile = self.profile
+            consumed = profile.bytes_read
+            start = perf_counter_ns()
+            try:
+                return handler(self)
+            finally:
+                profile.record(code, perf_counter_ns() - start,
+                               profile.bytes_read - consumed, len(self.stack),
+                               len(self.metastack), len(self.memo))
+        return load_and_record
+
+    def counted(self, read, readline):
+        """Return read and readline wrapped to count the bytes read."""
+        self.loads += 1
+        self.load_start = self.bytes_read
+        def counted_read(n):
+            data = read(n)
+            self.bytes_read += len(data)
+            return data
+        def counted_readline(size=-1):
+            data = readline(size)
+            self.bytes_read += len(data)
+            return data
+        return counted_read, counted_readline
+
+    def record(self, code, ns, nbytes, stack, marks, memo):
+        self.counts[code] += 1
+        self.times[code] += ns
+        self.sizes[code] += nbytes + 1
+        if stack > self.max_stack[code]:
+            self.max_stack[code] = stack
+        if memo > self.max_memo[code]:
+            self.max_memo[code] = memo
+        if marks > self.max_marks:
+            self.max_marks = marks
+
+    def as_dict(self):
+        """Return the statistics as a dict of plain values."""
+        opcodes = {}
+        for code in range(256):
+            if self.counts[code]:
+                name = _opcode_names.get(code, "0x%02x" % code)
+                opcodes[name] = {
+                    "count": self.counts[code],
+                    "ns": self.times[code],
+                    "bytes": self.sizes[code],
+                    "max_stack": self.max_stack[code],
+                    "max_memo": self.max_memo[code],
+                }
+        return {
+            "loads": self.loads,
+            "bytes": self.bytes_read,
+            "max_stack": max(self.max_stack),
+            "max_memo": max(self.max_memo),
+            "max_marks": self.max_marks,
+            "opcodes": opcodes,
+        }
+
+    def to_json(self, **kwargs):
+        """Return as_dict() encoded as JSON; kwargs go to json.dumps()."""
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+def _reset_peak():
+    # Make the traced memory now tracemalloc's peak.  Before Python 3.9
+    # that takes a restart, which forgets every trace, so the traced
+    # memory counts from zero again; returns what it was then, else 0.
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+        return 0
+    current = tracemalloc.get_traced_memory()[0]
+    nframe = tracemalloc.get_traceback_limit()
+    tracemalloc.stop()
+    tracemalloc.start(nframe)
+    return current
+
+class AllocationProfile(OpcodeProfile):
+    """Memory allocated by each opcode, measured with tracemalloc.
+
+    For each opcode it sums the net bytes left allocated by its handler,
+    which add up to the memory live at STOP, and keeps the largest rise
+    in traced memory during one call.  The *top* opcodes with the largest
+    rise are kept with their load number and offset in the pickle.
+
+    tracemalloc is started by the first load if it isn't tracing already.
+    It is left running, so call tracemalloc.stop() when done.  Before
+    Python 3.9 tracemalloc is restarted before each opcode instead, and
+    memory allocated before a restart is not seen being freed, so the
+    sums and peak run high.
+    """
+
+    def __init__(self, top=20):
+        super().__init__()
+        self.top = top
+        self.net = [0] * 256
+        self.peaks = [0] * 256
+        self.offsets = []
+        self.live_at_stop = 0
+        self.peak = 0
+        # Traced memory forgotten by restarts of tracemalloc
+        self.untraced = 0
+
+    @staticmethod
+    def instrument(code, handler):
+        def load_and_trace(self):
+            profile = self.profile
+            # The opcode itself has already been read
+            offset = profile.bytes_read - profile.load_start - 1
+            profile.untraced += _reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            try:
+                return handler(self)
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                untraced = profile.untraced
+                profile.trace(code, offset, current - before, peak - before,
+                              untraced + current, untraced + peak)
+        return load_and_trace
+
+    def counted(self, read, readline):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.traced_start = (self.untraced +
+                             tracemalloc.get_traced_memory()[0])
+        return super().counted(read, readline)
+
+    def trace(self, code, offset, net, rise, current, peak):
+        self.counts[code] += 1
+        self.net[code] += net
+        if rise > self.peaks[code]:
+            self.peaks[code] = rise
+        if peak - self.traced_start > self.peak:
+            self.peak = peak - self.traced_start
+        if code == STOP[0]:
+            self.live_at_stop = max(self.live_at_stop,
+                                    current - self.traced_start)
+        entry = (rise, self.loads, offset, code, net)
+        if len(self.offsets) < self.top:
+            heapq.heappush(self.offsets, entry)
+        elif rise > self.offsets[0][0]:
+            heapq.heapreplace(self.offsets, entry)
+
+    def as_dict(self):
+        """Return the statistics as a dict of plain values."""
+        opcodes = {}
+        for code in range(256):
+            if self.counts[code]:
+                name = _opcode_names.get(code, "0x%02x" % code)
+                opcodes[name] = {
+                    "count": self.counts[code],
+                    "net": self.net[code],
+                    "peak": self.peaks[code],
+                }
+        offsets = []
+        for rise, load, offset, code, net in sorted(self.offsets,
+                                                    reverse=True):
+            offsets.append({
+                "load": load,
+                "offset": offset,
+                "opcode": _opcode_names.get(code, "0x%02x" % code),
+                "net": net,
+                "peak": rise,
+            })
+        return {
+            "loads": self.loads,
+            "bytes": self.bytes_read,
+            "live_at_stop": self.live_at_stop,
+            "peak": self.peak,
+            "opcodes": opcodes,
+            "offsets": offsets,
+        }
+
+
+# Metrics
+
+class _MetricsShard:
+    # The part of a Metrics written by one thread.  The lock is only
+    # contended by snapshot(), which copies the shard under it.
+    def __init__(self, nseconds, nsizes):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.seconds = collections.defaultdict(lambda: [0] * nseconds)
+        self.sizes = collections.defaultdict(lambda: [0] * nsizes)
+        self.seconds_sum = collections.Counter()
+        self.sizes_sum = collections.Counter()
+
+    def update(self, other):
+        # Add the counts of other to these
+        self.counters.update(other.counters)
+        for mine, theirs in [(self.seconds, other.seconds),
+                             (self.sizes, other.sizes)]:
+            for op, counts in theirs.items():
+                mine[op] = [a + b for a, b in zip(mine[op], counts)]
+        self.seconds_sum.update(other.seconds_sum)
+        self.sizes_sum.update(other.sizes_sum)
+
+
+class _ShardOwner:
+    # Held by nothing but a thread's Metrics._local, so it dies with the
+    # thread, and its finalizer retires the thread's shard
+    __slots__ = ('__weakref__',)
+
+def _retire_shard(lock, shards, retired, shard):
+    # Fold the shard of a thread that ended into retired
+    with lock:
+        shards.remove(shard)
+        with shard.lock:
+            retired.update(shard)
+
+
+class Metrics:
+    """Process-wide counters and histograms of dump/dumps/load/loads calls.
+
+    Installed by enable_metrics().  Each thread records into its own
+    shard under a lock of its own; snapshot() and to_prometheus() merge
+    copies of them.  The shard of a thread that ends is folded into one
+    total of retired shards.
+
+    For each call kind it counts calls, bytes written or read, objects
+    memoized and failures by reason, and keeps histograms of the time
+    taken and the pickle size.  Failures of loads are classified as
+    "policy" (UnpicklingForbidden), "budget" (UnpicklingTimeout), "eof",
+    "struct" and "invalid" (other UnpicklingErrors); any other exception
+    is classified by its type name.
+    """
+
+    # Upper bounds of the histogram buckets, the last is +Inf
+    seconds_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                       1.0, 5.0)
+    size_buckets = tuple(1 << n for n in range(6, 30, 2))
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = self._new_shard()
+
+    def _new_shard(self):
+        return _MetricsShard(len(self.seconds_buckets) + 1,
+                             len(self.size_buckets) + 1)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+            owner = _ShardOwner()
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(owner, _retire_shard, self._lock, self._shards,
+                             self._retired, shard)
+            self._local.owner = owner
+            self._local.shard = shard
+            return shard
+
+    def record(self, op, seconds, nbytes, objects, error=None):
+        """Record one call of kind op ("dumps", "loads", ...)."""
+        shard = self._shard()
+        counters = shard.counters
+        with shard.lock:
+            counters["calls", op] += 1
+            counters["objects", op] += objects
+            if error is not None:
+                counters["failures", op, _failure_reason(error)] += 1
+            shard.seconds[op][_bucket(self.seconds_buckets, seconds)] += 1
+            shard.seconds_sum[op] += seconds
+            if nbytes is not None:
+                counters["bytes", op] += nbytes
+                shard.sizes[op][_bucket(self.size_buckets, nbytes)] += 1
+                shard.sizes_sum[op] += nbytes
+
+    def observe(self, op, call, owner, size):
+        """Return call(), recording it as op.
+
+        owner is the Pickler or Unpickler whose memo is counted, size a
+        function returning the bytes written or read, or None.
+        """
+        start = perf_counter()
+        try:
+            result = call()
+        except Exception as e:
+            self.record(op, perf_counter() - start, None, len(owner.memo), e)
+            raise
+        self.record(op, perf_counter() - start, size(), len(owner.memo))
+        return result
+
+    def snapshot(self):
+        """Return the merged metrics as a dict of plain values."""
+        counters = collections.Counter()
+        seconds = {}
+        sizes = {}
+        # Under the lock no shard is retired halfway through
+        with self._lock:
+            for shard in self._shards + [self._retired]:
+                with shard.lock:
+                    counters.update(shard.counters)
+                    _merge_histograms(seconds, shard.seconds,
+                                      shard.seconds_sum)
+                    _merge_histograms(sizes, shard.sizes, shard.sizes_sum)
+        snapshot = {"calls": {}, "bytes": {}, "objects": {}, "failures": {}}
+        for key, value in sorted(counters.items()):
+            if key[0] == "failures":
+                snapshot["failures"].setdefault(key[1], {})[key[2]] = value
+            else:
+                snapshot[key[0]][key[1]] = value
+        snapshot["seconds"] = seconds
+        snapshot["size_bytes"] = sizes
+        return snapshot
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, kind, text in [
+                ("calls", "counter", "Calls of dump, dumps, load and loads."),
+                ("bytes", "counter", "Bytes written or read."),
+                ("objects", "counter", "Objects memoized."),
+                ("failures", "counter", "Calls that raised, by reason.")]:
+            metric = "picklelite_%s_total" % name
+            lines.append("# HELP %s %s" % (metric, text))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for op, value in snapshot[name].items():
+                if name == "failures":
+                    for reason, count in value.items():
+                        lines.append('%s{op="%s",reason="%s"} %d' %
+                                     (metric, op, reason, count))
+                else:
+                    lines.append('%s{op="%s"} %d' % (metric, op, value))
+        for name, bounds, text in [
+                ("seconds", self.seconds_buckets, "Time taken per call."),
+                ("size_bytes", self.size_buckets, "Pickle size per call.")]:
+            metric = "picklelite_%s" % name
+            lines.append("# HELP %s %s" % (metric, text))
+            lines.append("# TYPE %s histogram" % metric)
+            for op, histogram in snapshot[name].items():
+                total = 0
+                for bound, count in zip(bounds + ("+Inf",),
+                                        histogram["buckets"]):
+                    total += count
+                    lines.append('%s_bucket{op="%s",le="%s"} %d' %
+                                 (metric, op, bound, total))
+                lines.append('%s_sum{op="%s"} %r' %
+                             (metric, op, histogram["sum"]))
+                lines.append('%s_count{op="%s"} %d' % (metric, op, total))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Atomically write to_prometheus() to the file path.
+
+        The file is written next to path and renamed over it, as the
+        node_exporter textfile collector expects.
+        """
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+
+def _bucket(bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+def _merge_histograms(merged, buckets, sums):
+    for op, counts in buckets.items():
+        histogram = merged.setdefault(
+            op, {"buckets": [0] * len(counts), "sum": 0})
+        histogram["buckets"] = [a + b for a, b in
+                                zip(histogram["buckets"], counts)]
+        histogram["sum"] += sums[op]
+
+def _failure_reason(error):
+    if isinstance(error, UnpicklingForbidden):
+        return "policy"
+    if isinstance(error, UnpicklingTimeout):
+        return "budget"
+    if isinstance(error, EOFError):
+        return "eof"
+    if isinstance(error, struct.error):
+        return "struct"
+    if isinstance(error, UnpicklingError):
+        return "invalid"
+    return type(error).__name__
+
+_metrics = None
+
+def enable_metrics():
+    """Start recording the shorthand calls; return the Metrics."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+def disable_metrics():
+    """Stop recording the shorthand calls."""
+    global _metrics
+    _metrics = None
+
+def get_metrics():
+    """Return the Metrics recording the shorthand calls, or None."""
+    return _metrics
+
+
+# Dispatch policies
+
+# Opcodes that reach code other than the builtin data types
+_CLASS_OPCODES = frozenset(code[0] for code in [
+    GLOBAL, STACK_GLOBAL, REDUCE, BUILD, NEWOBJ, NEWOBJ_EX, OBJ,
+    EXT1, EXT2, EXT4, BINPERSID])
+
+# policy name -> (forbidden opcodes, replacement handlers)
+POLICIES = {
+    "data": (_CLASS_OPCODES, {
+        APPENDS[0]: _Unpickler.load_appends_data,
+        ADDITEMS[0]: _Unpickler.load_additems_data,
+    }),
+    "allowlist": (frozenset(code[0] for code in [
+        NEWOBJ_EX, OBJ, EXT1, EXT2, EXT4, BINPERSID]), {
+        GLOBAL[0]: _Unpickler.load_global_allowlist,
+        STACK_GLOBAL[0]: _Unpickler.load_stack_global_allowlist,
+    }),
+    "full": (frozenset(), {}),
+}
+
+_opcode_names = {value[0]: name for name, value in list(globals().items())
+                 if re.match("[A-Z][A-Z0-9_]+$", name) and
+                 isinstance(value, bytes) and len(value) == 1}
+
+def _forbidden_opcode(code, policy):
+    # A new exception each time: a shared one would keep every
+    # unpickler it was raised in alive through its __traceback__
+    if code in _opcode_names:
+        error = UnpicklingForbidden
+        message = ("opcode %s is forbidden by the %r policy" %
+                   (_opcode_names[code], policy))
+    else:
+        error = UnpicklingError
+        message = "invalid load key, %r." % bytes([code])
+    def load_forbidden(self):
+        raise error(message)
+    return load_forbidden
+
+_compiled_policies = {}
+
+def _deadline_checked(handler):
+    def check_then_load(self):
+        self.check_deadline()
+        return handler(self)
+    return check_then_load
+
+def _compile_policy(cls, policy, text_opcodes=False, timed=False,
+                    profiler=None, views=False):
+    """Return the 256-entry dispatch list of cls under policy.
+
+    With policy None the class dispatch dict is returned instead.  The
+    text opcodes are added if text_opcodes is true, and if timed is true
+    the superinstructions are split and the handlers of
+    cls.deadline_opcodes check the deadline first.  If
+    profiler, a profile class, is given every handler is instrumented by
+    profiler.instrument().  If views is true bytes are read as views.
+    """
+    key = (cls, policy, text_opcodes, timed, profiler, views)
+    table = _compiled_policies.get(key)
+    if table is not None:
+        return table
+    dispatch = dict(cls.dispatch)
+    if text_opcodes:
+        dispatch.update(cls.text_dispatch)
+    if views:
+        dispatch.update(cls.view_dispatch)
+    if policy is not None:
+        try:
+            forbidden, replacements = POLICIES[policy]
+        except KeyError:
+            raise ValueError("unknown unpickling policy: %r" % (policy,))
+        for code in forbidden:
+            dispatch.pop(code, None)
+        for code, handler in replacements.items():
+            if code in dispatch:
+                dispatch[code] = handler
+    if timed:
+        dispatch.update(cls.single_dispatch)
+        for code in cls.deadline_opcodes:
+            if code in dispatch:
+                dispatch[code] = _deadline_checked(dispatch[code])
+    if profiler is not None:
+        dispatch.update(cls.single_dispatch)
+        for code, handler in dispatch.items():
+            dispatch[code] = profiler.instrument(code, handler)
+    if policy is None:
+        table = dispatch
+    else:
+        table = [dispatch.get(code) or _forbidden_opcode(code, policy)
+                 for code in range(256)]
+    _compiled_policies[key] = table
+    return table
+
+# Random access to the elements of a pickled list or dict
+
+# Argument layout of each opcode: a fixed size, a count of the given
+# struct format followed by that many bytes, or a number of lines.
+_ARG_FIXED = {code[0]: size for code, size in [
+    (BININT, 4), (BININT1, 1), (BININT2, 2), (BINFLOAT, 8), (BINGET, 1),
+    (LONG_BINGET, 4), (BINPUT, 1), (LONG_BINPUT, 4), (EXT1, 1), (EXT2, 2),
+    (EXT4, 4), (PROTO, 1), (FRAME, 8)]}
+_ARG_COUNTED = {code[0]: fmt for code, fmt in [
+    (SHORT_BINSTRING, '<B'), (SHORT_BINBYTES, '<B'), (SHORT_BINUNICODE, '<B'),
+    (LONG1, '<B'), (BINSTRING, '<i'), (BINBYTES, '<I'), (BINUNICODE, '<I'),
+    (LONG4, '<i'), (BINBYTES8, '<Q'), (BINUNICODE8, '<Q')]}
+_ARG_LINES = {code[0]: lines for code, lines in [
+    (INT, 1), (LONG, 1), (FLOAT, 1), (STRING, 1), (UNICODE, 1), (GET, 1),
+    (PUT, 1), (PERSID, 1), (GLOBAL, 2), (INST, 2)]}
+
+# Stack effects, as the number of items popped before one is pushed;
+# -1 pops through the topmost mark.  Opcodes that modify the item below
+# what they pop push nothing.
+_PUSHES = {code[0]: npop for code, npop in [
+    (NONE, 0), (NEWTRUE, 0), (NEWFALSE, 0), (INT, 0), (BININT, 0),
+    (BININT1, 0), (BININT2, 0), (LONG, 0), (LONG1, 0), (LONG4, 0),
+    (FLOAT, 0), (BINFLOAT, 0), (STRING, 0), (BINSTRING, 0),
+    (SHORT_BINSTRING, 0), (UNICODE, 0), (BINUNICODE, 0),
+    (SHORT_BINUNICODE, 0), (BINUNICODE8, 0), (BINBYTES, 0),
+    (SHORT_BINBYTES, 0), (BINBYTES8, 0), (EMPTY_TUPLE, 0), (EMPTY_LIST, 0),
+    (EMPTY_DICT, 0), (EMPTY_SET, 0), (GLOBAL, 0), (EXT1, 0), (EXT2, 0),
+    (EXT4, 0), (GET, 0), (BINGET, 0), (LONG_BINGET, 0), (PERSID, 0),
+    (TUPLE1, 1), (TUPLE2, 2), (TUPLE3, 3), (REDUCE, 2), (NEWOBJ, 2),
+    (NEWOBJ_EX, 3), (STACK_GLOBAL, 2), (BINPERSID, 1), (TUPLE, -1),
+    (LIST, -1), (DICT, -1), (FROZENSET, -1), (INST, -1), (OBJ, -1)]}
+_MODIFIES = {code[0]: npop for code, npop in [
+    (APPEND, 1), (SETITEM, 2), (BUILD, 1), (APPENDS, -1), (SETITEMS, -1),
+    (ADDITEMS, -1)]}
+_MEMO_PUTS = frozenset(code[0] for code in [PUT, BINPUT, LONG_BINPUT,
+                                            MEMOIZE])
+_MEMO_GETS = frozenset(code[0] for code in [GET, BINGET, LONG_BINGET])
+
+# What build_index() does for each opcode
+_SCAN_PUSH, _SCAN_MODIFY, _SCAN_MARK, _SCAN_PUT, _SCAN_GET, _SCAN_POP, \
+    _SCAN_POP_MARK, _SCAN_FRAME, _SCAN_PROTO, _SCAN_STOP = range(10)
+
+def _scan_table():
+    # code -> (argument kind, size/Struct/lines, action, items popped)
+    table = [None] * 256
+    for code in range(256):
+        if code in _ARG_FIXED:
+            arg = (0, _ARG_FIXED[code])
+        elif code in _ARG_COUNTED:
+            arg = (1, struct.Struct(_ARG_COUNTED[code]))
+        elif code in _ARG_LINES:
+            arg = (2, _ARG_LINES[code])
+        else:
+            arg = (0, 0)
+        if code in _MEMO_GETS:
+            action = (_SCAN_GET, 0)
+        elif code in _PUSHES:
+            action = (_SCAN_PUSH, _PUSHES[code])
+        elif code in _MODIFIES:
+            action = (_SCAN_MODIFY, _MODIFIES[code])
+        elif code in _MEMO_PUTS:
+            action = (_SCAN_PUT, 0)
+        else:
+            action = {MARK[0]: (_SCAN_MARK, 0), POP[0]: (_SCAN_POP, 0),
+                      POP_MARK[0]: (_SCAN_POP_MARK, 0),
+                      FRAME[0]: (_SCAN_FRAME, 0), PROTO[0]: (_SCAN_PROTO, 0),
+                      STOP[0]: (_SCAN_STOP, 0)}.get(code)
+            if action is None:
+                continue
+        table[code] = arg + action
+    return table
+
+_SCAN = _scan_table()
+
+# The names opcode_table() gives the actions of _SCAN
+_SCAN_EFFECTS = ('push', 'modify', 'mark', 'put', 'get', 'pop', 'pop_mark',
+                 'frame', 'proto', 'stop')
+
+def opcode_table():
+    """Return how loads() reads each opcode, for tools that scan pickles.
+
+    The list holds None for each byte that is no opcode, and for each
+    opcode a tuple (name, argument, effect, pops, batch):
+
+    argument  ('fixed', size), ('counted', Struct of the count that
+              precedes the bytes) or ('lines', number of lines)
+    effect    'push', 'modify' (the item below those popped), 'mark',
+              'put', 'get', 'pop', 'pop_mark', 'frame', 'proto' or 'stop'
+    pops      the number of items popped, -1 for all above the topmost
+              mark
+    batch     right after MARK, 'run' if runs of the opcode are decoded
+              in one go, 'loop' if load_mark() decodes it itself, else
+              None
+    """
+    table = [None] * 256
+    for code, entry in enumerate(_SCAN):
+        if code == DUP[0]:
+            # Left out of _SCAN, as build_index() can't follow it
+            entry = (0, 0, _SCAN_PUSH, 0)
+        elif entry is None:
+            continue
+        kind, arg, action, pops = entry
+        if code in _Unpickler._SCALAR_RUNS:
+            batch = 'run'
+        elif bytes((code,)) in _Unpickler._MARK_SCALARS:
+            batch = 'loop'
+        else:
+            batch = None
+        table[code] = (_opcode_names[code],
+                       (('fixed', 'counted', 'lines')[kind], arg),
+                       _SCAN_EFFECTS[action], pops, batch)
+    return table
+
+def _memo_argument(data, code, pos):
+    # The memo index of a GET or PUT opcode at pos, or None for MEMOIZE
+    if code == MEMOIZE[0]:
+        return None
+    if code in (BINGET[0], BINPUT[0]):
+        return data[pos + 1]
+    if code in (LONG_BINGET[0], LONG_BINPUT[0]):
+        return struct.unpack_from('<I', data, pos + 1)[0]
+    return int(data[pos + 1:data.find(b'\n', pos + 1)])
+
+
+class _SpanMemo(dict):
+    # The memo of one span decoded on its own.  Slots defined before the
+    # span are only filled in as needed, so len() counts them separately
+    # to keep MEMOIZE numbering as in the whole pickle.
+
+    def __init__(self, base):
+        self.base = base
+        self.count = 0
+
+    def __setitem__(self, key, value):
+        if key not in self and key >= self.base:
+            self.count += 1
+        dict.__setitem__(self, key, value)
+
+    def __len__(self):
+        return self.base + self.count
+
+
+def _strip_frames(data, frames, start, end):
+    # data[start:end] without the FRAME opcodes at the offsets in frames
+    first = bisect.bisect_left(frames, start)
+    last = bisect.bisect_left(frames, end)
+    if first == last:
+        return bytes(data[start:end])
+    pieces = []
+    for frame in frames[first:last]:
+        pieces.append(data[start:frame])
+        start = frame + 9
+    pieces.append(data[start:end])
+    return b''.join(pieces)
+
+def _decode_opcodes(proto, opcodes, memo, kwargs):
+    # Run opcodes cut from a pickle of protocol proto, with memo
+    file = io.BytesIO(PROTO + bytes([proto]) + opcodes + STOP)
+    unpickler = _Unpickler(file, **kwargs)
+    unpickler.memo = memo
+    return unpickler.load()
+
+
+class PickleIndex:
+    """Byte spans of the elements of a pickled top-level list or dict.
+
+    Built by build_index(), which scans the pickle once.  The opcodes of
+    each list element, or of each dict key and value, form a span that
+    can be decoded on its own.  Memo slots a span uses but does not
+    define are resolved by decoding the span that defines them first.
+
+    An index is saved next to its pickle with save() and read back with
+    PickleIndex.load().  The same pickle bytes must be passed to the
+    methods that decode.  value() decodes every key once, on its first
+    call, and keeps a map of key to span.
+    """
+
+    _spans = None
+
+    def __init__(self, kind, proto, starts, ends, bases, deps, defs, frames):
+        self.kind = kind        # 'list' or 'dict'
+        self.proto = proto
+        self.starts = starts    # span i is data[starts[i]:ends[i]]
+        self.ends = ends
+        self.bases = bases      # len(memo) at the start of each span
+        self.deps = deps        # memo slots each span uses from others
+        self.defs = defs        # slot in deps -> defining span, or -1
+        self.frames = frames    # offsets of the FRAME opcodes
+
+    def __len__(self):
+        if self.kind == 'dict':
+            return len(self.starts) // 2
+        return len(self.starts)
+
+    def span_bytes(self, data, i):
+        """Return the opcodes of span i without any FRAME opcodes."""
+        return _strip_frames(data, self.frames, self.starts[i],
+                             self.ends[i])
+
+    def decode_span(self, data, i, cache, outer=None, **kwargs):
+        """Decode span i, using and filling cache, a dict of span number
+        to (object, memo) for spans already decoded.
+
+        outer stands in for memo slots defined outside every span, i.e.
+        the container itself; kwargs are passed to the Unpickler.
+        """
+        # Spans only depend on earlier ones, so the worklist ends
+        todo = [i]
+        while todo:
+            j = todo[-1]
+            if j in cache:
+                todo.pop()
+                continue
+            needed = [k for k in map(self.defs.get, self.deps[j])
+                      if k is not None and k >= 0 and k not in cache]
+            if needed:
+                todo.extend(needed)
+                continue
+            todo.pop()
+            memo = _SpanMemo(self.bases[j])
+            for slot in self.deps[j]:
+                k = self.defs.get(slot, -1)
+                if k >= 0:
+                    value = cache[k][1][slot]
+                elif outer is not None:
+                    value = outer
+                else:
+                    raise UnpicklingError("span %d refers to memo slot %d, "
+                                          "which no element defines" %
+                                          (j, slot))
+                dict.__setitem__(memo, slot, value)
+            value = _decode_opcodes(self.proto, self.span_bytes(data, j),
+                                    memo, kwargs)
+            cache[j] = (value, memo)
+        return cache[i][0]
+
+    def element(self, data, n, **kwargs):
+        """Return element n of the list in data."""
+        if self.kind != 'list':
+            raise TypeError("the pickle holds a dict, not a list")
+        return self.decode_span(data, range(len(self.starts))[n], {},
+                                **kwargs)
+
+    def keys(self, data, **kwargs):
+        """Return the keys of the dict in data, in pickled order."""
+        if self.kind != 'dict':
+            raise TypeError("the pickle holds a list, not a dict")
+        cache = {}
+        return [self.decode_span(data, i, cache, **kwargs)
+                for i in range(0, len(self.starts), 2)]
+
+    def _key_spans(self, data, kwargs):
+        # key -> span of its value; a repeated key keeps its last value
+        if self._spans is None:
+            if self.kind != 'dict':
+                raise TypeError("the pickle holds a list, not a dict")
+            cache = {}
+            self._spans = {self.decode_span(data, i, cache, **kwargs): i + 1
+                           for i in range(0, len(self.starts), 2)}
+        return self._spans
+
+    def value(self, data, key, **kwargs):
+        """Return the value of key in the dict in data."""
+        return self.decode_span(data, self._key_spans(data, kwargs)[key], {},
+                                **kwargs)
+
+    def save(self, path):
+        """Write the index to path, as a pickle of plain data."""
+        with open(path, 'wb') as f:
+            _dump((self.kind, self.proto, self.starts, self.ends, self.bases,
+                   self.deps, self.defs, self.frames), f, HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save()."""
+        with open(path, 'rb') as f:
+            return cls(*_load(f, policy='data'))
+
+
+def build_index(data):
+    """Scan the protocol 2+ pickle in data and return its PickleIndex.
+
+    data is any bytes-like object with find(), e.g. bytes or a mmap.  The
+    pickle must hold a list or dict built with APPEND(S) or SETITEM(S),
+    itself, not inside a tuple or any other object.
+    """
+    view = memoryview(data)
+    end_of_data = len(view)
+    table = _SCAN
+    proto = 0
+    kind = None
+    root = object()     # the stack entry of the list or dict indexed
+    stack = []          # offset where each item on the stack starts
+    metastack = []      # (stack, offset) of each mark
+    defs = {}           # memo slot -> offset of its definition
+    uses = []           # (offset, slot) of each memo reference
+    frames = []
+    starts, ends = [], []
+    pos = 0
+    while True:
+        if pos >= end_of_data:
+            raise EOFError
+        code = view[pos]
+        entry = table[code]
+        if entry is None:
+            raise UnpicklingError("can't index a pickle using opcode %s" %
+                                  _opcode_names.get(code, repr(code)))
+        argkind, arg, action, npop = entry
+        if argkind == 0:
+            end = pos + 1 + arg
+        elif argkind == 1:
+            n, = arg.unpack_from(data, pos + 1)
+            if n < 0:
+                raise UnpicklingError("negative byte count at offset %d" %
+                                      pos)
+            end = pos + 1 + arg.size + n
+        else:
+            end = pos + 1
+            for _ in range(arg):
+                end = data.find(b'\n', end) + 1
+                if not end:
+                    raise UnpicklingError("unterminated line at offset %d"
+                                          % pos)
+        if action == _SCAN_PUSH:
+            if npop < 0:
+                stack, item = metastack.pop()
+            elif npop:
+                item = stack[-npop]
+                if item is root:
+                    # Wrapped, e.g. by TUPLE1: not what STOP returns
+                    item = pos
+                del stack[-npop:]
+            else:
+                item = pos
+                if kind is None and not stack and not metastack:
+                    kind = {EMPTY_LIST[0]: 'list',
+                            EMPTY_DICT[0]: 'dict'}.get(code, 'other')
+                    item = root
+            stack.append(item)
+        elif action == _SCAN_PUT:
+            slot = _memo_argument(data, code, pos)
+            defs[len(defs) if slot is None else slot] = pos
+        elif action == _SCAN_MARK:
+            metastack.append((stack, pos))
+            stack = []
+        elif action == _SCAN_MODIFY:
+            if npop < 0:
+                items = stack
+                stack, _ = metastack.pop()
+            else:
+                items = stack[-npop:]
+                del stack[-npop:]
+            if not metastack and len(stack) == 1 and code != BUILD[0]:
+                starts.extend(items)
+                ends.extend(items[1:])
+                ends.append(pos)
+        elif action == _SCAN_GET:
+            uses.append((pos, _memo_argument(data, code, pos)))
+            stack.append(pos)
+        elif action == _SCAN_POP:
+            stack.pop()
+        elif action == _SCAN_POP_MARK:
+            stack, _ = metastack.pop()
+        elif action == _SCAN_FRAME:
+            frames.append(pos)
+        elif action == _SCAN_PROTO:
+            proto = view[pos + 1]
+        else:
+            if metastack or len(stack) != 1 or stack[0] is not root:
+                kind = None
+            break
+        pos = end
+    if kind not in ('list', 'dict') or proto < 2:
+        raise UnpicklingError("the pickle must hold a protocol 2+ list or "
+                              "dict")
+    # len(memo) at the start of each span
+    offsets = sorted(defs.values())
+    bases = [bisect.bisect_left(offsets, start) for start in starts]
+    # A memo reference is to another span if the slot was defined before
+    # the span started; only those slots need their span looked up
+    deps = [[] for _ in starts]
+    span_of = {}
+    i = 0
+    for offset, slot in uses:
+        while i < len(starts) and ends[i] <= offset:
+            i += 1
+        if i == len(starts):
+            break
+        if starts[i] <= offset and defs[slot] < starts[i]:
+            if slot not in deps[i]:
+                deps[i].append(slot)
+            if slot not in span_of:
+                j = bisect.bisect_right(starts, defs[slot]) - 1
+                span_of[slot] = j if j >= 0 and defs[slot] < ends[j] else -1
+    return PickleIndex(kind, proto, starts, ends, bases, deps, span_of,
+                       frames)
+
+
+class _LazyContainer:
+    # Shared by LazyList and LazyDict: elements are decoded from their
+    # spans on first access, and kept with their memos for later ones.
+
+    def __init__(self, data, index, kwargs):
+        self._data = data
+        self._index = index
+        self._kwargs = kwargs
+        self._cache = {}
+
+    def _decode(self, i):
+        return self._index.decode_span(self._data, i, self._cache, self,
+                                       **self._kwargs)
+
+    def materialize(self):
+        """Return the whole object, decoded eagerly as loads() would."""
+        return _loads(self._data, **self._kwargs)
+
+    def __repr__(self):
+        return "<%s of %d items, %d spans decoded>" % (
+            type(self).__name__, len(self), len(self._cache))
+
+
+class LazyList(_LazyContainer, collections.abc.Sequence):
+    """A read-only list whose elements are decoded on first access."""
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self._decode(i) for i in range(len(self))[n]]
+        return self._decode(range(len(self))[n])
+
+
+class LazyDict(_LazyContainer, collections.abc.Mapping):
+    """A read-only dict whose values are decoded on first access.
+
+    All keys are decoded together, on the first access that needs them.
+    """
+
+    _spans = None
+
+    def _key_spans(self):
+        # key -> span of its value; a repeated key keeps its last value
+        if self._spans is None:
+            self._spans = {self._decode(i): i + 1
+                           for i in range(0, len(self._index.starts), 2)}
+        return self._spans
+
+    def __len__(self):
+        return len(self._key_spans())
+
+    def __iter__(self):
+        return iter(self._key_spans())
+
+    def __getitem__(self, key):
+        return self._decode(self._key_spans()[key])
+
+
+def loads_lazy(data, *, index=None, **kwargs):
+    """Return the object pickled in data, decoding it on demand.
+
+    A top-level list or dict comes back as a LazyList or LazyDict whose
+    elements are decoded on first access.  Elements referring to the
+    container itself see the proxy.  Any other object is decoded at
+    once.  index may be a PickleIndex of data built earlier; kwargs are
+    passed to the Unpickler.
+    """
+    if index is None:
+        try:
+            index = build_index(data)
+        except UnpicklingError:
+            return _loads(data, **kwargs)
+    if index.kind == 'dict':
+        return LazyDict(data, index, kwargs)
+    return LazyList(data, index, kwargs)
+
+
+# Decoding one path through a pickle
+
+# Opcodes that make objects no later opcode can change
+_IMMUTABLE_MAKERS = frozenset(code[0] for code in [
+    NONE, NEWTRUE, NEWFALSE, INT, BININT, BININT1, BININT2, LONG, LONG1,
+    LONG4, FLOAT, BINFLOAT, STRING, BINSTRING, SHORT_BINSTRING, UNICODE,
+    BINUNICODE, SHORT_BINUNICODE, BINUNICODE8, BINBYTES, SHORT_BINBYTES,
+    BINBYTES8, EMPTY_TUPLE, TUPLE1, TUPLE2, TUPLE3, TUPLE, FROZENSET])
+
+def _opcode_end(data, entry, pos):
+    # The offset after the opcode at pos, whose _SCAN entry is entry
+    argkind, arg = entry[0], entry[1]
+    if argkind == 0:
+        return pos + 1 + arg
+    if argkind == 1:
+        n, = arg.unpack_from(data, pos + 1)
+        if n < 0:
+            raise UnpicklingError("negative byte count at offset %d" % pos)
+        return pos + 1 + arg.size + n
+    end = pos + 1
+    for _ in range(arg):
+        end = data.find(b'\n', end) + 1
+        if not end:
+            raise UnpicklingError("unterminated line at offset %d" % pos)
+    return end
+
+def _skip_table():
+    # code -> size of opcodes whose only effect within a skipped mark is
+    # their size, else 0
+    table = [0] * 256
+    for code, entry in enumerate(_SCAN):
+        if (entry is not None and entry[0] == 0 and entry[3] >= 0 and
+                entry[2] in (_SCAN_PUSH, _SCAN_MODIFY, _SCAN_GET,
+                             _SCAN_POP)):
+            table[code] = 1 + entry[1]
+    return table
+
+_SKIP = _skip_table()
+
+def _scan_entry(code):
+    entry = _SCAN[code]
+    if entry is None:
+        raise UnpicklingError("can't decode a path using opcode %s" %
+                              _opcode_names.get(code, repr(code)))
+    return entry
+
+
+class _PathDecoder:
+    # Finds the span of each object along a path by scanning, and
+    # decodes only the last one.  Memo slots it refers to are decoded
+    # from the spans of the objects that were put there, on demand.
+    #
+    # Items on the scanned stack are the offsets where they start,
+    # inverted (~offset) if they were made from items popped, e.g. by
+    # TUPLE2, so that the opcode at the offset doesn't tell their type.
+
+    def __init__(self, data, kwargs):
+        self.data = data
+        self.view = memoryview(data)
+        self.kwargs = kwargs
+        self.proto = 0
+        self.frames = []
+        self.puts = []      # offsets of the memo puts, in order
+        self.objects = []   # item each of them put in the memo, or None
+        self.skipped = []   # offsets of the marks skipped over
+        self.defs = None    # memo slot -> index in puts, made on demand
+        self.values = {}    # memo slot -> object decoded for it
+
+    def load(self, path):
+        view = self.view
+        if len(view) < 3 or view[0] != PROTO[0] or view[1] < 2:
+            return self.follow(_loads(self.data, **self.kwargs), path)
+        self.proto = view[1]
+        item, end = 2, None
+        if view[item] == FRAME[0]:
+            self.frames.append(item)
+            item += 9
+        if item >= len(view):
+            raise EOFError
+        for n, key in enumerate(path):
+            span = self.find(item, end, key) if item >= 0 else None
+            if span is None:
+                return self.follow(self.decode(item, end), path[n:])
+            item, end = span
+        return self.decode(item, end)
+
+    @staticmethod
+    def follow(value, path):
+        for key in path:
+            value = value[key]
+        return value
+
+    def find(self, start, end, key):
+        # The (item, end) of element key of the list or dict made by the
+        # opcode at start, or None if it is made some other way.  end is
+        # None for the whole pickle, which is scanned to its STOP to
+        # record where each memo slot is defined.
+        data, view = self.data, self.view
+        kind = view[start]
+        if kind == EMPTY_LIST[0]:
+            if type(key) is not int:
+                return None
+            elements = [] if key < 0 else None
+        elif kind == EMPTY_DICT[0]:
+            elements = None
+        else:
+            return None
+        whole = end is None
+        table = _SCAN
+        puts, objects = self.puts, self.objects
+        stack = []
+        metastack = []
+        count = 0
+        found = None
+        pos = start
+        try:
+            while pos != end:
+                code = view[pos]
+                entry = table[code] or _scan_entry(code)
+                argkind, arg, action, npop = entry
+                if argkind == 0:
+                    next_pos = pos + 1 + arg
+                elif argkind == 1:
+                    n = arg.unpack_from(data, pos + 1)[0]
+                    if n < 0:
+                        raise UnpicklingError("negative byte count at "
+                                              "offset %d" % pos)
+                    next_pos = pos + 1 + arg.size + n
+                else:
+                    next_pos = _opcode_end(data, entry, pos)
+                if action == _SCAN_PUSH:
+                    if npop < 0:
+                        stack, item = metastack.pop()
+                        stack.append(~item)
+                    elif npop:
+                        if not metastack and npop >= len(stack):
+                            return None
+                        item = stack[-npop]
+                        del stack[-npop:]
+                        stack.append(item if item < 0 else ~item)
+                    else:
+                        stack.append(pos)
+                elif action == _SCAN_MODIFY:
+                    if npop < 0:
+                        popped = stack
+                        stack, _ = metastack.pop()
+                    else:
+                        popped = stack[len(stack) - npop:]
+                        del stack[len(stack) - npop:]
+                    if not metastack and len(stack) == 1:
+                        if code == BUILD[0] or code == ADDITEMS[0]:
+                            return None
+                        starts = [item if item >= 0 else ~item
+                                  for item in popped]
+                        ends = starts[1:]
+                        ends.append(pos)
+                        if kind == EMPTY_DICT[0]:
+                            for i in range(0, len(popped) - 1, 2):
+                                if self.key(starts[i], ends[i]) == key:
+                                    found = (popped[i + 1], ends[i + 1])
+                        elif elements is not None:
+                            elements.extend(zip(popped, ends))
+                        elif found is None and count + len(popped) > key:
+                            i = key - count
+                            found = (popped[i], ends[i])
+                            if not whole:
+                                break
+                        count += len(popped)
+                elif action == _SCAN_GET:
+                    stack.append(pos)
+                elif action == _SCAN_PUT:
+                    if whole:
+                        puts.append(pos)
+                        objects.append(stack[-1])
+                elif action == _SCAN_MARK:
+                    metastack.append((stack, pos))
+                    stack = []
+                    if len(metastack) > 1:
+                        # Nothing in here can be an element: skip to its end
+                        next_pos = self.skip(pos, whole)
+                elif action == _SCAN_POP:
+                    stack.pop()
+                    if not metastack and not stack:
+                        return None
+                elif action == _SCAN_POP_MARK:
+                    stack, _ = metastack.pop()
+                elif action == _SCAN_FRAME:
+                    if whole:
+                        self.frames.append(pos)
+                elif action == _SCAN_STOP:
+                    break
+                else:
+                    raise UnpicklingError("unexpected PROTO at offset %d" %
+                                          pos)
+                pos = next_pos
+        except (IndexError, struct.error):
+            if pos >= len(view) - 1:
+                raise EOFError from None
+            raise UnpicklingError("unbalanced stack at offset %d" % pos) \
+                from None
+        if elements is not None:
+            if -key <= len(elements):
+                found = elements[key]
+        if found is None:
+            if kind == EMPTY_DICT[0]:
+                raise KeyError(key)
+            raise IndexError("list index out of range")
+        return found
+
+    def skip(self, pos, record):
+        # The offset of the opcode that pops the MARK at pos.  The memo
+        # puts and frames skipped over are noted if record is true.
+        data, view = self.data, self.view
+        sizes = _SKIP
+        puts, objects = self.puts, self.objects
+        if record:
+            self.skipped.append(pos)
+        depth = 0
+        try:
+            while True:
+                code = view[pos]
+                size = sizes[code]
+                if size:
+                    pos += size
+                    continue
+                if code == SHORT_BINUNICODE[0]:
+                    pos += 2 + view[pos + 1]
+                    continue
+                entry = _scan_entry(code)
+                action = entry[2]
+                if action == _SCAN_MARK:
+                    depth += 1
+                elif (entry[3] < 0 and action in (_SCAN_PUSH,
+                                                  _SCAN_MODIFY) or
+                      action == _SCAN_POP_MARK):
+                    depth -= 1
+                    if not depth:
+                        return pos
+                elif action == _SCAN_PUT:
+                    if record:
+                        puts.append(pos)
+                        objects.append(None)
+                elif action == _SCAN_FRAME:
+                    if record:
+                        self.frames.append(pos)
+                elif action in (_SCAN_STOP, _SCAN_PROTO):
+                    raise UnpicklingError("unexpected %s at offset %d" %
+                                          (_opcode_names[code], pos))
+                pos = _opcode_end(data, entry, pos)
+        except (IndexError, struct.error):
+            raise EOFError from None
+
+    def object_start(self, put):
+        # Where the object put in the memo at put, in a skipped mark,
+        # starts
+        data, view = self.data, self.view
+        pos = self.skipped[bisect.bisect_right(self.skipped, put) - 1]
+        stack = []
+        metastack = []
+        while pos != put:
+            entry = _scan_entry(view[pos])
+            action, npop = entry[2], entry[3]
+            if action == _SCAN_PUSH or action == _SCAN_GET:
+                if npop < 0:
+                    stack, item = metastack.pop()
+                elif npop:
+                    item = stack[-npop]
+                    del stack[-npop:]
+                else:
+                    item = pos
+                stack.append(item)
+            elif action == _SCAN_MODIFY:
+                if npop < 0:
+                    stack, _ = metastack.pop()
+                else:
+                    del stack[len(stack) - npop:]
+            elif action == _SCAN_MARK:
+                metastack.append((stack, pos))
+                stack = []
+            elif action == _SCAN_POP:
+                stack.pop()
+            elif action == _SCAN_POP_MARK:
+                stack, _ = metastack.pop()
+            pos = _opcode_end(data, entry, pos)
+        return stack[-1]
+
+    def key(self, start, end):
+        # Decode a dict key, taking a short cut for plain str keys
+        view = self.view
+        code = view[start]
+        if code == SHORT_BINUNICODE[0]:
+            first = start + 2
+            last = first + view[start + 1]
+        elif code == BINUNICODE[0]:
+            first = start + 5
+            last = first + struct.unpack_from('<I', view, start + 1)[0]
+        else:
+            return self.decode(start, end)
+        if last != end and (view[last] not in _MEMO_PUTS or
+                            _opcode_end(self.data, _SCAN[view[last]],
+                                        last) != end):
+            return self.decode(start, end)
+        return str(view[first:last], 'utf-8', 'surrogatepass')
+
+    def decode(self, item, end):
+        # Decode the item on the scanned stack that spans up to end, or
+        # the whole pickle if end is None
+        if end is None:
+            return _loads(self.data, **self.kwargs)
+        start = item if item >= 0 else ~item
+        return self.decode_span(start, end)[0]
+
+    def slot_defs(self):
+        # memo slot -> index of its put, on first use
+        if self.defs is None:
+            self.defs = {}
+            for i, pos in enumerate(self.puts):
+                slot = _memo_argument(self.data, self.view[pos], pos)
+                self.defs[len(self.defs) if slot is None else slot] = i
+        return self.defs
+
+    def decode_span(self, start, end):
+        # Decode data[start:end], which makes one object, and return it
+        # with its memo
+        data, view = self.data, self.view
+        memo = _SpanMemo(bisect.bisect_left(self.puts, start))
+        pos = start
+        while pos < end:
+            code = view[pos]
+            entry = _scan_entry(code)
+            if entry[2] == _SCAN_GET:
+                slot = _memo_argument(data, code, pos)
+                defs = self.slot_defs()
+                if slot in defs and self.puts[defs[slot]] < start:
+                    dict.__setitem__(memo, slot, self.value(slot))
+            pos = _opcode_end(data, entry, pos)
+        value = _decode_opcodes(self.proto,
+                                _strip_frames(data, self.frames, start, end),
+                                memo, self.kwargs)
+        return value, memo
+
+    def value(self, slot):
+        # The object put in memo slot, decoded from the opcodes that make
+        # it and any that change it later
+        if slot not in self.values:
+            i = self.defs[slot]
+            put, start = self.puts[i], self.objects[i]
+            if start is None:
+                start = self.object_start(put)
+            elif start < 0:
+                start = ~start
+            value, memo = self.decode_span(start, self.object_end(start, put))
+            for known, obj in memo.items():
+                self.values.setdefault(known, obj)
+        return self.values[slot]
+
+    def object_end(self, start, put):
+        # Where the opcodes for the object made from start and put in the
+        # memo at put end: right after the put if it can't change, or
+        # after the last opcode that changes it before it is popped
+        data, view = self.data, self.view
+        count = 0           # items since start or the last mark
+        marks = []
+        maker = None
+        end = None
+        pos = start
+        while True:
+            code = view[pos]
+            entry = _scan_entry(code)
+            next_pos = _opcode_end(data, entry, pos)
+            action, npop = entry[2], entry[3]
+            if end is not None and not marks:
+                # Stop at anything that pops the object
+                if (action == _SCAN_PUSH and (npop < 0 or npop >= count) or
+                        action == _SCAN_MODIFY and (npop < 0 or
+                                                    npop >= count) or
+                        action == _SCAN_POP and count == 1 or
+                        action in (_SCAN_POP_MARK, _SCAN_STOP)):
+                    return end
+            if action == _SCAN_PUSH or action == _SCAN_GET:
+                if npop < 0:
+                    count = marks.pop() + 1
+                else:
+                    count += 1 - npop
+                if not marks and count == 1:
+                    maker = code
+            elif action == _SCAN_MODIFY:
+                count = marks.pop() if npop < 0 else count - npop
+                if end is not None and not marks and count == 1:
+                    end = next_pos
+            elif action == _SCAN_MARK:
+                marks.append(count)
+                count = 0
+            elif action == _SCAN_POP:
+                count -= 1
+            elif action == _SCAN_POP_MARK:
+                count = marks.pop()
+            if pos == put:
+                end = next_pos
+                if maker in _IMMUTABLE_MAKERS:
+                    return end
+            pos = next_pos
+
+
+def loads_path(data, path, **kwargs):
+    """Return the object at path in the pickle in data.
+
+    loads_path(data, ("users", 3, "email")) returns what
+    loads(data)["users"][3]["email"] would, but only decodes that email:
+    the lists and dicts along the path are scanned for the element wanted
+    and everything else is skipped.  Memo references into skipped parts
+    are decoded from the opcodes that made them.  Objects on the path
+    that aren't plain lists and dicts, and pickles before protocol 2, are
+    decoded whole.  kwargs are passed to the Unpickler.
+    """
+    return _PathDecoder(data, kwargs).load(tuple(path))
+
 
 # Shorthands
 
-def _dump(obj, file, protocol=None, *, fix_imports=True):
-    _Pickler(file, protocol, fix_imports=fix_imports).dump(obj)
+def _tell(file):
+    # The position of file, or None if it can't tell
+    try:
+        return file.tell()
+    except (AttributeError, OSError):
+        return None
+
+def _observe_file(metrics, op, call, owner, file):
+    start = _tell(file)
+    def size():
+        end = _tell(file)
+        return None if start is None or end is None else end - start
+    return metrics.observe(op, call, owner, size)
+
+def _dump(obj, file, protocol=None, *, fix_imports=True, canonical=False,
+          elide_memo=False, dedup=False):
+    pickler = _Pickler(file, protocol, fix_imports=fix_imports,
+                       canonical=canonical, elide_memo=elide_memo,
+                       dedup=dedup)
+    metrics = _metrics
+    if metrics is None:
+        pickler.dump(obj)
+    else:
+        _observe_file(metrics, "dump", partial(pickler.dump, obj), pickler,
+                      file)
 
-def _dumps(obj, protocol=None, *, fix_imports=True):
+def _dumps(obj, protocol=None, *, fix_imports=True, canonical=False,
+           elide_memo=False, dedup=False):
     f = io.BytesIO()
-    _Pickler(f, protocol, fix_imports=fix_imports).dump(obj)
+    pickler = _Pickler(f, protocol, fix_imports=fix_imports,
+                       canonical=canonical, elide_memo=elide_memo,
+                       dedup=dedup)
+    metrics = _metrics
+    if metrics is None:
+        pickler.dump(obj)
+    else:
+        metrics.observe("dumps", partial(pickler.dump, obj), pickler, f.tell)
     res = f.getvalue()
     assert isinstance(res, bytes_types)
     return res
 
-def _load(file, *, fix_imports=True, encoding="ASCII", errors="strict"):
-    return _Unpickler(file, fix_imports=fix_imports,
-                     encoding=encoding, errors=errors).load()
-
-def _loads(s, *, fix_imports=True, encoding="ASCII", errors="strict"):
+def dumps_canonical(obj, protocol=None, *, fix_imports=True):
+    """Return (pickle, hexdigest) for the canonical pickle of obj."""
+    f = io.BytesIO()
+    p = _Pickler(f, protocol, fix_imports=fix_imports, canonical=True)
+    p.dump(obj)
+    return f.getvalue(), p.hexdigest()
+
+def _load(file, *, fix_imports=True, encoding="ASCII", errors="strict",
+          natives=False, policy=None, text_opcodes=False, deadline=None,
+          profile=None, max_long_digits=None):
+    unpickler = _Unpickler(file, fix_imports=fix_imports, encoding=encoding,
+                           errors=errors, natives=natives, policy=policy,
+                           text_opcodes=text_opcodes, deadline=deadline,
+                           profile=profile, max_long_digits=max_long_digits)
+    metrics = _metrics
+    if metrics is None:
+        return unpickler.load()
+    return _observe_file(metrics, "load", unpickler.load, unpickler, file)
+
+def _loads(s, *, fix_imports=True, encoding="ASCII", errors="strict",
+           natives=False, policy=None, text_opcodes=False, deadline=None,
+           profile=None, max_long_digits=None):
     if isinstance(s, str):
         raise TypeError("Can't load pickle from unicode string")
     file = io.BytesIO(s)
-    return _Unpickler(file, fix_imports=fix_imports,
-                      encoding=encoding, errors=errors).load()
+    unpickler = _Unpickler(file, fix_imports=fix_imports, encoding=encoding,
+                           errors=errors, natives=natives, policy=policy,
+                           text_opcodes=text_opcodes, deadline=deadline,
+                           profile=profile, max_long_digits=max_long_digits)
+    metrics = _metrics
+    if metrics is None:
+        return unpickler.load()
+    return metrics.observe("loads", unpickler.load, unpickler,
+                           partial(len, s))
+
+def load_path(path, *, fix_imports=True, encoding="ASCII", errors="strict",
+              natives=False, policy=None, text_opcodes=False, deadline=None,
+              profile=None, bytes_views=False, max_long_digits=None):
+    """Load the pickle in the file at path through a memory map.
+
+    Nothing is read into memory up front and frames are not copied.  If
+    bytes_views is true bytes objects are returned as read-only
+    memoryviews into the mapping, which stays open while any of them
+    is alive.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise EOFError
+        file = MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(file, 'madvise'):
+        file.madvise(mmap.MADV_SEQUENTIAL)
+    unpickler = _Unpickler(file, fix_imports=fix_imports, encoding=encoding,
+                           errors=errors, natives=natives, policy=policy,
+                           text_opcodes=text_opcodes, deadline=deadline,
+                           profile=profile, bytes_views=bytes_views,
+                           max_long_digits=max_long_digits)
+    metrics = _metrics
+    try:
+        if metrics is None:
+            return unpickler.load()
+        return metrics.observe("load_path", unpickler.load, unpickler,
+                               file.tell)
+    finally:
+        if not bytes_views:
+            file.close()
+
+# Magic number -> reader of the decompressed stream, for load_compressed()
+_COMPRESSED_FORMATS = []
+if lzma is not None:
+    _COMPRESSED_FORMATS.append((b'\xfd7zXZ\x00', lzma.LZMAFile))
+if gzip is not None:
+    _COMPRESSED_FORMATS.append(
+        (b'\x1f\x8b', lambda f: gzip.GzipFile(fileobj=f, mode='rb')))
+if bz2 is not None:
+    _COMPRESSED_FORMATS.append((b'BZh', bz2.BZ2File))
+
+_READ_AHEAD = 1 << 20
+
+def _open_compressed(file):
+    # The decompressed stream of file, and the BufferedReader file had to
+    # be wrapped in to peek at its magic number, or None.  The caller
+    # must detach() the wrapper, which would otherwise close file.
+    wrapper = None
+    if hasattr(file, 'peek'):
+        magic = file.peek(6)[:6]
+    elif file.seekable():
+        start = file.tell()
+        magic = file.read(6)
+        file.seek(start)
+    else:
+        file = wrapper = io.BufferedReader(file)
+        magic = file.peek(6)[:6]
+    for prefix, reader in _COMPRESSED_FORMATS:
+        if magic.startswith(prefix):
+            return reader(file), wrapper
+    if wrapper is not None:
+        wrapper.detach()
+    raise UnpicklingError("not an xz, gzip or bz2 file, or its "
+                          "decompressor is not available")
+
+def load_compressed(path_or_file, *, fix_imports=True, encoding="ASCII",
+                    errors="strict", natives=False, policy=None,
+                    text_opcodes=False, deadline=None, profile=None,
+                    max_long_digits=None):
+    """Load the pickle in an xz, gzip or bz2 compressed file.
+
+    path_or_file is a path or a binary file; the format is detected from
+    its magic number.  The pickle is decompressed as it is read, through
+    a _READ_AHEAD byte buffer, and never held in memory in full.  A file
+    given is left open.
+    """
+    if isinstance(path_or_file, (str, bytes, os.PathLike)):
+        with open(path_or_file, 'rb') as f:
+            return load_compressed(f, fix_imports=fix_imports,
+                                   encoding=encoding, errors=errors,
+                                   natives=natives, policy=policy,
+                                   text_opcodes=text_opcodes,
+                                   deadline=deadline, profile=profile,
+                                   max_long_digits=max_long_digits)
+    decompressed, wrapper = _open_compressed(path_or_file)
+    # The decompressors only close files they opened themselves
+    file = io.BufferedReader(decompressed, _READ_AHEAD)
+    try:
+        unpickler = _Unpickler(file, fix_imports=fix_imports,
+                               encoding=encoding, errors=errors,
+                               natives=natives, policy=policy,
+                               text_opcodes=text_opcodes, deadline=deadline,
+                               profile=profile,
+                               max_long_digits=max_long_digits)
+        metrics = _metrics
+        if metrics is None:
+            return unpickler.load()
+        return _observe_file(metrics, "load_compressed", unpickler.load,
+                             unpickler, file)
+    finally:
+        file.close()
+        if wrapper is not None:
+            wrapper.detach()
+
+def _load_compressed_or_error(path, return_exceptions, kwargs):
+    # Runs in a worker process of load_compressed_many()
+    try:
+        return load_compressed(path, **kwargs)
+    except Exception as e:
+        if not return_exceptions:
+            raise
+        return e
+
+def load_compressed_many(paths, *, max_workers=None, chunksize=1,
+                         return_exceptions=False, **kwargs):
+    """Load many compressed pickle files in a pool of processes.
+
+    Return an iterator over the objects, in the order of paths, as
+    load_compressed(path, **kwargs) would.  The objects are sent back
+    from the workers pickled, so they must be picklable.  If
+    return_exceptions is true an exception raised for a file is
+    returned in its place rather than raised.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    worker = partial(_load_compressed_or_error,
+                     return_exceptions=return_exceptions, kwargs=kwargs)
+    with ProcessPoolExecutor(max_workers) as executor:
+        yield from executor.map(worker, paths, chunksize=chunksize)
 
 Pickler, Unpickler = _Pickler, _Unpickler
 dump, dumps, load, loads = _dump, _dumps, _load, _loads
 
 # Doctest
+__test__ = {"index_of_a_wrapped_root": """
+Only a list or dict that STOP returns is indexed, not one wrapped later:
+
+>>> index = build_index(dumps([1, [2], 3], 2))
+>>> index.kind, len(index)
+('list', 3)
+>>> build_index(dumps(([1, 2, 3],), 2))
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: the pickle must hold a protocol 2+ list or dict
+>>> build_index(dumps(({'a': 1}, 5), 4))
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: the pickle must hold a protocol 2+ list or dict
+""",
+
+"lazy_wrapped_root": """
+loads_lazy() decodes a pickle whose list or dict is wrapped at once, as
+loads() does, rather than returning the inner container:
+
+>>> import pickle
+>>> loads_lazy(pickle.dumps(([1, 2, 3],), 2))
+([1, 2, 3],)
+>>> loads_lazy(pickle.dumps(({'a': [1]}, 5), 4))
+({'a': [1]}, 5)
+>>> lazy = loads_lazy(pickle.dumps([(1, [2]), {'b': 3}], 4))
+>>> lazy
+<LazyList of 2 items, 0 spans decoded>
+>>> lazy[1], lazy[:]
+({'b': 3}, [(1, [2]), {'b': 3}])
+""",
+
+"text_opcodes": """
+text_opcodes=True reads protocol 0 pickles as pickle does:
+
+>>> import pickle
+>>> data = pickle.dumps([1, 2.5, 'x', {'y': (10**30, -3)}], 0)
+>>> loads(data, text_opcodes=True) == pickle.loads(data)
+True
+>>> loads(data)
+Traceback (most recent call last):
+  ...
+KeyError: 112
+
+The argument of a LONG is capped at max_long_digits digits, a sign and
+the "L" suffix, or not at all if max_long_digits is 0:
+
+>>> data = b'L' + b'9' * 30 + b'L\\n.'
+>>> loads(data, text_opcodes=True, max_long_digits=30) == 10**30 - 1
+True
+>>> loads(data, text_opcodes=True, max_long_digits=0) == 10**30 - 1
+True
+>>> loads(data, text_opcodes=True, max_long_digits=28)
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: LONG argument is longer than 30 bytes
+""",
+
+"canonical": """
+Equal values pickle to the same bytes and digest whatever the order
+their dicts and sets were filled in, and pickle reads them back:
+
+>>> import pickle
+>>> a = {'b': 1, 'a': {'x', 'y', 'z'}, (1, 'k'): frozenset({'q', 'p'})}
+>>> b = {(1, 'k'): frozenset({'p', 'q'}), 'a': {'z', 'y', 'x'}, 'b': 1}
+>>> data, digest = dumps_canonical(a)
+>>> (data, digest) == dumps_canonical(b)
+True
+>>> pickle.loads(data) == a
+True
+>>> digest == hashlib.sha256(data).hexdigest()
+True
+
+There is no digest before the first canonical pickle:
+
+>>> Pickler(io.BytesIO(), 4, canonical=True).hexdigest()
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+PicklingError: no canonical pickle has been written
+""",
+
+"elide_memo": """
+elide_memo=True writes no memo opcodes for data without shared objects:
+
+>>> import pickle, pickletools
+>>> def memo_ops(data):
+...     return [op.name for op, arg, pos in pickletools.genops(data)
+...             if op.name in ('MEMOIZE', 'BINPUT', 'LONG_BINPUT')]
+>>> obj = {'a': [1, 2, 'x'], 'b': (3.5, b'y')}
+>>> data = dumps(obj, 4, elide_memo=True)
+>>> memo_ops(data), pickle.loads(data) == obj
+([], True)
+
+Shared and recursive objects keep their slots, so pickle rebuilds them:
+
+>>> shared = [1]
+>>> obj = [shared, shared]
+>>> obj.append(obj)
+>>> copy = pickle.loads(dumps(obj, 4, elide_memo=True))
+>>> copy[0] is copy[1], copy[2] is copy
+(True, True)
+
+Objects only __reduce__() can follow are all memoized, as without it:
+
+>>> obj = collections.OrderedDict(a=shared, b=shared)
+>>> data = dumps(obj, 4, elide_memo=True)
+>>> data == dumps(obj, 4)
+True
+>>> copy = pickle.loads(data)
+>>> copy['a'] is copy['b']
+True
+""",
+
+"dedup": """
+dedup=True pickles equal strings once, even when they are distinct
+objects, and pickle reads them back as one:
+
+>>> import pickle
+>>> a, b = 'x' * 10, ''.join(['x'] * 10)
+>>> a is b
+False
+>>> data = dumps([a, b, a], 4, dedup=True)
+>>> len(data) < len(dumps([a, b, a], 4))
+True
+>>> copy = pickle.loads(data)
+>>> copy == [a, b, a], copy[0] is copy[1]
+(True, True)
+
+Longer strings are written in full:
+
+>>> a, b = 'y' * 2000, ''.join(['y'] * 2000)
+>>> copy = pickle.loads(dumps([a, b], 4, dedup=True))
+>>> copy == [a, b], copy[0] is copy[1]
+(True, False)
+
+Values forgotten when the table is full are written again, and the
+references already made to them stay valid:
+
+>>> class SmallPickler(Pickler):
+...     _DEDUP_MAX_ENTRIES = 2
+>>> words = [''.join([w] * 3) for w in 'abcaba']
+>>> f = io.BytesIO()
+>>> SmallPickler(f, 4, dedup=True).dump(words)
+>>> pickle.loads(f.getvalue())
+['aaa', 'bbb', 'ccc', 'aaa', 'bbb', 'aaa']
+""",
+
+"superinstructions": """
+The superinstructions read what pickle writes at every protocol, and
+agree with the single opcode handlers a profile runs:
+
+>>> import pickle
+>>> obj = [[5], ['s', 's'], {'k': [7, 'k']}, [3] * 3]
+>>> for proto in 2, 3, 4:
+...     data = pickle.dumps(obj, proto)
+...     print(loads(data) == pickle.loads(data) == obj,
+...           loads(data, profile=OpcodeProfile()) == obj)
+True True
+True True
+True True
+
+A handler that finds the pickle ends where it looked for the next
+opcode leaves that to load(), which raises EOFError:
+
+>>> data = pickle.dumps([5], 2)
+>>> data[-4:]
+b'K\\x05a.'
+>>> loads(data[:-2])
+Traceback (most recent call last):
+  ...
+EOFError
+""",
+
+"scalar_runs": """
+Runs of BININT1, BININT2, BININT and BINFLOAT, short or long enough for
+NumPy, decode as pickle does, up to the first other opcode:
+
+>>> import pickle
+>>> obj = ([7] * 5 + [300] * 100 + [1.5] * 100 + [-2 ** 20] * 100 +
+...        ['x', 3.0])
+>>> for proto in 2, 4:
+...     data = pickle.dumps(obj, proto)
+...     print(loads(data) == pickle.loads(data) == obj)
+True
+True
+
+A pickle cut off inside a run is rejected:
+
+>>> data = pickle.dumps(list(range(300, 500)), 4)
+>>> loads(data[:100])
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: pickle exhausted before end of frame
+""",
+
+"natives": """
+natives=True loads the standard library types in _NATIVE_GLOBALS as
+pickle does, even when find_class() refuses every global:
+
+>>> import pickle, array, datetime, decimal
+>>> class StrictUnpickler(Unpickler):
+...     def find_class(self, module, name):
+...         raise UnpicklingError("global %s.%s is forbidden" %
+...                               (module, name))
+>>> obj = [collections.OrderedDict(a=1), collections.Counter('abb'),
+...        datetime.datetime(2024, 1, 2, 3, 4, 5,
+...                          tzinfo=datetime.timezone.utc),
+...        datetime.timedelta(3), decimal.Decimal('1.5'),
+...        array.array('d', [1.5]), complex(1, 2), bytearray(b'x')]
+>>> for proto in 2, 3, 4:
+...     data = pickle.dumps(obj, proto)
+...     unpickler = StrictUnpickler(io.BytesIO(data), natives=True)
+...     print(unpickler.load() == pickle.loads(data) == obj)
+True
+True
+True
+>>> StrictUnpickler(io.BytesIO(data)).load()
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: global collections.OrderedDict is forbidden
+
+The reconstructors check their arguments:
+
+>>> loads(b'\\x80\\x02ccollections\\nCounter\\n]\\x85R.', natives=True)
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: Counter() argument must be a dict
+""",
+
+"policies": """
+Every policy loads plain data as pickle does; "allowlist" also loads
+the globals in _NATIVE_GLOBALS:
+
+>>> import pickle, datetime
+>>> obj = {'a': [1, 2.5, 'x', b'y'], 'b': (None, True), 'c': {1, 2},
+...        'd': frozenset({3})}
+>>> data = pickle.dumps(obj, 4)
+>>> [loads(data, policy=policy) == pickle.loads(data) == obj
+...  for policy in ('data', 'allowlist', 'full')]
+[True, True, True]
+>>> obj = [collections.OrderedDict(a=1), datetime.date(2024, 1, 2)]
+>>> data = pickle.dumps(obj, 4)
+>>> loads(data, policy='allowlist') == pickle.loads(data) == obj
+True
+
+Opcodes and globals a policy forbids are rejected as soon as they are
+read:
+
+>>> loads(data, policy='data')
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingForbidden: opcode STACK_GLOBAL is forbidden by the 'data' policy
+>>> loads(pickle.dumps([pickle.Pickler], 4), policy='allowlist')
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingForbidden: global '_pickle.Pickler' is forbidden
+>>> loads(data, policy='nope')
+Traceback (most recent call last):
+  ...
+ValueError: unknown unpickling policy: 'nope'
+""",
+
+"deadlines": """
+A pickle loaded before its deadline comes back as pickle loads it:
+
+>>> import pickle
+>>> obj = [list(range(3000)), {'a': 'b' * 100}]
+>>> data = pickle.dumps(obj, 4)
+>>> loads(data, deadline=monotonic() + 60) == pickle.loads(data) == obj
+True
+
+Once the deadline has passed load() raises UnpicklingTimeout, an
+UnpicklingError:
+
+>>> loads(data, deadline=monotonic() - 1)
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingTimeout: unpickling deadline exceeded
+>>> issubclass(UnpicklingTimeout, UnpicklingError)
+True
+""",
+
+"opcode_profile": """
+A profiled load returns what pickle does and counts every opcode and
+byte read; without a profile the class dispatch table is used as is:
+
+>>> import pickle
+>>> profile = OpcodeProfile()
+>>> data = pickle.dumps([1, 'ab', 'ab'], 2)
+>>> loads(data, profile=profile) == pickle.loads(data)
+True
+>>> stats = profile.as_dict()
+>>> sorted((name, op['count']) for name, op in stats['opcodes'].items())
+... # doctest: +NORMALIZE_WHITESPACE
+[('APPENDS', 1), ('BINGET', 1), ('BININT1', 1), ('BINPUT', 2),
+ ('BINUNICODE', 1), ('EMPTY_LIST', 1), ('MARK', 1), ('PROTO', 1),
+ ('STOP', 1)]
+>>> stats['loads'], stats['bytes'] == len(data), stats['max_memo']
+(1, True, 2)
+>>> 'dispatch' in vars(Unpickler(io.BytesIO(data)))
+False
+
+A load that fails keeps the opcodes handled before the error:
+
+>>> profile = OpcodeProfile()
+>>> data = pickle.dumps([1, collections.OrderedDict()], 2)
+>>> loads(data, profile=profile, policy='data')
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingForbidden: opcode GLOBAL is forbidden by the 'data' policy
+>>> sorted(profile.as_dict()['opcodes'])
+['BININT1', 'BINPUT', 'EMPTY_LIST', 'MARK', 'PROTO']
+""",
+
+"allocation_profile": """
+An allocation profiled load returns what pickle does, and finds the
+memory the pickle leaves live and the opcodes that allocated most:
+
+>>> import pickle
+>>> obj = [list(range(1000)), 'x' * 10000]
+>>> data = pickle.dumps(obj, 4)
+>>> profile = AllocationProfile(top=3)
+>>> loads(data, profile=profile) == pickle.loads(data) == obj
+True
+>>> stats = profile.as_dict()
+>>> stats['live_at_stop'] >= 10000, stats['peak'] >= stats['live_at_stop']
+(True, True)
+>>> 'BINUNICODE' in [entry['opcode'] for entry in stats['offsets']]
+True
+>>> tracemalloc.stop()
+
+Without tracemalloc.reset_peak(), before Python 3.9, tracemalloc is
+restarted before each opcode, and the memory it forgets still counts:
+
+>>> reset_peak = getattr(tracemalloc, 'reset_peak', None)
+>>> if reset_peak is not None:
+...     del tracemalloc.reset_peak
+>>> try:
+...     profile = AllocationProfile(top=3)
+...     print(loads(data, profile=profile) == obj)
+... finally:
+...     if reset_peak is not None:
+...         tracemalloc.reset_peak = reset_peak
+...     tracemalloc.stop()
+True
+>>> stats = profile.as_dict()
+>>> stats['live_at_stop'] >= 10000, stats['peak'] >= stats['live_at_stop']
+(True, True)
+""",
+
+"metrics": """
+While metrics are enabled the shorthand calls are counted, failures by
+reason, and the counts of threads that ended are kept:
+
+>>> import pickle
+>>> disable_metrics()
+>>> metrics = enable_metrics()
+>>> get_metrics() is metrics
+True
+>>> data = pickle.dumps([1, 2, 'x'], 4)
+>>> loads(data) == pickle.loads(data)
+True
+>>> loads(data[:-1])
+Traceback (most recent call last):
+  ...
+EOFError
+>>> loads(pickle.dumps([pickle.Pickler], 4), policy='data')
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingForbidden: opcode STACK_GLOBAL is forbidden by the 'data' policy
+>>> thread = threading.Thread(target=dumps, args=([1],))
+>>> thread.start(); thread.join()
+>>> snapshot = metrics.snapshot()
+>>> snapshot['calls'], snapshot['failures']
+({'dumps': 1, 'loads': 3}, {'loads': {'eof': 1, 'policy': 1}})
+>>> len(metrics._shards)
+1
+>>> print(metrics.to_prometheus().split('\\n')[2])
+picklelite_calls_total{op="dumps"} 1
+>>> disable_metrics()
+""",
+
+"reuse": """
+One Pickler writes many standalone pickles into one reused buffer, and
+one Unpickler reads them back in turn until the file runs out:
+
+>>> import pickle
+>>> pickler = Pickler(io.BytesIO(), 4)
+>>> buffer = bytearray()
+>>> messages = [{'id': i, 'tag': 'x'} for i in range(3)]
+>>> pickles = [bytes(pickler.dump_into(m, buffer)) for m in messages]
+>>> pickler.dump_into(messages[0], buffer) is buffer
+True
+>>> [pickle.loads(data) for data in pickles] == messages
+True
+>>> pickles[0] == dumps(messages[0], 4)
+True
+>>> unpickler = Unpickler(io.BytesIO(b''.join(pickles)))
+>>> [unpickler.load() for _ in messages] == messages
+True
+>>> unpickler.load()
+Traceback (most recent call last):
+  ...
+EOFError
+
+dump() keeps the memo, so a second pickle of the same object refers to
+the first; reset() makes the next one stand alone again:
+
+>>> f = io.BytesIO()
+>>> pickler = Pickler(f, 4)
+>>> obj = ['shared']
+>>> pickler.dump(obj)
+>>> start = f.tell()
+>>> pickler.dump(obj)
+>>> pickle.loads(f.getvalue()[start:])
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: Memo value not found at index 0
+>>> pickler.reset()
+>>> start = f.tell()
+>>> pickler.dump(obj)
+>>> pickle.loads(f.getvalue()[start:])
+['shared']
+""",
+
+"load_path": """
+load_path() maps the file and loads what pickle wrote to it; with
+bytes_views bytes come back as read-only views into the mapping:
+
+>>> import pickle, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'data.pkl')
+>>> obj = {'a': b'x' * 100, 'b': list(range(10))}
+>>> with open(path, 'wb') as f:
+...     pickle.dump(obj, f, 4)
+>>> load_path(path) == obj
+True
+>>> view = load_path(path, bytes_views=True)['a']
+>>> type(view).__name__, view.readonly, view == obj['a']
+('memoryview', True, True)
+>>> view.release()
+
+An empty file holds no pickle, and only a MappedFile can lend views:
+
+>>> open(path, 'wb').close()
+>>> load_path(path)
+Traceback (most recent call last):
+  ...
+EOFError
+>>> Unpickler(io.BytesIO(b''), bytes_views=True)
+Traceback (most recent call last):
+  ...
+ValueError: bytes_views needs a MappedFile
+""",
+
+"load_compressed": """
+load_compressed() decodes a pickle as it decompresses it, whichever of
+the formats it is in, from a path or from an open file it leaves open:
+
+>>> import pickle, tempfile
+>>> folder = tempfile.mkdtemp()
+>>> obj = [list(range(2000)), 'x' * 5000]
+>>> data = pickle.dumps(obj, 4)
+>>> paths = []
+>>> for module in lzma, gzip, bz2:
+...     if module is not None:
+...         path = os.path.join(folder, 'data.pkl.' + module.__name__)
+...         with module.open(path, 'wb') as f:
+...             _ = f.write(data)
+...         paths.append(path)
+>>> [load_compressed(path) == obj for path in paths] == [True] * len(paths)
+True
+>>> with open(paths[0], 'rb') as f:
+...     print(load_compressed(f) == pickle.loads(data), f.closed)
+True False
+
+A file in no format it knows is rejected, here by one of the worker
+processes of load_compressed_many():
+
+>>> plain = os.path.join(folder, 'data.pkl')
+>>> with open(plain, 'wb') as f:
+...     _ = f.write(data)
+>>> load_compressed(plain)
+... # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+  ...
+UnpicklingError: not an xz, gzip or bz2 file, ...
+>>> results = load_compressed_many(paths + [plain], max_workers=2,
+...                                return_exceptions=True)
+>>> [type(result).__name__ for result in results][-2:]
+['list', 'UnpicklingError']
+""",
+
+"index": """
+Elements of an indexed list, and values of an indexed dict, decode on
+their own as pickle decodes them in place, memo references included:
+
+>>> import pickle, tempfile
+>>> shared = ['s']
+>>> obj = [{'a': i, 's': shared} for i in range(5)] + [shared, 'tail']
+>>> data = pickle.dumps(obj, 4)
+>>> index = build_index(data)
+>>> len(index)
+7
+>>> [index.element(data, i) for i in range(7)] == pickle.loads(data)
+True
+>>> index.element(data, -1)
+'tail'
+>>> obj = {'k%d' % i: [i] * 3 for i in range(5)}
+>>> data = pickle.dumps(obj, 2)
+>>> index = build_index(data)
+>>> index.keys(data) == list(pickle.loads(data))
+True
+>>> path = os.path.join(tempfile.mkdtemp(), 'index')
+>>> index.save(path)
+>>> PickleIndex.load(path).value(data, 'k4')
+[4, 4, 4]
+
+A dict's index has no elements:
+
+>>> index.element(data, 0)
+Traceback (most recent call last):
+  ...
+TypeError: the pickle holds a dict, not a list
+""",
+
+"lazy": """
+A lazy list or dict holds what pickle loads, and decodes only the
+elements asked for and those they refer to:
+
+>>> import pickle
+>>> obj = [{'a': [i]} for i in range(100)]
+>>> data = pickle.dumps(obj, 4)
+>>> lazy = loads_lazy(data)
+>>> lazy[5]
+{'a': [5]}
+>>> lazy
+<LazyList of 100 items, 2 spans decoded>
+>>> list(lazy) == pickle.loads(data)
+True
+>>> data = pickle.dumps({'x': [1], 'y': {'z': 2}}, 4)
+>>> lazy = loads_lazy(data)
+>>> lazy['y'], dict(lazy) == pickle.loads(data)
+({'z': 2}, True)
+
+Missing elements raise as they would for a list or dict:
+
+>>> loads_lazy(pickle.dumps(obj, 4))[100]
+... # doctest: +ELLIPSIS
+Traceback (most recent call last):
+  ...
+IndexError: ...index out of range
+>>> lazy['q']
+Traceback (most recent call last):
+  ...
+KeyError: 'q'
+""",
+
+"loads_path": """
+loads_path() decodes the object at a path as indexing what pickle
+loads would find it, memo references into skipped parts included:
+
+>>> import pickle
+>>> obj = {'users': [{'name': 'n%d' % i, 'email': 'e%d' % i,
+...                   'tags': ['t']} for i in range(5)],
+...        'other': list(range(100))}
+>>> data = pickle.dumps(obj, 4)
+>>> full = pickle.loads(data)
+>>> loads_path(data, ('users', 3, 'email')) == full['users'][3]['email']
+True
+>>> loads_path(data, ('users', 4, 'tags')), loads_path(data, ['users', -1])
+(['t'], {'name': 'n4', 'email': 'e4', 'tags': ['t']})
+>>> loads_path(data, ()) == full
+True
+>>> loads_path(pickle.dumps((1, [2, 3]), 4), (1, 0))
+2
+
+A path that isn't there raises as indexing would:
+
+>>> loads_path(data, ('users', 9))
+Traceback (most recent call last):
+  ...
+IndexError: list index out of range
+>>> loads_path(data, ('nope',))
+Traceback (most recent call last):
+  ...
+KeyError: 'nope'
+"""}
+
 def _test():
     import doctest
     return doctest.testmod()
@@ -1495,6 +4418,9 @@ if __name__ == "__main__":
     parser.add_argument(
         '-v', action='store_true',
         help='run verbosely; only affects self-test run')
+    parser.add_argument(
+        '-p', '--profile', action='store_true',
+        help='print opcode statistics as JSON instead of the contents')
     args = parser.parse_args()
     if args.test:
         _test()
@@ -1503,6 +4429,10 @@ if __name__ == "__main__":
             parser.print_help()
         else:
             import pprint
+            profile = OpcodeProfile() if args.profile else None
             for f in args.pickle_file:
-                obj = load(f)
-                pprint.pprint(obj)
+                obj = load(f, profile=profile)
+                if profile is None:
+                    pprint.pprint(obj)
+            if profile is not None:
+                print(profile.to_json(indent=2))
@@ -0,0 +1,1267 @@
+'''Python 3 counterparts of the tools in pickletools2714, for protocols 0-5.
+
+The opcode descriptions (OpcodeInfo, ArgumentDescriptor, StackObject) are
+those of the standard library's pickletools.  The functions here read a
+pickle in place, by offset, from anything supporting the buffer protocol,
+so an mmap of a file of several GB works as well as a bytes object.
+
+genops(pickle, lazy=False, start=0)
+   Generate all the opcodes in a pickle, as (opcode, arg, position)
+   triples, or with lazy=True (opcode, arg_start, arg_len, position)
+   without decoding any argument.
+
+dis(pickle, out=None, memo=None, indentlevel=4)
+   Print a symbolic disassembly of a pickle.
+
+optimize(p)
+   Drop unused memo writes and renumber the rest densely.
+
+optimize_file(src, dst)
+   The same from file to file, in memory that doesn't grow with the pickle.
+
+stats(pickle), stats_file(path), stats_many(paths)
+   Opcode statistics of pickles, as PickleStats; stats_many() reads the
+   files under directories in a pool of processes.
+'''
+
+import array
+import contextlib
+import csv
+import heapq
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from functools import partial
+from pickletools import (
+    opcodes, code2op, markobject, stringnl_noescape_pair,
+    UP_TO_NEWLINE, TAKEN_FROM_ARGUMENT1, TAKEN_FROM_ARGUMENT4,
+    TAKEN_FROM_ARGUMENT4U, TAKEN_FROM_ARGUMENT8U,
+)
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import gzip
+except ImportError:
+    gzip = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+__all__ = ['dis', 'genops', 'optimize', 'optimize_file', 'PickleStats',
+           'stats', 'stats_file', 'stats_many']
+
+##############################################################################
+# Reading arguments in place.
+
+# How an opcode's argument is laid out
+_NONE = 0       # no argument
+_FIXED = 1      # a fixed number of bytes
+_COUNTED = 2    # a length, then that many bytes
+_LINES = 3      # one or two newline-terminated lines
+
+_COUNTS = {
+    TAKEN_FROM_ARGUMENT1: struct.Struct('<B'),
+    TAKEN_FROM_ARGUMENT4: struct.Struct('<i'),
+    TAKEN_FROM_ARGUMENT4U: struct.Struct('<I'),
+    TAKEN_FROM_ARGUMENT8U: struct.Struct('<Q'),
+}
+
+def _unpacker(fmt):
+    unpack_from = struct.Struct(fmt).unpack_from
+    return lambda data, start, stop: unpack_from(data, start)[0]
+
+def _decode_str(encoding):
+    return lambda data, start, stop: str(data[start:stop], encoding,
+                                         'surrogatepass')
+
+def _decode_long(data, start, stop):
+    return int.from_bytes(data[start:stop], 'little', signed=True)
+
+# Argument name -> function of (data, arg_start, arg_stop) giving the same
+# value as the descriptor's reader; the rest go through the reader
+_DECODERS = {
+    'uint1': lambda data, start, stop: data[start],
+    'uint2': _unpacker('<H'),
+    'int4': _unpacker('<i'),
+    'uint4': _unpacker('<I'),
+    'uint8': _unpacker('<Q'),
+    'float8': _unpacker('>d'),
+    'bytes1': lambda data, start, stop: bytes(data[start:stop]),
+    'bytes4': lambda data, start, stop: bytes(data[start:stop]),
+    'bytes8': lambda data, start, stop: bytes(data[start:stop]),
+    'bytearray8': lambda data, start, stop: bytearray(data[start:stop]),
+    'string1': _decode_str('latin-1'),
+    'string4': _decode_str('latin-1'),
+    'unicodestring1': _decode_str('utf-8'),
+    'unicodestring4': _decode_str('utf-8'),
+    'unicodestring8': _decode_str('utf-8'),
+    'long1': _decode_long,
+    'long4': _decode_long,
+}
+
+def _opcode_table():
+    # Opcode byte -> (OpcodeInfo, layout, size, count Struct or line count,
+    # decoder or None), or None for bytes that aren't opcodes
+    table = [None] * 256
+    for opcode in opcodes:
+        arg = opcode.arg
+        if arg is None:
+            entry = (opcode, _NONE, 0, None)
+        elif arg.n >= 0:
+            entry = (opcode, _FIXED, arg.n, _DECODERS.get(arg.name))
+        elif arg.n == UP_TO_NEWLINE:
+            lines = 2 if arg is stringnl_noescape_pair else 1
+            entry = (opcode, _LINES, lines, None)
+        else:
+            entry = (opcode, _COUNTED, _COUNTS[arg.n],
+                     _DECODERS.get(arg.name))
+        table[ord(opcode.code)] = entry
+    return table
+
+_OPCODES = _opcode_table()
+
+def _find_in_view(view):
+    # A find(sub, start) for a memoryview, which has none of its own
+    def find(sub, start):
+        end = len(view)
+        while start < end:
+            chunk = bytes(view[start:start + 256])
+            i = chunk.find(sub)
+            if i >= 0:
+                return start + i
+            start += len(chunk)
+        return -1
+    return find
+
+def _buffer(pickle):
+    # (data, find, start, file) for a pickle given as a buffer or a file;
+    # positions in data are the file's positions
+    if hasattr(pickle, 'read'):
+        if isinstance(pickle, io.BytesIO):
+            data = pickle.getbuffer()
+            return data, _find_in_view(data), pickle.tell(), pickle
+        try:
+            fileno = pickle.fileno()
+            start = pickle.tell()
+            data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            data = pickle.read()
+            return data, data.find, 0, None
+        return data, data.find, start, pickle
+    if isinstance(pickle, (bytes, bytearray, mmap.mmap)):
+        return pickle, pickle.find, 0, None
+    data = memoryview(pickle)
+    if data.ndim != 1 or data.format != 'B':
+        data = data.cast('B')
+    return data, _find_in_view(data), 0, None
+
+##############################################################################
+# A pickle opcode generator.
+
+def genops(pickle, lazy=False, start=0):
+    """Generate all the opcodes in a pickle.
+
+    'pickle' is a file-like object, or an object supporting the buffer
+    protocol (bytes, bytearray, memoryview, mmap), containing the pickle.
+    A buffer is read in place from offset start.  A file is read from its
+    current position, through an mmap where it has a fileno(), and left
+    positioned after the STOP opcode.
+
+    Each opcode in the pickle is generated, stopping after a STOP opcode
+    is delivered.  A triple is generated for each opcode:
+
+        opcode, arg, pos
+
+    opcode is an OpcodeInfo record, describing the current opcode.  arg
+    is the decoded value of the argument embedded in the pickle, or None.
+    pos is the opcode's offset in the buffer, or position in the file.
+
+    With lazy=True no argument is decoded, and a quadruple is generated
+    instead:
+
+        opcode, arg_start, arg_len, pos
+
+    data[arg_start:arg_start + arg_len] holds the argument's payload: the
+    bytes after a length, or the text of a line (two lines for GLOBAL and
+    INST, joined by their newline) without the final newline.  For an
+    opcode without an argument arg_start is pos + 1 and arg_len 0.
+    """
+    data, find, pos, file = _buffer(pickle)
+    if file is None:
+        pos = start
+    try:
+        if lazy:
+            pos = yield from _genops_lazy(data, find, pos)
+        else:
+            pos = yield from _genops(data, find, pos)
+    finally:
+        if file is not None:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            else:
+                data.release()
+    if file is not None:
+        file.seek(pos)
+
+def _exhausted():
+    return ValueError("pickle exhausted before seeing STOP")
+
+def _genops_lazy(data, find, pos):
+    # genops(lazy=True) over data from pos; returns the offset after STOP
+    table = _OPCODES
+    end = len(data)
+    stop = table[ord('.')][0]
+    while True:
+        try:
+            opcode, layout, size, _ = table[data[pos]]
+        except IndexError:
+            raise _exhausted() from None
+        except TypeError:
+            raise ValueError("at position %s, opcode %r unknown"
+                             % (pos, bytes([data[pos]]))) from None
+        arg_start = pos + 1
+        if layout == _NONE:
+            next_pos = arg_start
+            n = 0
+        elif layout == _FIXED:
+            n = size
+            next_pos = arg_start + n
+        elif layout == _COUNTED:
+            try:
+                n, = size.unpack_from(data, arg_start)
+            except struct.error:
+                raise _exhausted() from None
+            if n < 0:
+                raise ValueError("negative byte count (%d) at position %s"
+                                 % (n, pos))
+            arg_start += size.size
+            next_pos = arg_start + n
+        else:
+            arg_stop = find(b'\n', arg_start)
+            if size == 2 and arg_stop >= 0:
+                arg_stop = find(b'\n', arg_stop + 1)
+            if arg_stop < 0:
+                raise ValueError("no newline found when trying to read %s"
+                                 % opcode.arg.name)
+            n = arg_stop - arg_start
+            next_pos = arg_stop + 1
+        if next_pos > end:
+            raise _exhausted()
+        yield opcode, arg_start, n, pos
+        if opcode is stop:
+            return next_pos
+        pos = next_pos
+
+def _genops(data, find, pos):
+    # genops() over data from pos; _genops_lazy() decoding each argument
+    table = _OPCODES
+    end = len(data)
+    stop = table[ord('.')][0]
+    while True:
+        try:
+            opcode, layout, size, decode = table[data[pos]]
+        except IndexError:
+            raise _exhausted() from None
+        except TypeError:
+            raise ValueError("at position %s, opcode %r unknown"
+                             % (pos, bytes([data[pos]]))) from None
+        arg_start = pos + 1
+        if layout == _NONE:
+            yield opcode, None, pos
+            if opcode is stop:
+                return arg_start
+            pos = arg_start
+            continue
+        if layout == _FIXED:
+            next_pos = arg_start + size
+        elif layout == _COUNTED:
+            try:
+                n, = size.unpack_from(data, arg_start)
+            except struct.error:
+                raise _exhausted() from None
+            if n < 0:
+                raise ValueError("negative byte count (%d) at position %s"
+                                 % (n, pos))
+            arg_start += size.size
+            next_pos = arg_start + n
+        else:
+            arg_stop = find(b'\n', arg_start)
+            if size == 2 and arg_stop >= 0:
+                arg_stop = find(b'\n', arg_stop + 1)
+            if arg_stop < 0:
+                raise ValueError("no newline found when trying to read %s"
+                                 % opcode.arg.name)
+            next_pos = arg_stop + 1
+            yield opcode, opcode.arg.reader(io.BytesIO(data[pos + 1:
+                                                            next_pos])), pos
+            pos = next_pos
+            continue
+        if next_pos > end:
+            raise _exhausted()
+        yield opcode, decode(data, arg_start, next_pos), pos
+        pos = next_pos
+
+##############################################################################
+# A pickle optimizer.
+
+_FRAME_SIZE_TARGET = 64 * 1024
+_FRAME = struct.Struct('<BQ')
+
+def _memo_key(opcode, data, arg_start, arg_len):
+    # The memo key a PUT or GET names; MEMOIZE is handled by the caller
+    if opcode.arg.n == UP_TO_NEWLINE:
+        return int(bytes(data[arg_start:arg_start + arg_len]))
+    return int.from_bytes(data[arg_start:arg_start + arg_len], 'little')
+
+def _put(index, proto):
+    if proto >= 4:
+        return b'\x94'                                  # MEMOIZE
+    if proto >= 1:
+        if index < 256:
+            return b'q' + bytes([index])                # BINPUT
+        return b'r' + index.to_bytes(4, 'little')       # LONG_BINPUT
+    return b'p%d\n' % index                             # PUT
+
+def _get(index, proto):
+    if proto >= 1:
+        if index < 256:
+            return b'h' + bytes([index])                # BINGET
+        return b'j' + index.to_bytes(4, 'little')       # LONG_BINGET
+    return b'g%d\n' % index                             # GET
+
+class _MemoWrites:
+    # The memo writes of a pickle, by ordinal, in two bits each: whether
+    # the write's key was its ordinal, as picklers number the memo in
+    # order, and whether a GET reads it.  Other keys are kept in a dict.
+    # restart() forgets the keys, to follow the writes again
+
+    def __init__(self):
+        self.identity = bytearray()
+        self.used = bytearray()
+        self.ranks = None
+        self.restart()
+
+    def restart(self):
+        self.puts = 0       # writes followed
+        self.length = 0     # the memo's length, for MEMOIZE
+        self.others = {}    # key -> ordinal of its last write
+
+    def _defined(self, key):
+        return key in self.others or (0 <= key < self.puts and
+                                      self.identity[key >> 3] >> (key & 7) & 1)
+
+    def put(self, key=None):
+        # Follow a write to key, or for MEMOIZE the next key; the ordinal
+        o = self.puts
+        if not o & 7 and o >> 3 == len(self.identity):
+            self.identity.append(0)
+            self.used.append(0)
+        if key is None:
+            key = self.length
+        if not self._defined(key):
+            self.length += 1
+        if key == o:
+            self.identity[o >> 3] |= 1 << (o & 7)
+            self.others.pop(key, None)
+        else:
+            self.others[key] = o
+        self.puts = o + 1
+        return o
+
+    def ordinal(self, key):
+        # The ordinal of the write a GET of key reads
+        o = self.others.get(key)
+        if o is not None:
+            return o
+        if 0 <= key < self.puts and self.identity[key >> 3] >> (key & 7) & 1:
+            return key
+        raise ValueError("memo key %r has never been stored into" % key)
+
+    def use(self, o):
+        self.used[o >> 3] |= 1 << (o & 7)
+
+    def is_used(self, o):
+        return self.used[o >> 3] >> (o & 7) & 1
+
+    def rank(self, o):
+        # How many writes before o are used: o's index once renumbered
+        used = self.used
+        if self.ranks is None:
+            # Used writes before each block of 512
+            self.ranks = ranks = array.array('Q', [0])
+            for block in range(0, len(used), 64):
+                ranks.append(ranks[-1] + _ones(used[block:block + 64]))
+        block = o >> 9
+        return (self.ranks[block] + _ones(used[block << 6:o >> 3]) +
+                bin(used[o >> 3] & (1 << (o & 7)) - 1).count('1'))
+
+def _ones(bits):
+    return bin(int.from_bytes(bits, 'little')).count('1')
+
+def _releaser(data):
+    # A function dropping the pages of an mmap before an offset from
+    # memory, so that reading through it doesn't grow the process, or None
+    madvise = getattr(data, 'madvise', None)
+    if madvise is None or not hasattr(mmap, 'MADV_DONTNEED'):
+        return None
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        madvise(mmap.MADV_SEQUENTIAL)
+    released = 0
+    def release(pos):
+        nonlocal released
+        pos -= pos % mmap.PAGESIZE
+        if pos > released:
+            madvise(mmap.MADV_DONTNEED, released, pos - released)
+            released = pos
+    return release
+
+def optimize(p):
+    """Optimize a pickle by removing unused memo writes.
+
+    The memo writes that are kept are renumbered densely, so they and the
+    GETs that read them use the short forms, and protocol 4 and 5 pickles
+    are re-framed.  'p' is any object genops() accepts; bytes are returned.
+    """
+    chunks = []
+    _optimize(p, chunks.append)
+    return b''.join(chunks)
+
+def optimize_file(src, dst):
+    """Optimize the pickle in file src into file dst, as optimize() does.
+
+    src and dst are paths or binary files, src one mmap can map or a
+    BytesIO.  The pickle is read twice through an mmap, dropping pages
+    once read, and written out about a frame at a time, so the memory
+    used grows with the pickle only by two bits for each memo write.
+    Returns the number of bytes written.
+    """
+    written = 0
+    def write(b):
+        nonlocal written
+        written += len(b)
+        out.write(b)
+    with contextlib.ExitStack() as stack:
+        if not hasattr(src, 'read'):
+            src = stack.enter_context(open(src, 'rb'))
+        if hasattr(dst, 'write'):
+            out = dst
+        else:
+            out = stack.enter_context(open(dst, 'wb'))
+        _optimize(src, write)
+    return written
+
+# Opcode -> what optimize() does with it; the rest are copied unchanged
+_REWRITES = {}
+for _opcode in opcodes:
+    if _opcode.name == 'MEMOIZE' or 'PUT' in _opcode.name:
+        _REWRITES[_opcode] = 'put'
+    elif 'GET' in _opcode.name:
+        _REWRITES[_opcode] = 'get'
+    elif _opcode.name in ('FRAME', 'PROTO'):
+        _REWRITES[_opcode] = _opcode.name
+del _opcode
+
+# Bytes read between releases of an mmap's pages
+_RELEASE_SIZE = 16 << 20
+
+def _optimize(p, write):
+    data, find, start, file = _buffer(p)
+    if file is None:
+        start = 0
+    release = None
+    if isinstance(data, mmap.mmap):
+        release = _releaser(data)
+    try:
+        memo = _MemoWrites()
+        declared, proto = _memo_uses(data, find, start, memo, release)
+        if release is not None:
+            # Drop the pages the first pass read; the second rereads them
+            data.madvise(mmap.MADV_DONTNEED)
+            release = _releaser(data)
+        memo.restart()
+        _rewrite(data, find, start, memo, declared >= 4, proto, write,
+                 release)
+    finally:
+        if file is not None:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            else:
+                data.release()
+
+def _memo_uses(data, find, start, memo, release):
+    # Mark in memo the writes a GET reads; returns the protocol the PROTO
+    # opcode declares and the highest protocol among the opcodes
+    declared = proto = 0
+    rewrites = _REWRITES
+    release_at = start + _RELEASE_SIZE if release else sys.maxsize
+    for opcode, arg_start, arg_len, pos in _genops_lazy(data, find, start):
+        if pos >= release_at:
+            release(pos)
+            release_at = pos + _RELEASE_SIZE
+        if opcode.proto > proto:
+            proto = opcode.proto
+        action = rewrites.get(opcode)
+        if action is None:
+            continue
+        if action == 'put':
+            if arg_start == pos + 1 and not arg_len:
+                memo.put()      # MEMOIZE
+            else:
+                memo.put(_memo_key(opcode, data, arg_start, arg_len))
+        elif action == 'get':
+            memo.use(memo.ordinal(_memo_key(opcode, data, arg_start,
+                                            arg_len)))
+        elif action == 'PROTO':
+            declared = data[arg_start]
+    return declared, max(declared, proto)
+
+def _rewrite(data, find, start, memo, framing, proto, write, release):
+    # Pass the optimized pickle to write() in pieces of about a frame:
+    # runs of opcodes are copied unchanged, the memo writes memo marks as
+    # used kept with the next index, and the pieces framed if framing
+    frame = bytearray()
+    target = _FRAME_SIZE_TARGET
+    rewrites = _REWRITES
+    release_at = start + _RELEASE_SIZE if release else sys.maxsize
+    kept = 0
+    indices = {}        # ordinal -> index, for the writes GETs read lately
+    run = start         # start of the opcodes to copy unchanged
+    for opcode, arg_start, arg_len, pos in _genops_lazy(data, find, start):
+        if pos >= release_at:
+            release(run)
+            release_at = pos + _RELEASE_SIZE
+        action = rewrites.get(opcode)
+        if action is None:
+            if arg_len < target:
+                if len(frame) + pos - run >= target:
+                    frame += data[run:pos]
+                    run = pos
+                    _end_frame(write, frame, framing)
+                continue
+            # Write large payloads outside frames
+            frame += data[run:pos]
+            _end_frame(write, frame, framing)
+            run = arg_start + arg_len
+            write(bytes(data[pos:run]))
+            continue
+        frame += data[run:pos]
+        run = arg_start + arg_len
+        if opcode.arg is not None and opcode.arg.n == UP_TO_NEWLINE:
+            run += 1
+        if action == 'put':
+            if run == pos + 1:
+                o = memo.put()  # MEMOIZE
+            else:
+                o = memo.put(_memo_key(opcode, data, arg_start, arg_len))
+            if memo.is_used(o):
+                frame += _put(kept, proto)
+                kept += 1
+        elif action == 'get':
+            o = memo.ordinal(_memo_key(opcode, data, arg_start, arg_len))
+            index = indices.get(o)
+            if index is None:
+                if len(indices) >= 4096:
+                    indices.clear()
+                index = indices[o] = memo.rank(o)
+            frame += _get(index, proto)
+        elif action == 'PROTO':
+            frame += data[pos:run]
+            _end_frame(write, frame, False)
+        if len(frame) >= target:
+            _end_frame(write, frame, framing)
+    frame += data[run:pos + 1]
+    _end_frame(write, frame, framing)
+
+def _end_frame(write, frame, framing):
+    if frame:
+        if framing and len(frame) >= 4:
+            write(_FRAME.pack(0x95, len(frame)))
+        write(bytes(frame))
+        frame.clear()
+
+##############################################################################
+# Pickle statistics.
+
+# Opcode name -> class, for the bytes spent on each kind of opcode
+_CLASSES = {}
+for _names, _class in [
+        ('INT BININT BININT1 BININT2 LONG LONG1 LONG4 STRING BINSTRING '
+         'SHORT_BINSTRING BINBYTES SHORT_BINBYTES BINBYTES8 BYTEARRAY8 NONE '
+         'NEWTRUE NEWFALSE UNICODE SHORT_BINUNICODE BINUNICODE BINUNICODE8 '
+         'FLOAT BINFLOAT', 'scalar'),
+        ('EMPTY_LIST APPEND APPENDS LIST EMPTY_TUPLE TUPLE TUPLE1 TUPLE2 '
+         'TUPLE3 EMPTY_DICT DICT SETITEM SETITEMS EMPTY_SET ADDITEMS '
+         'FROZENSET', 'container'),
+        ('POP DUP MARK POP_MARK', 'stack'),
+        ('GET BINGET LONG_BINGET PUT BINPUT LONG_BINPUT MEMOIZE', 'memo'),
+        ('EXT1 EXT2 EXT4 GLOBAL STACK_GLOBAL REDUCE BUILD INST OBJ NEWOBJ '
+         'NEWOBJ_EX PERSID BINPERSID', 'object'),
+        ('NEXT_BUFFER READONLY_BUFFER', 'buffer'),
+        ('PROTO STOP FRAME', 'framing')]:
+    for _name in _names.split():
+        _CLASSES[_name] = _class
+del _names, _class, _name
+
+# Stack effects, for the stack depth
+_PUSH = 0       # pushes len(stack_after) - len(stack_before) items
+_MARK = 1       # pushes a mark
+_TO_MARK = 2    # pops through the topmost mark
+_POP = 3        # pops an item, or a mark
+
+def _stats_table():
+    # Opcode byte -> (name, class, stack effect, items popped below the
+    # mark or the change in depth, items pushed after the mark, what the
+    # statistics pass does with it)
+    table = [None] * 256
+    for opcode in opcodes:
+        name = opcode.name
+        before, after = opcode.stack_before, opcode.stack_after
+        if name == 'MARK':
+            effect = (_MARK, 0, 0)
+        elif name == 'POP':
+            effect = (_POP, 0, 0)
+        elif markobject in before:
+            effect = (_TO_MARK, before.index(markobject), len(after))
+        else:
+            effect = (_PUSH, len(after) - len(before), 0)
+        if 'GET' in name:
+            action = 'get'
+        elif 'PUT' in name or name == 'MEMOIZE':
+            action = 'put'
+        elif name in ('SHORT_BINUNICODE', 'BINUNICODE', 'BINUNICODE8',
+                      'SHORT_BINSTRING', 'BINSTRING'):
+            action = 'str'
+        elif name in ('GLOBAL', 'INST', 'STACK_GLOBAL', 'FRAME', 'PROTO'):
+            action = name
+        elif _CLASSES[name] == 'scalar' and opcode.arg is not None:
+            action = 'scalar'
+        else:
+            action = None
+        table[ord(opcode.code)] = (name, _CLASSES[name]) + effect + (action,)
+    return table
+
+_STATS = _stats_table()
+
+class PickleStats:
+    """Statistics of the opcodes of one or more pickles, from stats().
+
+    They hold the opcode histogram, the bytes per opcode and per class of
+    opcode, the memo writes and reads, the greatest stack depth and MARK
+    nesting, the FRAME sizes, the largest scalar payloads and the globals
+    referenced.  update() adds the statistics of other pickles.  Reading a
+    malformed pickle stops at the fault, whose message is kept in error.
+    """
+
+    def __init__(self, top=5):
+        self.top = top
+        self.pickles = 0
+        self.bytes = 0
+        self.protocol = -1
+        self.counts = [0] * 256
+        self.sizes = [0] * 256
+        self.memo_writes = 0
+        self.memo_reads = 0
+        self.unread_writes = 0
+        self.max_stack = 0
+        self.max_marks = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.min_frame = None
+        self.max_frame = 0
+        self.largest = []       # heap of (size, opcode name, pos, path)
+        self.globals = {}       # 'module name' -> references
+        self.errors = 0
+        self.error = None
+
+    def _payload_floor(self):
+        # The size a payload must exceed to be kept
+        if len(self.largest) < self.top:
+            return -1
+        return self.largest[0][0]
+
+    def _payload(self, size, name, pos, path):
+        # Keep a payload if it is among the top largest; the new floor
+        item = (size, name, pos, path)
+        if len(self.largest) < self.top:
+            heapq.heappush(self.largest, item)
+        elif item > self.largest[0]:
+            heapq.heapreplace(self.largest, item)
+        return self._payload_floor()
+
+    def update(self, other):
+        """Add the statistics of other to these."""
+        self.pickles += other.pickles
+        self.bytes += other.bytes
+        self.protocol = max(self.protocol, other.protocol)
+        for code in range(256):
+            self.counts[code] += other.counts[code]
+            self.sizes[code] += other.sizes[code]
+        self.memo_writes += other.memo_writes
+        self.memo_reads += other.memo_reads
+        self.unread_writes += other.unread_writes
+        self.max_stack = max(self.max_stack, other.max_stack)
+        self.max_marks = max(self.max_marks, other.max_marks)
+        self.frames += other.frames
+        self.frame_bytes += other.frame_bytes
+        if other.min_frame is not None and (
+                self.min_frame is None or other.min_frame < self.min_frame):
+            self.min_frame = other.min_frame
+        self.max_frame = max(self.max_frame, other.max_frame)
+        for item in other.largest:
+            self._payload(*item)
+        for name, n in other.globals.items():
+            self.globals[name] = self.globals.get(name, 0) + n
+        self.errors += other.errors
+        if self.error is None:
+            self.error = other.error
+
+    def highest_protocol(self):
+        """Return the highest protocol a PROTO opcode or any opcode needs."""
+        protocol = self.protocol
+        for code, entry in enumerate(_STATS):
+            if entry is not None and self.counts[code]:
+                protocol = max(protocol, code2op[chr(code)].proto)
+        return protocol
+
+    def class_bytes(self):
+        """Return a dict of opcode class -> bytes of those opcodes."""
+        classes = dict.fromkeys(sorted(set(_CLASSES.values())), 0)
+        for code, entry in enumerate(_STATS):
+            if entry is not None:
+                classes[entry[1]] += self.sizes[code]
+        return classes
+
+    def as_dict(self):
+        """Return the statistics as a dict of plain values."""
+        opcodes = {}
+        for code, entry in enumerate(_STATS):
+            if entry is not None and self.counts[code]:
+                opcodes[entry[0]] = {"count": self.counts[code],
+                                     "bytes": self.sizes[code]}
+        largest = []
+        for size, name, pos, path in sorted(self.largest, reverse=True):
+            payload = {"opcode": name, "size": size, "pos": pos}
+            if path is not None:
+                payload["path"] = path
+            largest.append(payload)
+        return {
+            "pickles": self.pickles,
+            "bytes": self.bytes,
+            "protocol": self.highest_protocol(),
+            "opcodes": opcodes,
+            "class_bytes": self.class_bytes(),
+            "memo": {"writes": self.memo_writes, "reads": self.memo_reads,
+                     "unread_writes": self.unread_writes},
+            "max_stack": self.max_stack,
+            "max_marks": self.max_marks,
+            "frames": {"count": self.frames, "bytes": self.frame_bytes,
+                       "min": self.min_frame, "max": self.max_frame},
+            "largest_payloads": largest,
+            "globals": dict(sorted(self.globals.items())),
+            "errors": self.errors,
+            "error": self.error,
+        }
+
+    # Columns of csv_row()
+    csv_fields = (
+        ['pickles', 'bytes', 'protocol', 'opcodes'] +
+        ['%s_bytes' % c for c in sorted(set(_CLASSES.values()))] +
+        ['memo_writes', 'memo_reads', 'unread_writes', 'max_stack',
+         'max_marks', 'frames', 'min_frame', 'max_frame', 'largest_payload',
+         'globals', 'error'])
+
+    def csv_row(self):
+        """Return the statistics as a list of csv_fields values."""
+        largest = max(self.largest, default=(None,))[0]
+        return ([self.pickles, self.bytes, self.highest_protocol(),
+                 sum(self.counts)] +
+                list(self.class_bytes().values()) +
+                [self.memo_writes, self.memo_reads, self.unread_writes,
+                 self.max_stack, self.max_marks, self.frames,
+                 self.min_frame, self.max_frame, largest,
+                 ' '.join(sorted(self.globals)), self.error or ''])
+
+def stats(pickle, top=5, path=None):
+    """Return the PickleStats of every pickle in 'pickle'.
+
+    'pickle' is any object genops() accepts; the pickles in it are read
+    one after another to its end.  top is how many of the largest scalar
+    payloads to keep, and path is recorded with them.
+    """
+    result = PickleStats(top)
+    data, find, start, file = _buffer(pickle)
+    try:
+        end = len(data)
+        while start < end:
+            try:
+                start = _stats(data, find, start, result, path)
+            except ValueError as e:
+                result.errors += 1
+                result.error = str(e)
+                break
+    finally:
+        if file is not None:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            else:
+                data.release()
+    return result
+
+def _stats(data, find, start, result, path):
+    # Add the statistics of the pickle at start to result; returns its end
+    table = _STATS
+    counts = result.counts
+    sizes = result.sizes
+    globals_ = result.globals
+    depth = max_stack = 0
+    marks = []
+    max_marks = 0
+    writes = reads = 0
+    slots_read = set()
+    strings = {}        # memo key -> (start, length) of a short str
+    recent = last = None    # the two strs last pushed, for STACK_GLOBAL
+    memo_len = 0
+    floor = result._payload_floor()     # payloads this size aren't kept
+    prev_code = prev_pos = None
+    for opcode, arg_start, arg_len, pos in _genops_lazy(data, find, start):
+        code = data[pos]
+        counts[code] += 1
+        if prev_code is not None:
+            sizes[prev_code] += pos - prev_pos
+        prev_code, prev_pos = code, pos
+        _, _, effect, n, pushed, action = table[code]
+        if effect == _PUSH:
+            depth += n
+        elif effect == _MARK:
+            marks.append(depth)
+            if len(marks) > max_marks:
+                max_marks = len(marks)
+        elif effect == _TO_MARK:
+            depth = (marks.pop() if marks else 0) - n + pushed
+        elif marks and marks[-1] == depth:
+            marks.pop()
+        else:
+            depth -= 1
+        if depth > max_stack:
+            max_stack = depth
+        if action is None:
+            recent = last = None
+            continue
+        if action == 'str':
+            recent, last = last, (arg_start, arg_len)
+            if arg_len > floor:
+                floor = result._payload(arg_len, opcode.name, pos, path)
+            continue
+        if action == 'scalar':
+            recent = last = None
+            if arg_len > floor:
+                floor = result._payload(arg_len, opcode.name, pos, path)
+            continue
+        if action == 'put':
+            writes += 1
+            if arg_start == pos + 1 and not arg_len:
+                key = memo_len
+                memo_len += 1
+            else:
+                key = _memo_key(opcode, data, arg_start, arg_len)
+                memo_len = max(memo_len, key + 1)
+            if last is not None and last[1] <= 256:
+                strings[key] = last
+            else:
+                strings.pop(key, None)
+        elif action == 'get':
+            reads += 1
+            key = _memo_key(opcode, data, arg_start, arg_len)
+            slots_read.add(key)
+            recent, last = last, strings.get(key)
+        elif action == 'FRAME':
+            size = int.from_bytes(data[arg_start:arg_start + arg_len],
+                                  'little')
+            result.frames += 1
+            result.frame_bytes += size
+            if result.min_frame is None or size < result.min_frame:
+                result.min_frame = size
+            if size > result.max_frame:
+                result.max_frame = size
+        elif action == 'PROTO':
+            result.protocol = max(result.protocol, data[arg_start])
+        elif action == 'STACK_GLOBAL':
+            if recent is not None and last is not None:
+                name = '%s %s' % (
+                    str(data[recent[0]:recent[0] + recent[1]], 'utf-8',
+                        'replace'),
+                    str(data[last[0]:last[0] + last[1]], 'utf-8', 'replace'))
+            else:
+                name = '?'
+            globals_[name] = globals_.get(name, 0) + 1
+            recent = last = None
+        else:
+            # GLOBAL and INST: 'module\nname'
+            name = str(data[arg_start:arg_start + arg_len], 'utf-8',
+                       'replace').replace('\n', ' ')
+            globals_[name] = globals_.get(name, 0) + 1
+            recent = last = None
+    sizes[prev_code] += 1       # STOP
+    result.pickles += 1
+    result.bytes += pos + 1 - start
+    result.memo_writes += writes
+    result.memo_reads += reads
+    result.unread_writes += writes - len(slots_read)
+    result.max_stack = max(result.max_stack, max_stack)
+    result.max_marks = max(result.max_marks, max_marks)
+    return pos + 1
+
+# Magic number -> opener of the decompressed stream, for stats_file()
+_COMPRESSED_FORMATS = []
+if lzma is not None:
+    _COMPRESSED_FORMATS.append((b'\xfd7zXZ\x00', lzma.open))
+if gzip is not None:
+    _COMPRESSED_FORMATS.append((b'\x1f\x8b', gzip.open))
+if bz2 is not None:
+    _COMPRESSED_FORMATS.append((b'BZh', bz2.open))
+
+def stats_file(path, top=5):
+    """Return the PickleStats of the pickles in the file at path.
+
+    xz, gzip and bz2 files are decompressed to a temporary file first.
+    Failing to read the file is recorded in error, like a malformed
+    pickle.
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(6)
+            f.seek(0)
+            for prefix, opener in _COMPRESSED_FORMATS:
+                if magic.startswith(prefix):
+                    with opener(f) as decompressed, \
+                            tempfile.TemporaryFile() as temp:
+                        shutil.copyfileobj(decompressed, temp)
+                        temp.seek(0)
+                        return stats(temp, top, path)
+            return stats(f, top, path)
+    except (OSError, EOFError) as e:
+        result = PickleStats(top)
+        result.errors = 1
+        result.error = str(e) or type(e).__name__
+        return result
+
+def _walk(paths):
+    # The files named by paths, the files under directories in turn
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+def stats_many(paths, *, top=5, max_workers=None, chunksize=16):
+    """Compute the stats_file() of many files in a pool of processes.
+
+    paths may name directories, whose files are read in turn.  Return an
+    iterator over (path, PickleStats) pairs in the order of the files.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    files = list(_walk(paths))
+    with ProcessPoolExecutor(max_workers) as executor:
+        yield from zip(files, executor.map(partial(stats_file, top=top),
+                                           files, chunksize=chunksize))
+
+def _report(paths, out, fmt='json', top=5, max_workers=None):
+    # Write the statistics of each file and their total to out
+    total = PickleStats(top)
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(['path'] + PickleStats.csv_fields)
+        for path, result in stats_many(paths, top=top,
+                                       max_workers=max_workers):
+            writer.writerow([path] + result.csv_row())
+            total.update(result)
+        writer.writerow(['TOTAL'] + total.csv_row())
+        return
+    files = []
+    for path, result in stats_many(paths, top=top, max_workers=max_workers):
+        files.append(dict(path=path, **result.as_dict()))
+        total.update(result)
+    json.dump({"files": files, "total": total.as_dict()}, out, indent=2)
+    out.write('\n')
+
+##############################################################################
+# A symbolic pickle disassembler.
+
+def dis(pickle, out=None, memo=None, indentlevel=4):
+    """Produce a symbolic disassembly of a pickle.
+
+    'pickle' is any object genops() accepts, containing at least one
+    pickle.  The pickle is disassembled through the first STOP opcode.
+
+    Optional arg 'out' is a file-like object to which the disassembly is
+    printed.  It defaults to sys.stdout.
+
+    Optional arg 'memo' is a Python dict, used as the pickle's memo.  It
+    may be mutated by dis(), if the pickle contains PUT, BINPUT or MEMOIZE
+    opcodes.  Passing the same memo object to another dis() call then
+    allows disassembly to proceed across multiple pickles that were all
+    created by the same pickler with the same memo.
+
+    Optional arg indentlevel is the number of blanks by which to indent
+    a new MARK level.  It defaults to 4.
+
+    In addition to printing the disassembly, the same sanity checks as
+    pickletools2714.dis() are made, and a ValueError raised for the first
+    that fails.
+    """
+
+    # Most of the hair here is for sanity checks, but most of it is needed
+    # anyway to detect when a protocol 0 POP takes a MARK off the stack
+    # (which in turn is needed to indent MARK blocks correctly).
+
+    stack = []          # crude emulation of unpickler stack
+    if memo is None:
+        memo = {}       # crude emulation of unpickler memo
+    maxproto = -1       # max protocol number seen
+    markstack = []      # bytecode positions of MARK opcodes
+    indentchunk = ' ' * indentlevel
+    errormsg = None
+    for opcode, arg, pos in genops(pickle):
+        print("%5d:" % pos, end=' ', file=out)
+
+        line = "%-4s %s%s" % (repr(opcode.code)[1:-1],
+                              indentchunk * len(markstack),
+                              opcode.name)
+
+        maxproto = max(maxproto, opcode.proto)
+        before = opcode.stack_before    # don't mutate
+        after = opcode.stack_after      # don't mutate
+        numtopop = len(before)
+
+        # See whether a MARK should be popped.
+        markmsg = None
+        if markobject in before or (opcode.name == "POP" and
+                                    stack and
+                                    stack[-1] is markobject):
+            assert markobject not in after
+            if markstack:
+                markpos = markstack.pop()
+                markmsg = "(MARK at %d)" % markpos
+                # Pop everything at and after the topmost markobject.
+                while stack[-1] is not markobject:
+                    stack.pop()
+                stack.pop()
+                # Stop later code from popping too much.
+                try:
+                    numtopop = before.index(markobject)
+                except ValueError:
+                    assert opcode.name == "POP"
+                    numtopop = 0
+            else:
+                errormsg = markmsg = "no MARK exists on stack"
+
+        # Check for correct memo usage.
+        if opcode.name in ("PUT", "BINPUT", "LONG_BINPUT", "MEMOIZE"):
+            if opcode.name == "MEMOIZE":
+                memo_idx = len(memo)
+                markmsg = "(as %d)" % memo_idx
+            else:
+                assert arg is not None
+                memo_idx = arg
+            if memo_idx in memo:
+                errormsg = "memo key %r already defined" % memo_idx
+            elif not stack:
+                errormsg = "stack is empty -- can't store into memo"
+            elif stack[-1] is markobject:
+                errormsg = "can't store markobject in the memo"
+            else:
+                memo[memo_idx] = stack[-1]
+
+        elif opcode.name in ("GET", "BINGET", "LONG_BINGET"):
+            if arg in memo:
+                assert len(after) == 1
+                after = [memo[arg]]     # for better stack emulation
+            else:
+                errormsg = "memo key %r has never been stored into" % arg
+
+        if arg is not None or markmsg:
+            # make a mild effort to align arguments
+            line += ' ' * (10 - len(opcode.name))
+            if arg is not None:
+                line += ' ' + repr(arg)
+            if markmsg:
+                line += ' ' + markmsg
+        print(line, file=out)
+
+        if errormsg:
+            # Note that we delayed complaining until the offending opcode
+            # was printed.
+            raise ValueError(errormsg)
+
+        # Emulate the stack effects.
+        if len(stack) < numtopop:
+            raise ValueError("tries to pop %d items from stack with "
+                             "only %d items" % (numtopop, len(stack)))
+        if numtopop:
+            del stack[-numtopop:]
+        if markobject in after:
+            assert markobject not in before
+            markstack.append(pos)
+
+        stack.extend(after)
+
+    print("highest protocol among opcodes =", maxproto, file=out)
+    if stack:
+        raise ValueError("stack not empty after STOP: %r" % stack)
+
+
+# Doctest
+__test__ = {"genops_dis_optimize": """
+genops() and dis() read pickles of every protocol as pickletools does,
+and optimize() output loads as the original does:
+
+>>> import pickle, pickletools
+>>> obj = [1, 'ab', 'ab', {'k': (1.5, b'x')}, 2 ** 70]
+>>> for proto in range(6):
+...     data = pickle.dumps(obj, proto)
+...     ops = [(op.name, arg, pos) for op, arg, pos in genops(data)]
+...     std = [(op.name, arg, pos)
+...            for op, arg, pos in pickletools.genops(data)]
+...     optimized = optimize(data)
+...     print(proto, ops == std, pickle.loads(optimized) == obj,
+...           optimized == pickletools.optimize(data))
+0 True True True
+1 True True True
+2 True True True
+3 True True True
+4 True True True
+5 True True True
+>>> dis(pickle.dumps([1], 2))
+    0: \\x80 PROTO      2
+    2: ]    EMPTY_LIST
+    3: q    BINPUT     0
+    5: K    BININT1    1
+    7: a    APPEND
+    8: .    STOP
+highest protocol among opcodes = 2
+
+Truncated pickles and unknown opcodes are reported:
+
+>>> list(genops(b'\\x80\\x02]q\\x00K'))
+Traceback (most recent call last):
+  ...
+ValueError: pickle exhausted before seeing STOP
+>>> list(genops(b'\\xff.'))
+Traceback (most recent call last):
+  ...
+ValueError: at position 0, opcode b'\\xff' unknown
+""",
+
+"optimize_file": """
+optimize_file() writes what optimize() returns, from paths or files,
+and pickle loads it as it loads the original:
+
+>>> import pickle, tempfile
+>>> folder = tempfile.mkdtemp()
+>>> src = os.path.join(folder, 'in.pkl')
+>>> dst = os.path.join(folder, 'out.pkl')
+>>> shared = ['s']
+>>> obj = [{'n': i, 's': shared} for i in range(2000)]
+>>> data = pickle.dumps(obj, 4)
+>>> with open(src, 'wb') as f:
+...     _ = f.write(data)
+>>> written = optimize_file(src, dst)
+>>> with open(dst, 'rb') as f:
+...     optimized = f.read()
+>>> written == len(optimized) < len(data), optimized == optimize(data)
+(True, True)
+>>> copy = pickle.loads(optimized)
+>>> copy == obj, copy[0]['s'] is copy[1]['s']
+(True, True)
+>>> out = io.BytesIO()
+>>> optimize_file(io.BytesIO(data), out) == written
+True
+
+A truncated pickle is rejected by the first pass, before anything is
+written:
+
+>>> with open(src, 'wb') as f:
+...     _ = f.write(data[:-1])
+>>> optimize_file(src, out)
+Traceback (most recent call last):
+  ...
+ValueError: pickle exhausted before seeing STOP
+>>> out.tell() == written
+True
+""",
+
+"stats": """
+stats() counts the opcodes of every pickle in its input as pickletools
+reads them, along with the memo traffic, payloads and globals:
+
+>>> import collections, pickle, pickletools
+>>> pickles = [pickle.dumps([collections.OrderedDict(a='x' * 300), 'ab',
+...                          'ab', b'y' * 50], 4),
+...            pickle.dumps(1, 2)]
+>>> result = stats(b''.join(pickles), top=2)
+>>> counts = collections.Counter(op.name for data in pickles
+...                              for op, arg, pos in pickletools.genops(data))
+>>> opcodes = result.as_dict()['opcodes']
+>>> {name: op['count'] for name, op in opcodes.items()} == counts
+True
+>>> result.pickles, result.bytes == sum(map(len, pickles)), result.error
+(2, True, None)
+>>> result.globals, result.memo_reads
+({'collections OrderedDict': 1}, 1)
+>>> [largest[:2] for largest in sorted(result.largest, reverse=True)]
+[(300, 'BINUNICODE'), (50, 'SHORT_BINBYTES')]
+
+Reading stops at a malformed pickle, and the fault is kept, as is a
+file that can't be read:
+
+>>> result = stats(pickles[0] + pickles[0][:-3])
+>>> result.pickles, result.errors, result.error
+(1, 1, 'pickle exhausted before seeing STOP')
+>>> result = stats_file(os.path.join(tempfile.mkdtemp(), 'missing.pkl'))
+>>> result.errors, 'No such file' in result.error
+(1, True)
+"""}
+
+def _test():
+    import doctest
+    return doctest.testmod()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='disassemble pickle files, or report their statistics')
+    parser.add_argument(
+        'path', nargs='+', help='a pickle file, or with -s a directory')
+    parser.add_argument(
+        '-s', '--stats', action='store_true',
+        help='report opcode statistics of each file and their total')
+    parser.add_argument(
+        '-f', '--format', choices=('json', 'csv'), default='json',
+        help='the statistics format (default: json)')
+    parser.add_argument(
+        '-t', '--top', type=int, default=5,
+        help='how many of the largest scalar payloads to report')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='worker processes for the statistics (default: one per CPU)')
+    parser.add_argument(
+        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help='where to write the output (default: stdout)')
+    args = parser.parse_args()
+    if args.stats:
+        _report(args.path, args.output, args.format, args.top, args.jobs)
+    else:
+        for path in args.path:
+            with open(path, 'rb') as f:
+                dis(f, args.output)